@@ -1,13 +1,43 @@
+import atexit
+import codecs
+import contextvars
+import hashlib
+import hmac
+import multiprocessing
 import os
+import random
 import re
-from datetime import datetime
-from typing import List, Literal, Optional, Dict, Any
-
-from flask import Flask, jsonify, request
+import threading
+import time
+import unicodedata
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, datetime, timedelta
+from itertools import islice
+from typing import List, Literal, Optional, Dict, Any, Iterable, Iterator
+
+from flask import Flask, Response, g, jsonify, request, stream_with_context
 import json
-import requests
 from dotenv import load_dotenv
 
+from crm_outbox import CrmOutbox
+from debounce import KeyedDebouncer
+from funnel_analytics import FunnelAnalytics, event_from_analysis
+from http_clients import BackendClient
+from history_store import HistoryStore
+from idempotency import IdempotencyStore
+from job_queue import KeyedJobQueue
+from jsonl_sink import JsonlSink
+from lead_scoring import COMPARE_INSIGHT, load_model
+from lead_state import LeadStateStore
+from metrics import REGISTRY
+from outbound import OutboundScheduler
+from profiling import SlowLog, current_trace, finish_trace, record, redact, start_trace, timed
+from rules import STAGES, RulePack, RulePackRegistry, Signals
+from ttl_cache import TTLCache
+from windowed_scan import RE_WORD, WindowedScanner
+
 # --------- Data Schema Types (doc only) ---------
 StageLiteral = Literal[
     "Novo", "Qualificacao", "Diagnostico", "Proposta", "Negociacao", "Fechamento", "PosVenda"
@@ -40,14 +70,11 @@ BUDGET_PATTERNS = [
     r"\bR\$\s?\d+[\.,]?\d*", r"\$\s?\d+[\.,]?\d*", r"\b\d+\s?(k|mil|k\/m|\/mês|\/mes)\b", r"or[çc]amento", r"budget"
 ]
 
-DECISION_PATTERNS = [
-    r"sou o decisor", r"posso aprovar", r"eu aprovo", r"preciso do gerente", r"meu chefe decide", r"compras decide"
-]
+DECISION_POSITIVE = [r"sou o decisor", r"eu decido", r"posso aprovar", r"eu aprovo"]
+DECISION_NEGATIVE = [r"meu chefe decide", r"preciso do gerente", r"aprova[çc][aã]o do gerente|compras"]
 
-INTENT_PATTERNS = [
-    r"enviar (a )?proposta", r"manda (a )?proposta", r"vamos fechar", r"quero contratar", r"agendar demo", r"marcar call",
-    r"comparando (fornecedores|concorrentes)", r"testar", r"piloto", r"POC"
-]
+INTENT_STRONG = [r"vamos fechar", r"quero contratar", r"enviar (a )?proposta", r"agendar demo", r"POC|piloto"]
+INTENT_MEDIUM = [r"avaliando", r"entender melhor", r"conhecer"]
 
 STAGE_RULES = [
     ("Fechamento", [r"(assinar|assinei) contrato", r"pagamento efetuado", r"(vamos )?fechar hoje"]),
@@ -65,13 +92,23 @@ TIME_URGENCY = [
 
 COMPARE_PATTERNS = [r"concorrente", r"fornecedor", r"comparando", r"alternativas", r"or[çc]amentos"]
 
-RE_SUMMARY_CLEAN = re.compile(r"\s+", re.MULTILINE)
+# ICP: trechos procurados em metadata.segmento e metadata.tamanho_empresa
+ICP_SEGMENTS = ["saas", "ecommerce", "fintech"]
+ICP_SIZES = ["100-", "100-500", ">500", "enterprise", "medio"]
+
+RE_NON_WORD = re.compile(r"[^\w\s]+")
 
 load_dotenv()
 
 ZAPI_INSTANCE_ID = os.getenv("Z_API_INSTANCE_ID", "").strip()
 ZAPI_TOKEN = os.getenv("Z_API_TOKEN", "").strip()
-ZAPI_BASE = "https://api.z-api.io"
+ZAPI_BASE = os.getenv("Z_API_BASE_URL", "https://api.z-api.io").rstrip("/")
+# Outras instâncias que respondem pelo próprio número: "instancia:token,instancia2:token2"
+ZAPI_INSTANCE_TOKENS = dict(
+    (part.split(":", 1)[0].strip(), part.split(":", 1)[1].strip())
+    for part in os.getenv("Z_API_INSTANCE_TOKENS", "").split(",")
+    if ":" in part
+)
 
 CRM_BASE_URL = os.getenv("CRM_API_BASE_URL", "").rstrip("/")
 CRM_TOKEN = os.getenv("CRM_API_TOKEN", "").strip()
@@ -80,68 +117,231 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "").strip()
 OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
 LLM_MODEL = os.getenv("LLM_MODEL", "gpt-4o-mini")
 
-
-def compile_patterns(patterns: List[str]) -> List[re.Pattern]:
-    return [re.compile(p, re.IGNORECASE) for p in patterns]
-
-# Precompile
-PAIN_REGEX = [re.compile(p, re.IGNORECASE) for p in PAIN_PATTERNS]
-OBJECTION_REGEX = {k: compile_patterns(v) for k, v in OBJECTION_MAP.items()}
-BUDGET_REGEX = [re.compile(p, re.IGNORECASE) for p in BUDGET_PATTERNS]
-DECISION_REGEX = [re.compile(p, re.IGNORECASE) for p in DECISION_PATTERNS]
-INTENT_REGEX = [re.compile(p, re.IGNORECASE) for p in INTENT_PATTERNS]
-STAGE_REGEX = [(s, compile_patterns(ps)) for s, ps in STAGE_RULES]
-TIME_URGENCY_REGEX = [(re.compile(p, re.IGNORECASE), lvl) for p, lvl in TIME_URGENCY]
-COMPARE_REGEX = [re.compile(p, re.IGNORECASE) for p in COMPARE_PATTERNS]
+# Clientes HTTP por backend (pool, timeout, retries e breaker via <PREFIXO>_HTTP_*)
+ZAPI_CLIENT = BackendClient.from_env("zapi", "ZAPI", timeout=20.0)
+CRM_CLIENT = BackendClient.from_env("crm", "CRM", timeout=20.0)
+LLM_CLIENT = BackendClient.from_env("llm", "LLM", timeout=30.0, retries=1)
+
+# Logs JSONL (var/data): buffer, rotação e retenção
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+LOG_ROTATE_DAILY = os.getenv("LOG_ROTATE_DAILY", "1").lower() in ("1", "true", "yes")
+LOG_COMPRESS = os.getenv("LOG_COMPRESS", "1").lower() in ("1", "true", "yes")
+LOG_RETENTION_DAYS = int(os.getenv("LOG_RETENTION_DAYS", "30"))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "1"))
+LOG_FLUSH_RECORDS = int(os.getenv("LOG_FLUSH_RECORDS", "256"))
+LOG_MAX_RECORD_BYTES = int(os.getenv("LOG_MAX_RECORD_BYTES", str(256 * 1024)))
+
+# Outbox do CRM: mutações gravadas em SQLite e enviadas em background
+CRM_OUTBOX_ENABLED = os.getenv("CRM_OUTBOX", "1").lower() in ("1", "true", "yes")
+CRM_OUTBOX_PATH = os.getenv("CRM_OUTBOX_PATH", "")
+CRM_TASKS_BULK_PATH = os.getenv("CRM_TASKS_BULK_PATH", "")
+CRM_OUTBOX_CONCURRENCY = int(os.getenv("CRM_OUTBOX_CONCURRENCY", "8"))
+CRM_OUTBOX_INTERVAL = float(os.getenv("CRM_OUTBOX_INTERVAL", "2"))
+CRM_OUTBOX_MAX_ATTEMPTS = int(os.getenv("CRM_OUTBOX_MAX_ATTEMPTS", "20"))
+
+# Estado por lead: sinais acumulados entre mensagens do webhook
+LEAD_STATE_ENABLED = os.getenv("LEAD_STATE", "1").lower() in ("1", "true", "yes")
+LEAD_STATE_PATH = os.getenv("LEAD_STATE_PATH", "")
+LEAD_STATE_CACHE = int(os.getenv("LEAD_STATE_CACHE", "10000"))
+
+# Resposta via LLM: cache de respostas e prazo máximo por mensagem
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", "8"))
+LLM_STREAM = os.getenv("LLM_STREAM", "0").lower() in ("1", "true", "yes")
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+REPLY_CACHE_SIZE = int(os.getenv("REPLY_CACHE_SIZE", "2048"))
+REPLY_CACHE_TTL = float(os.getenv("REPLY_CACHE_TTL", "3600"))
+REPLY_CACHE_MAX_CHARS = int(os.getenv("REPLY_CACHE_MAX_CHARS", "120"))
+
+REPLY_CACHE = TTLCache(REPLY_CACHE_SIZE, REPLY_CACHE_TTL)
+_llm_executor = ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY, thread_name_prefix="llm")
+_reply_stats = {"generated": 0, "deadline_fallbacks": 0, "errors": 0, "shed": 0}
+_reply_stats_lock = threading.Lock()
+
+# Score de lead: "rule" (regra aditiva) ou "model" (modelo treinado por lead_scoring.py)
+LEAD_SCORING = os.getenv("LEAD_SCORING", "rule").strip().lower()
+LEAD_MODEL_PATH = os.getenv("LEAD_MODEL_PATH", "")
+
+# Scheduler de saída: limite de taxa (req/s; 0 = ilimitado) e prioridade para LLM e Z-API
+LLM_RATE = float(os.getenv("LLM_RATE", "0"))
+LLM_BURST = float(os.getenv("LLM_BURST", "0"))
+LLM_MAX_WAIT = float(os.getenv("LLM_MAX_WAIT", "2"))
+ZAPI_RATE = float(os.getenv("ZAPI_RATE", "0"))
+ZAPI_BURST = float(os.getenv("ZAPI_BURST", "0"))
+ZAPI_INSTANCE_RATE = float(os.getenv("ZAPI_INSTANCE_RATE", "0"))
+ZAPI_INSTANCE_BURST = float(os.getenv("ZAPI_INSTANCE_BURST", "0"))
+ZAPI_MAX_WAIT = float(os.getenv("ZAPI_MAX_WAIT", "30"))
+OUTBOUND_MAX_QUEUE = int(os.getenv("OUTBOUND_MAX_QUEUE", "500"))
+OUTBOUND_SHED_PRIORITY = float(os.getenv("OUTBOUND_SHED_PRIORITY", "40"))
+OUTBOUND_SHED_DEPTH = int(os.getenv("OUTBOUND_SHED_DEPTH", "50"))
+
+# Baixa prioridade sob sobrecarga cai na resposta padrão
+LLM_SCHEDULER = OutboundScheduler(
+    "llm",
+    LLM_RATE,
+    LLM_BURST,
+    max_queue=OUTBOUND_MAX_QUEUE,
+    max_wait=LLM_MAX_WAIT,
+    shed_priority=OUTBOUND_SHED_PRIORITY,
+    shed_depth=OUTBOUND_SHED_DEPTH,
+)
+# Envio não tem alternativa: só espera a vez (ou sai com a fila cheia)
+ZAPI_SCHEDULER = OutboundScheduler(
+    "zapi",
+    ZAPI_RATE,
+    ZAPI_BURST,
+    key_rate=ZAPI_INSTANCE_RATE,
+    key_burst=ZAPI_INSTANCE_BURST,
+    max_queue=OUTBOUND_MAX_QUEUE,
+    max_wait=ZAPI_MAX_WAIT,
+)
+
+# Lote: itens por tarefa do pool, limiar para usar processos e limite do modo JSON
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "0")) or (os.cpu_count() or 1)
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", "64"))
+BATCH_POOL_THRESHOLD = int(os.getenv("BATCH_POOL_THRESHOLD", "256"))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "10000"))
+
+# Webhook assíncrono: responde 202 e processa LLM/CRM/WhatsApp em background
+WEBHOOK_ASYNC = os.getenv("WEBHOOK_ASYNC", "0").lower() in ("1", "true", "yes")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+WEBHOOK_QUEUE_MAX = int(os.getenv("WEBHOOK_QUEUE_MAX", "1000"))
+
+# Agrupamento de rajadas por telefone (segundos; 0 desativa). Implica processamento em background
+WEBHOOK_DEBOUNCE = float(os.getenv("WEBHOOK_DEBOUNCE", "0"))
+WEBHOOK_DEBOUNCE_MAX_WAIT = float(os.getenv("WEBHOOK_DEBOUNCE_MAX_WAIT", "10"))
+WEBHOOK_DEBOUNCE_MAX_MESSAGES = int(os.getenv("WEBHOOK_DEBOUNCE_MAX_MESSAGES", "20"))
+
+# Idempotência do webhook: reentregas da mesma mensagem não são reprocessadas
+IDEMPOTENCY_ENABLED = os.getenv("IDEMPOTENCY", "1").lower() in ("1", "true", "yes")
+IDEMPOTENCY_CACHE = int(os.getenv("IDEMPOTENCY_CACHE", "10000"))
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_PERSIST = os.getenv("IDEMPOTENCY_PERSIST", "0").lower() in ("1", "true", "yes")
+
+# Histórico indexado (SQLite) consultado por /leads
+HISTORY_STORE_ENABLED = os.getenv("HISTORY_STORE", "1").lower() in ("1", "true", "yes")
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH", "")
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "1"))
+HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", "500"))
+
+# Rollups do funil em /analytics/funnel
+ANALYTICS_ENABLED = os.getenv("ANALYTICS", "1").lower() in ("1", "true", "yes")
+ANALYTICS_DB_PATH = os.getenv("ANALYTICS_DB_PATH", "")
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_INTERVAL", "1"))
+ANALYTICS_DEFAULT_DAYS = int(os.getenv("ANALYTICS_DEFAULT_DAYS", "30"))
+# Grava em analysis.jsonl as análises de /analyze e /analyze/stream, para o rebuild (só os campos do funil)
+ANALYTICS_LOG_ANALYSES = os.getenv("ANALYTICS_LOG_ANALYSES", "0").lower() in ("1", "true", "yes")
+
+# Análise em streaming (/analyze/stream): tamanho da janela, sobreposição e leitura, em caracteres/bytes
+ANALYZE_STREAM_WINDOW = int(os.getenv("ANALYZE_STREAM_WINDOW", "65536"))
+ANALYZE_STREAM_OVERLAP = int(os.getenv("ANALYZE_STREAM_OVERLAP", "512"))
+ANALYZE_STREAM_READ = int(os.getenv("ANALYZE_STREAM_READ", "65536"))
+
+# Pacotes de regras por tenant (RULES_DIR/<tenant>.json), recarregados a quente
+RULES_DIR = os.getenv("RULES_DIR", "")
+RULES_RELOAD_INTERVAL = float(os.getenv("RULES_RELOAD_INTERVAL", "5"))
+RULES_TENANT_HEADER = os.getenv("RULES_TENANT_HEADER", "X-Tenant")
+
+# Requisições lentas e profiler sob demanda (/admin/slow)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "").strip()
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "1000"))
+SLOW_REQUEST_BUFFER = int(os.getenv("SLOW_REQUEST_BUFFER", "100"))
+SLOW_REQUEST_MAX_CHARS = int(os.getenv("SLOW_REQUEST_MAX_CHARS", "20000"))
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "1"))
+PROFILE_HEADER = os.getenv("PROFILE_HEADER", "X-Profile")
+
+# Métricas (formato Prometheus em /metrics)
+METRICS_ENABLED = os.getenv("METRICS", "1").lower() in ("1", "true", "yes")
+HTTP_REQUESTS = REGISTRY.counter("funnel_http_requests_total", "Requisições recebidas por rota, método e status", ("route", "method", "status"))
+HTTP_LATENCY = REGISTRY.histogram("funnel_http_request_duration_seconds", "Duração das requisições por rota", ("route", "method"))
+STEP_LATENCY = REGISTRY.histogram("funnel_step_duration_seconds", "Duração de cada etapa do pipeline por resultado", ("step", "status"))
+ANALYSIS_STAGES = REGISTRY.counter("funnel_analysis_stage_total", "Análises por estágio do funil e origem", ("stage", "source"))
+LEAD_SCORES = REGISTRY.histogram(
+    "funnel_lead_score", "Distribuição do lead_score por origem", ("source",), buckets=(10, 20, 30, 40, 50, 60, 70, 80, 90, 100)
+)
+REPLY_OUTCOMES = REGISTRY.counter("funnel_reply_outcomes_total", "Respostas ao cliente por origem (llm, cache, fallback)", ("outcome",))
+
+
+# --------- Signal Engine ---------
+
+# Pacote base: as tabelas acima. Tenants sobrescrevem o que quiserem em RULES_DIR/<tenant>.json
+DEFAULT_RULES = RulePack("default", "builtin", {
+    "stage_rules": STAGE_RULES,
+    "pain": PAIN_PATTERNS,
+    "objections": OBJECTION_MAP,
+    "budget": BUDGET_PATTERNS,
+    "decision_positive": DECISION_POSITIVE,
+    "decision_negative": DECISION_NEGATIVE,
+    "intent_strong": INTENT_STRONG,
+    "intent_medium": INTENT_MEDIUM,
+    "urgency": TIME_URGENCY,
+    "compare": COMPARE_PATTERNS,
+    "icp_segments": ICP_SEGMENTS,
+    "icp_sizes": ICP_SIZES,
+})
+RULES = RulePackRegistry(DEFAULT_RULES, RULES_DIR, RULES_RELOAD_INTERVAL)
+
+# Carregado uma vez na subida (cada worker do pool carrega o seu ao importar o app)
+LEAD_MODEL = (
+    load_model(LEAD_MODEL_PATH or os.path.join(os.getcwd(), "var", "data", "lead_model.json"))
+    if LEAD_SCORING == "model" else None
+)
+
+SIGNAL_TABLES: Dict[str, List[str]] = DEFAULT_RULES.signal_tables
+
+
+@timed("detectors")
+def scan_signals(transcript: str, rules: Optional[RulePack] = None) -> Signals:
+    return (rules or DEFAULT_RULES).scan(transcript)
 
 # --------- Core Logic ---------
 
-def detect_stage(transcript: str) -> tuple[StageLiteral, float, List[str]]:
-    hits = []
-    for stage, patterns in STAGE_REGEX:
-        for pat in patterns:
-            if pat.search(transcript):
-                hits.append(stage)
-                break
-    priority = {name: i for i, (name, _) in enumerate(STAGE_RULES)}
+@timed("detectors")
+def detect_stage(transcript: str, signals: Optional[Signals] = None) -> tuple[StageLiteral, float, List[str]]:
+    signals = signals or scan_signals(transcript)
+    rules = signals.rules or DEFAULT_RULES
+    hits = [stage for stage, patterns in rules.stage_rules if signals.any(patterns)]
     if not hits:
         return "Novo", 0.35, []
-    top = min(hits, key=lambda s: priority[s])
+    top = min(hits, key=lambda s: rules.stage_priority[s])
     confidence = 0.8 if top in ("Proposta", "Negociacao", "Fechamento") else 0.6
     return top, confidence, hits
 
 
-def detect_pain_points(transcript: str) -> List[str]:
+@timed("detectors")
+def detect_pain_points(transcript: str, signals: Optional[Signals] = None) -> List[str]:
+    signals = signals or scan_signals(transcript)
     pains = set()
-    for reg in PAIN_REGEX:
-        m = reg.search(transcript)
+    for p in (signals.rules or DEFAULT_RULES).pain:
+        m = signals.group(p)
         if m:
-            pains.add(m.group(0))
+            pains.add(m)
     return list(pains)[:3]
 
 
-def detect_objections(transcript: str) -> List[str]:
-    found = []
-    for label, regs in OBJECTION_REGEX.items():
-        for r in regs:
-            if r.search(transcript):
-                found.append(label)
-                break
-    return found
+@timed("detectors")
+def detect_objections(transcript: str, signals: Optional[Signals] = None) -> List[str]:
+    signals = signals or scan_signals(transcript)
+    return [label for label, patterns in (signals.rules or DEFAULT_RULES).objections.items() if signals.any(patterns)]
 
 
-def detect_urgency(transcript: str) -> UrgencyLiteral:
-    for reg, lvl in TIME_URGENCY_REGEX:
-        if reg.search(transcript):
+@timed("detectors")
+def detect_urgency(transcript: str, signals: Optional[Signals] = None) -> UrgencyLiteral:
+    signals = signals or scan_signals(transcript)
+    for p, lvl in (signals.rules or DEFAULT_RULES).urgency:
+        if signals.hit(p):
             return lvl  # type: ignore
     return "Baixa"
 
 
-def detect_budget_signal(transcript: str) -> BudgetSignalLiteral:
+@timed("detectors")
+def detect_budget_signal(transcript: str, signals: Optional[Signals] = None) -> BudgetSignalLiteral:
+    signals = signals or scan_signals(transcript)
+    rules = signals.rules or DEFAULT_RULES
     any_num = False
-    for reg in BUDGET_REGEX:
-        if reg.search(transcript):
-            if re.search(r"\d", reg.pattern):
+    for p in rules.budget:
+        if signals.hit(p):
+            if rules.budget_numeric[p]:
                 any_num = True
             else:
                 return "Indireto"
@@ -150,58 +350,61 @@ def detect_budget_signal(transcript: str) -> BudgetSignalLiteral:
     return "Inexistente"
 
 
-def detect_decision_maker(transcript: str) -> DecisionMakerLiteral:
-    positive = [r"sou o decisor", r"eu decido", r"posso aprovar", r"eu aprovo"]
-    negative = [r"meu chefe decide", r"preciso do gerente", r"aprova[çc][aã]o do gerente|compras"]
-    for p in compile_patterns(positive):
-        if p.search(transcript):
-            return "Sim"
-    for n in compile_patterns(negative):
-        if n.search(transcript):
-            return "Nao"
+@timed("detectors")
+def detect_decision_maker(transcript: str, signals: Optional[Signals] = None) -> DecisionMakerLiteral:
+    signals = signals or scan_signals(transcript)
+    rules = signals.rules or DEFAULT_RULES
+    if signals.any(rules.decision_positive):
+        return "Sim"
+    if signals.any(rules.decision_negative):
+        return "Nao"
     return "Desconhecido"
 
 
-def detect_intent(transcript: str) -> IntentLiteral:
-    strong = [r"vamos fechar", r"quero contratar", r"enviar (a )?proposta", r"agendar demo", r"POC|piloto"]
-    medium = [r"avaliando", r"entender melhor", r"conhecer"]
-    for p in compile_patterns(strong):
-        if p.search(transcript):
-            return "Alto"
-    for p in compile_patterns(medium):
-        if p.search(transcript):
-            return "Medio"
+@timed("detectors")
+def detect_intent(transcript: str, signals: Optional[Signals] = None) -> IntentLiteral:
+    signals = signals or scan_signals(transcript)
+    rules = signals.rules or DEFAULT_RULES
+    if signals.any(rules.intent_strong):
+        return "Alto"
+    if signals.any(rules.intent_medium):
+        return "Medio"
     return "Baixo"
 
 
-def detect_icp_fit(metadata: Dict[str, Any]) -> ICPFitLiteral:
+@timed("detectors")
+def detect_icp_fit(metadata: Dict[str, Any], rules: Optional[RulePack] = None) -> ICPFitLiteral:
+    rules = rules or DEFAULT_RULES
     seg = str(metadata.get("segmento", "")).lower()
     size = str(metadata.get("tamanho_empresa", "")).lower()
-    if any(k in seg for k in ["saas", "ecommerce", "fintech"]) or any(k in size for k in ["100-", "100-500", ">500", "enterprise", "medio"]):
+    if any(k in seg for k in rules.icp_segments) or any(k in size for k in rules.icp_sizes):
         return "Alto"
     if seg:
         return "Medio"
     return "Baixo"
 
 
-def compute_lead_score(transcript: str, urgency: UrgencyLiteral, budget: BudgetSignalLiteral, decision: DecisionMakerLiteral) -> int:
+def compute_lead_score(transcript: str, urgency: UrgencyLiteral, budget: BudgetSignalLiteral, decision: DecisionMakerLiteral, signals: Optional[Signals] = None) -> int:
+    signals = signals or scan_signals(transcript)
+    rules = signals.rules or DEFAULT_RULES
     score = 0
-    if detect_pain_points(transcript) and urgency == "Alta":
+    if detect_pain_points(transcript, signals) and urgency == "Alta":
         score += 20
     if budget == "Presente":
         score += 15
     if decision == "Sim":
         score += 10
-    if any(r.search(transcript) for r in COMPARE_REGEX):
+    if signals.any(rules.compare):
         score += 10
-    if any(r.search(transcript) for r in OBJECTION_REGEX["prioridade"]):
+    if signals.any(rules.objections.get("prioridade", [])):
         score -= 10
     return max(0, min(100, score))
 
 
+@timed("detectors")
 def summarize_pt(transcript: str) -> str:
-    words = RE_SUMMARY_CLEAN.sub(" ", transcript).strip().split()
-    return " ".join(words[:30])[:240]
+    # Só as 30 primeiras palavras interessam: para de ler o texto ao chegar nelas
+    return " ".join(m.group() for m in islice(RE_WORD.finditer(transcript), 30))[:240]
 
 
 def build_next_best_actions(stage: StageLiteral, intent: IntentLiteral, decision: DecisionMakerLiteral, objections: List[str], urgency: UrgencyLiteral) -> List[Dict[str, Any]]:
@@ -232,6 +435,379 @@ def build_tasks(stage: StageLiteral, decision: DecisionMakerLiteral, complete_di
         tasks.append({"title": "Gerar proposta base e anexar cases", "due_in_hours": 12, "priority": "High"})
     return tasks
 
+def extract_features(transcript: str, signals: Optional[Signals] = None, summary: Optional[str] = None) -> Dict[str, Any]:
+    """Sinais brutos de um texto, antes dos ajustes de estágio e da montagem da resposta."""
+    signals = signals or scan_signals(transcript)
+    stage, stage_conf, _ = detect_stage(transcript, signals)
+    return {
+        "stage": stage,
+        "stage_confidence": stage_conf,
+        "pain_points": detect_pain_points(transcript, signals),
+        "objections": detect_objections(transcript, signals),
+        "urgency": detect_urgency(transcript, signals),
+        "budget_signal": detect_budget_signal(transcript, signals),
+        "decision_maker": detect_decision_maker(transcript, signals),
+        "buying_intent": detect_intent(transcript, signals),
+        "compares_vendors": signals.any((signals.rules or DEFAULT_RULES).compare),
+        "low_priority": signals.any((signals.rules or DEFAULT_RULES).objections.get("prioridade", [])),
+        "summary_pt": summarize_pt(transcript) if summary is None else summary,
+    }
+
+
+@timed("detectors")
+def score_features(features: Dict[str, Any]) -> int:
+    # Mesma regra de compute_lead_score, a partir de sinais já extraídos
+    score = 0
+    if features["pain_points"] and features["urgency"] == "Alta":
+        score += 20
+    if features["budget_signal"] == "Presente":
+        score += 15
+    if features["decision_maker"] == "Sim":
+        score += 10
+    if features["compares_vendors"]:
+        score += 10
+    if features["low_priority"]:
+        score -= 10
+    return max(0, min(100, score))
+
+
+def build_analysis(lead_id: str, features: Dict[str, Any], metadata: Dict[str, Any], rules: Optional[RulePack] = None) -> Dict[str, Any]:
+    stage = features["stage"]
+    stage_conf = features["stage_confidence"]
+    pains = features["pain_points"]
+    objections = features["objections"]
+    urgency = features["urgency"]
+    budget = features["budget_signal"]
+    decision = features["decision_maker"]
+    intent = features["buying_intent"]
+    icp_fit = detect_icp_fit(metadata, rules)
+    lead_score = score_features(features)
+
+    if decision != "Sim" and stage == "Fechamento":
+        stage = "Negociacao"
+        stage_conf = min(stage_conf, 0.75)
+
+    if stage in ("Novo", "Qualificacao") and intent == "Baixo":
+        stage_conf = min(stage_conf, 0.5)
+
+    nba = build_next_best_actions(stage, intent, decision, objections, urgency)
+    tasks = build_tasks(stage, decision, complete_diagnosis=(stage != "Diagnostico"))
+
+    insights: List[str] = []
+    if urgency != "Baixa":
+        insights.append(f"Urgência: {urgency}")
+    if budget != "Inexistente":
+        insights.append(f"Sinal de orçamento: {budget}")
+    if features["compares_vendors"]:
+        insights.append(COMPARE_INSIGHT)
+
+    if LEAD_MODEL is not None:
+        # Mesmas features que o treino extrai do histórico; sem modelo, fica a regra
+        lead_score = LEAD_MODEL.score({
+            "stage": stage,
+            "urgency": urgency,
+            "budget_signal": budget,
+            "decision_maker": decision,
+            "buying_intent": intent,
+            "icp_fit": icp_fit,
+            "pain_points": pains,
+            "objections": objections,
+            "compares_vendors": features["compares_vendors"],
+            "messages": features.get("messages"),
+        })
+
+    summary = features["summary_pt"]
+
+    tags: List[str] = []
+    if lead_score >= 70:
+        tags.append("quente")
+    if budget == "Presente":
+        tags.append("budget_presente")
+    if urgency == "Alta":
+        tags.append("urgencia_alta")
+    if decision != "Sim":
+        tags.append("nao_decisor")
+
+    result = {
+        "lead_id": lead_id,
+        "stage": stage,
+        "stage_confidence": round(float(stage_conf), 2),
+        "lead_score": int(lead_score),
+        "icp_fit": icp_fit,
+        "buying_intent": intent,
+        "pain_points": pains,
+        "objections": objections,
+        "urgency": urgency,
+        "budget_signal": budget,
+        "decision_maker": decision,
+        "next_best_actions": nba,
+        "insights": insights,
+        "summary_pt": summary,
+        "tasks_to_create": tasks,
+        "tags": tags,
+    }
+    if rules is not None and rules is not DEFAULT_RULES:
+        result["rules"] = f"{rules.tenant}@{rules.version}"
+    if LEAD_MODEL is not None:
+        result["scoring"] = f"model@{LEAD_MODEL.version}"
+    return result
+
+
+def analyze_transcript(lead_id: str, transcript: str, metadata: Dict[str, Any], rules: Optional[RulePack] = None) -> Dict[str, Any]:
+    return build_analysis(lead_id, extract_features(transcript, scan_signals(transcript, rules)), metadata, rules)
+
+
+# --------- Streaming Analysis ---------
+
+def analyze_stream(lead_id: str, chunks: Iterable[str], metadata: Dict[str, Any], rules: Optional[RulePack] = None) -> Dict[str, Any]:
+    """Analisa um texto longo lido aos pedaços, sem manter o texto inteiro em memória.
+
+    O resultado é o mesmo de `analyze_transcript` sobre o texto completo, mais
+    `signal_segments`: onde cada sinal apareceu pela primeira vez (janela,
+    linha, offset e timestamp da fala, quando houver).
+    """
+    rules = rules or DEFAULT_RULES
+    scanner = WindowedScanner(rules.engine, window=ANALYZE_STREAM_WINDOW, overlap=ANALYZE_STREAM_OVERLAP)
+    for chunk in chunks:
+        scanner.feed(chunk)
+    hits = scanner.finish()
+    signals = Signals({p: hits.get(p) for p in rules.engine.order}, rules)
+    result = build_analysis(lead_id, extract_features("", signals, summary=scanner.summary()), metadata, rules)
+
+    located: List[tuple] = sorted(((p, h) for p, h in hits.items()), key=lambda ph: ph[1].offset)
+    result["signal_segments"] = [
+        {
+            "signals": rules.labels.get(p, []),
+            "match": h.text,
+            "segment": h.segment,
+            "line": h.line,
+            "offset": h.offset,
+            "timestamp": h.timestamp,
+        }
+        for p, h in located
+    ]
+    result["stream"] = {"chars": scanner.chars, "segments": scanner.segments, "window": scanner.window, "overlap": scanner.overlap}
+    return result
+
+
+def iter_text_chunks(stream: Any, size: int = ANALYZE_STREAM_READ, encoding: str = "utf-8") -> Iterator[str]:
+    # Decodifica incrementalmente: um caractere multibyte pode chegar dividido entre leituras
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    while True:
+        data = stream.read(size)
+        if not data:
+            break
+        text = decoder.decode(data)
+        if text:
+            yield text
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+def observe_analysis(result: Dict[str, Any], source: str) -> None:
+    # Contado na borda (rota/pipeline) porque o lote pode rodar em outros processos
+    if "stage" in result:
+        ANALYSIS_STAGES.inc(result["stage"], source)
+        LEAD_SCORES.observe(result.get("lead_score", 0), source)
+        if ANALYTICS_ENABLED and source in FUNNEL_SOURCES:
+            track_funnel(result, source)
+
+# --------- Lead State ---------
+
+URGENCY_RANK = {"Baixa": 0, "Media": 1, "Alta": 2}
+INTENT_RANK = {"Baixo": 0, "Medio": 1, "Alto": 2}
+BUDGET_RANK = {"Inexistente": 0, "Indireto": 1, "Presente": 2}
+
+
+def merge_features(state: Optional[Dict[str, Any]], new: Dict[str, Any], rules: Optional[RulePack] = None) -> Dict[str, Any]:
+    """Acumula os sinais de uma nova mensagem no estado do lead.
+
+    Só os sinais da mensagem nova são extraídos; o merge é O(1) no tamanho do
+    histórico. Estágio, urgência, intenção e orçamento guardam o maior nível já
+    visto; objeções e dores são unidas; o decisor fica com a última informação
+    conhecida. A ordem dos estágios e das objeções é a do pacote de regras.
+    """
+    if not state:
+        return {**new, "messages": 1}
+    rules = rules or DEFAULT_RULES
+    priority = rules.stage_priority
+    # Estágio fora do pacote (ex.: estado gravado com outras regras) perde para qualquer um do pacote
+    unknown = len(priority)
+    merged = dict(state)
+    # Mensagem sem nenhum hit de estágio não rebaixa nem muda a confiança
+    new_has_stage = new["stage_confidence"] > 0.35
+    if new_has_stage and (
+        state["stage_confidence"] <= 0.35
+        or priority.get(new["stage"], unknown) < priority.get(state["stage"], unknown)
+    ):
+        merged["stage"], merged["stage_confidence"] = new["stage"], new["stage_confidence"]
+    elif new_has_stage and new["stage"] == state["stage"]:
+        merged["stage_confidence"] = max(state["stage_confidence"], new["stage_confidence"])
+    merged["pain_points"] = list(dict.fromkeys(state["pain_points"] + new["pain_points"]))[:3]
+    seen = dict.fromkeys(state["objections"] + new["objections"])
+    # Ordem do pacote; rótulos que ele não conhece (de outra versão) ficam no fim
+    merged["objections"] = [label for label in rules.objections if label in seen] + [
+        label for label in seen if label not in rules.objections
+    ]
+    merged["urgency"] = max(state["urgency"], new["urgency"], key=URGENCY_RANK.__getitem__)
+    merged["buying_intent"] = max(state["buying_intent"], new["buying_intent"], key=INTENT_RANK.__getitem__)
+    merged["budget_signal"] = max(state["budget_signal"], new["budget_signal"], key=BUDGET_RANK.__getitem__)
+    if new["decision_maker"] != "Desconhecido":
+        merged["decision_maker"] = new["decision_maker"]
+    merged["compares_vendors"] = state["compares_vendors"] or new["compares_vendors"]
+    merged["low_priority"] = state["low_priority"] or new["low_priority"]
+    merged["summary_pt"] = new["summary_pt"]
+    merged["messages"] = state.get("messages", 0) + 1
+    return merged
+
+
+_lead_state: Optional[LeadStateStore] = None
+_lead_state_lock = threading.Lock()
+
+
+def get_lead_state() -> LeadStateStore:
+    global _lead_state
+    with _lead_state_lock:
+        if _lead_state is None:
+            _lead_state = LeadStateStore(
+                LEAD_STATE_PATH or os.path.join(_ensure_data_dir(), "lead_state.sqlite3"),
+                cache_size=LEAD_STATE_CACHE,
+            )
+    return _lead_state
+
+
+def analyze_message(
+    lead_id: str,
+    text: str,
+    metadata: Dict[str, Any],
+    rules: Optional[RulePack] = None,
+    state_store: Optional[LeadStateStore] = None,
+) -> Dict[str, Any]:
+    """Análise de uma mensagem no contexto do lead (estado acumulado), quando habilitado.
+
+    `state_store` troca o estado do serviço por outro (o replay usa um próprio).
+    """
+    features = extract_features(text, scan_signals(text, rules))
+    if state_store is None and not LEAD_STATE_ENABLED:
+        return build_analysis(lead_id, features, metadata, rules)
+    state = (state_store or get_lead_state()).update(lead_id, lambda current: merge_features(current, features, rules))
+    analysis = build_analysis(lead_id, state, metadata, rules)
+    analysis["messages"] = state["messages"]
+    return analysis
+
+# --------- Batch ---------
+
+_batch_pool: Optional[ProcessPoolExecutor] = None
+_batch_pool_lock = threading.Lock()
+
+
+def _get_batch_pool() -> Optional[ProcessPoolExecutor]:
+    global _batch_pool
+    if BATCH_WORKERS <= 1:
+        return None
+    with _batch_pool_lock:
+        if _batch_pool is None:
+            # spawn: um fork copiaria um processo com threads rodando (logs, filas, dispatcher)
+            # e os locks que elas seguram no momento
+            _batch_pool = ProcessPoolExecutor(max_workers=BATCH_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _batch_pool
+
+
+def _reset_batch_pool(broken: ProcessPoolExecutor) -> None:
+    # Um worker morto (OOM, segfault numa lib nativa) quebra o pool para sempre: descarta-o
+    # para que o próximo _get_batch_pool crie outro. Só troca se ninguém já trocou.
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is broken:
+            _batch_pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def analyze_item(item: Any, tenant: str = "") -> Dict[str, Any]:
+    # Um item inválido vira um resultado de erro na mesma posição, sem abortar o lote
+    if not isinstance(item, dict):
+        return {"lead_id": "", "error": "item deve ser um objeto JSON"}
+    if "_invalid" in item:
+        return {"lead_id": "", "error": f"JSON inválido: {item['_invalid']}"}
+    lead_id = item.get("lead_id", "")
+    if not lead_id:
+        return {"lead_id": "", "error": "lead_id obrigatório"}
+    return analyze_transcript(lead_id, item.get("transcript", "") or "", item.get("metadata") or {}, RULES.get(tenant))
+
+
+def _analyze_chunk(items: List[Any], tenant: str = "") -> List[Dict[str, Any]]:
+    return [analyze_item(it, tenant) for it in items]
+
+
+def iter_analyze_batch(items: Iterable[Any], tenant: str = "") -> Iterator[Dict[str, Any]]:
+    """Analisa `items` e devolve os resultados na ordem de entrada.
+
+    Lotes pequenos rodam no próprio processo. Lotes grandes são divididos em
+    blocos de BATCH_CHUNK_SIZE e distribuídos no pool de processos, com no
+    máximo 2 blocos por worker em voo, então a memória não cresce com o lote.
+    Os workers resolvem `tenant` no próprio registro de regras. Se um worker
+    morre, o pool é recriado e os blocos em voo são reenviados uma vez.
+    """
+    it = iter(items)
+    head = list(islice(it, BATCH_POOL_THRESHOLD))
+    pool = _get_batch_pool() if len(head) >= BATCH_POOL_THRESHOLD else None
+    if pool is None:
+        yield from _analyze_chunk(head, tenant)
+        for item in it:
+            yield analyze_item(item, tenant)
+        return
+
+    # (future, bloco): o bloco fica junto para poder ser reenviado
+    pending: deque = deque()
+    chunks = (head[i:i + BATCH_CHUNK_SIZE] for i in range(0, len(head), BATCH_CHUNK_SIZE))
+    max_in_flight = BATCH_WORKERS * 2
+    retries = 1
+
+    def next_chunk() -> List[Any]:
+        chunk = next(chunks, None)
+        return chunk if chunk is not None else list(islice(it, BATCH_CHUNK_SIZE))
+
+    while True:
+        try:
+            while len(pending) < max_in_flight:
+                chunk = next_chunk()
+                if not chunk:
+                    break
+                # Entra na fila antes do submit: se o pool já estiver quebrado, o bloco é
+                # reenviado junto com os outros em voo
+                pending.append((None, chunk))
+                pending[-1] = (pool.submit(_analyze_chunk, chunk, tenant), chunk)
+            if not pending:
+                return
+            results = pending[0][0].result()
+        except BrokenProcessPool:
+            if not retries:
+                _reset_batch_pool(pool)
+                raise
+            retries -= 1
+            _reset_batch_pool(pool)
+            pool = _get_batch_pool()
+            pending = deque((pool.submit(_analyze_chunk, chunk, tenant), chunk) for _, chunk in pending)
+            continue
+        pending.popleft()
+        yield from results
+
+
+def analyze_batch(items: Iterable[Any], tenant: str = "") -> List[Dict[str, Any]]:
+    return list(iter_analyze_batch(items, tenant))
+
+
+def _iter_ndjson(lines: Iterable[bytes]) -> Iterator[Any]:
+    for raw in lines:
+        line = raw.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as exc:
+            yield {"_invalid": str(exc)}
+
 def _digits_only(value: str) -> str:
     return re.sub(r"\D+", "", value or "")
 
@@ -240,16 +816,113 @@ def _ensure_data_dir() -> str:
     os.makedirs(data_dir, exist_ok=True)
     return data_dir
 
+_log_sinks: Dict[str, JsonlSink] = {}
+_log_sinks_lock = threading.Lock()
+_log_sinks_pid = os.getpid()
+
+
+def get_log_sink(filename: str) -> JsonlSink:
+    global _log_sinks_pid
+    with _log_sinks_lock:
+        # Após fork a thread de escrita não existe no filho: recria os sinks
+        if _log_sinks_pid != os.getpid():
+            _log_sinks.clear()
+            _log_sinks_pid = os.getpid()
+        sink = _log_sinks.get(filename)
+        if sink is None:
+            sink = JsonlSink(
+                os.path.join(_ensure_data_dir(), filename),
+                max_bytes=LOG_MAX_BYTES,
+                rotate_daily=LOG_ROTATE_DAILY,
+                compress=LOG_COMPRESS,
+                retention_days=LOG_RETENTION_DAYS,
+                flush_interval=LOG_FLUSH_INTERVAL,
+                flush_records=LOG_FLUSH_RECORDS,
+                max_record_bytes=LOG_MAX_RECORD_BYTES,
+            )
+            _log_sinks[filename] = sink
+        return sink
+
+
+def close_log_sinks() -> None:
+    with _log_sinks_lock:
+        sinks = list(_log_sinks.values()) if _log_sinks_pid == os.getpid() else []
+    for sink in sinks:
+        sink.close()
+
+
 def log_jsonl(filename: str, record: Dict[str, Any]) -> None:
-    path = os.path.join(_ensure_data_dir(), filename)
-    with open(path, "a", encoding="utf-8") as f:
-        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    get_log_sink(filename).write(record)
+
+
+_history_store: Optional[HistoryStore] = None
+_history_store_lock = threading.Lock()
+
+
+def get_history_store() -> HistoryStore:
+    global _history_store
+    with _history_store_lock:
+        if _history_store is None:
+            _history_store = HistoryStore(
+                HISTORY_DB_PATH or os.path.join(_ensure_data_dir(), "history.sqlite3"),
+                batch_size=HISTORY_BATCH_SIZE,
+                flush_interval=HISTORY_FLUSH_INTERVAL,
+            )
+    return _history_store
+
+
+def close_history_store() -> None:
+    if _history_store is not None:
+        _history_store.close()
+
+
+_funnel_analytics: Optional[FunnelAnalytics] = None
+_funnel_analytics_lock = threading.Lock()
+
+# O lote fica de fora: costuma reprocessar leads já contados. As análises avulsas só contam
+# quando vão para analysis.jsonl; senão um rebuild apagaria contagens que não consegue refazer
+FUNNEL_SOURCES = ("analyze", "stream", "webhook") if ANALYTICS_LOG_ANALYSES else ("webhook",)
+
+
+def get_funnel_analytics() -> FunnelAnalytics:
+    global _funnel_analytics
+    with _funnel_analytics_lock:
+        if _funnel_analytics is None:
+            _funnel_analytics = FunnelAnalytics(
+                ANALYTICS_DB_PATH or os.path.join(_ensure_data_dir(), "funnel.sqlite3"),
+                flush_interval=ANALYTICS_FLUSH_INTERVAL,
+            )
+    return _funnel_analytics
+
+
+def close_funnel_analytics() -> None:
+    if _funnel_analytics is not None:
+        _funnel_analytics.close()
+
+
+def track_funnel(result: Dict[str, Any], source: str) -> None:
+    ts = datetime.utcnow().isoformat()
+    # O webhook já fica no history.jsonl. As análises avulsas (só chegam aqui com
+    # ANALYTICS_LOG_ANALYSES) vão sem texto do cliente (summary_pt etc.): só o que event_from_record lê
+    if source != "webhook":
+        funnel_fields = {k: result.get(k) for k in ("stage", "lead_score", "icp_fit", "objections")}
+        log_jsonl("analysis.jsonl", {"lead_id": result.get("lead_id"), "source": source, "analysis": funnel_fields, "ts": ts})
+    get_funnel_analytics().observe(event_from_analysis(result, ts))
+
+
+def record_history(record: Dict[str, Any]) -> None:
+    # O JSONL continua sendo o registro bruto; o SQLite é o índice consultável
+    log_jsonl("history.jsonl", record)
+    if HISTORY_STORE_ENABLED:
+        get_history_store().add(record)
 
 def extract_zapi_event(payload: Dict[str, Any]) -> Dict[str, Any]:
     # Tenta cobrir formatos comuns de webhook (texto e origem)
     text = None
     phone = None
     sender_name = None
+    message_id = None
+    timestamp = None
 
     # Texto
     candidates = [
@@ -267,6 +940,8 @@ def extract_zapi_event(payload: Dict[str, Any]) -> Dict[str, Any]:
             text = (msg0.get("text") or {}).get("body") or msg0.get("body") or msg0.get("message")
             phone = msg0.get("from") or msg0.get("author") or msg0.get("phone")
             sender_name = msg0.get("pushName") or msg0.get("senderName") or msg0.get("name")
+            message_id = msg0.get("id") or msg0.get("messageId")
+            timestamp = msg0.get("timestamp")
     except Exception:
         pass
 
@@ -290,18 +965,92 @@ def extract_zapi_event(payload: Dict[str, Any]) -> Dict[str, Any]:
     if sender_name is None:
         sender_name = payload.get("senderName") or payload.get("pushName") or payload.get("name")
 
-    return {"text": text or "", "phone": phone_digits, "sender_name": sender_name or ""}
+    # Identificador da mensagem no provedor (usado para idempotência) e horário
+    if message_id is None:
+        key = payload.get("key")
+        message_id = payload.get("messageId") or payload.get("id") or (key.get("id") if isinstance(key, dict) else None)
+    if timestamp is None:
+        timestamp = payload.get("momment") or payload.get("timestamp") or payload.get("messageTimestamp")
+
+    return {
+        "text": text or "",
+        "phone": phone_digits,
+        "sender_name": sender_name or "",
+        "message_id": str(message_id) if message_id else "",
+        "timestamp": str(timestamp) if timestamp else "",
+        "instance_id": str(payload.get("instanceId") or ""),
+    }
+
+def outbound_priority(analysis: Dict[str, Any]) -> float:
+    # Score (0-100) + 5 por estágio avançado + 15 por nível de urgência: "vamos fechar hoje" passa na frente de "oi"
+    stage = analysis.get("stage")
+    rank = STAGES.index(stage) if stage in STAGES else 0
+    return float(analysis.get("lead_score") or 0) + 5 * rank + 15 * URGENCY_RANK.get(analysis.get("urgency"), 0)
 
-def send_whatsapp_message(phone: str, message: str) -> Dict[str, Any]:
-    if not (ZAPI_INSTANCE_ID and ZAPI_TOKEN):
+
+def zapi_credentials(instance_id: str = "") -> tuple[str, str]:
+    """Instância e token que enviam a resposta: a do evento, se configurada, senão a padrão."""
+    if instance_id and instance_id in ZAPI_INSTANCE_TOKENS:
+        return instance_id, ZAPI_INSTANCE_TOKENS[instance_id]
+    return ZAPI_INSTANCE_ID, ZAPI_TOKEN
+
+
+def send_whatsapp_message(phone: str, message: str, priority: float = 0.0, instance_id: str = "") -> Dict[str, Any]:
+    instance, token = zapi_credentials(instance_id)
+    if not (instance and token):
         return {"skipped": True, "reason": "Z-API não configurada"}
-    url = f"{ZAPI_BASE}/instances/{ZAPI_INSTANCE_ID}/token/{ZAPI_TOKEN}/send-message"
+    # O balde é o da instância que de fato envia, a mesma da URL
+    if not ZAPI_SCHEDULER.acquire(priority, instance):
+        return {"error": "fila de envio saturada", "shed": True}
+    url = f"{ZAPI_BASE}/instances/{instance}/token/{token}/send-message"
     try:
-        resp = requests.post(url, json={"phone": phone, "message": message}, timeout=20)
+        resp = ZAPI_CLIENT.post(url, json={"phone": phone, "message": message})
         return {"status_code": resp.status_code, "body": (resp.json() if resp.headers.get("content-type", "").startswith("application/json") else resp.text)}
     except Exception as exc:
         return {"error": str(exc)}
 
+_crm_outbox: Optional[CrmOutbox] = None
+_crm_outbox_lock = threading.Lock()
+
+
+def get_crm_outbox() -> CrmOutbox:
+    global _crm_outbox
+    with _crm_outbox_lock:
+        if _crm_outbox is None:
+            _crm_outbox = CrmOutbox(
+                CRM_OUTBOX_PATH or os.path.join(_ensure_data_dir(), "crm_outbox.sqlite3"),
+                CRM_CLIENT,
+                CRM_BASE_URL,
+                CRM_TOKEN,
+                bulk_path=CRM_TASKS_BULK_PATH,
+                concurrency=CRM_OUTBOX_CONCURRENCY,
+                interval=CRM_OUTBOX_INTERVAL,
+                max_attempts=CRM_OUTBOX_MAX_ATTEMPTS,
+            )
+    return _crm_outbox
+
+
+def start_crm_outbox() -> None:
+    """Sobe o dispatcher já na carga do app, para retomar o que ficou pendente sem esperar um webhook.
+
+    Processos filhos do multiprocessing (pool do lote, workers do replay) não enviam nada.
+    """
+    if CRM_BASE_URL and CRM_TOKEN and CRM_OUTBOX_ENABLED and multiprocessing.parent_process() is None:
+        get_crm_outbox().start()
+
+
+def _reset_crm_outbox_after_fork() -> None:
+    # Workers do gunicorn com --preload: o fork copia a conexão SQLite, mas não a thread do
+    # dispatcher. Cada worker abre os seus; as linhas são reservadas (lease), então não há envio duplo.
+    global _crm_outbox, _crm_outbox_lock
+    _crm_outbox = None
+    _crm_outbox_lock = threading.Lock()
+    start_crm_outbox()
+
+
+start_crm_outbox()
+os.register_at_fork(after_in_child=_reset_crm_outbox_after_fork)
+
 def update_crm(lead_id: str, stage: StageLiteral, insights: List[str], tags: List[str], tasks: List[Dict[str, Any]]) -> Dict[str, Any]:
     record = {
         "lead_id": lead_id,
@@ -311,19 +1060,22 @@ def update_crm(lead_id: str, stage: StageLiteral, insights: List[str], tags: Lis
         "tasks": tasks,
         "ts": datetime.utcnow().isoformat(),
     }
-    # Se houver API do CRM configurada, tenta sincronizar
+    # Com outbox, grava a mutação localmente e o dispatcher envia em background
+    if CRM_BASE_URL and CRM_TOKEN and CRM_OUTBOX_ENABLED:
+        return get_crm_outbox().enqueue(lead_id, {"stage": stage, "insights": insights, "tags": tags}, tasks)
+    # Sem outbox, sincroniza direto com a API do CRM
     if CRM_BASE_URL and CRM_TOKEN:
         headers = {"Authorization": f"Bearer {CRM_TOKEN}", "Content-Type": "application/json"}
         results: Dict[str, Any] = {"sent": []}
         try:
-            r1 = requests.patch(f"{CRM_BASE_URL}/leads/{lead_id}", headers=headers, json={"stage": stage, "insights": insights, "tags": tags}, timeout=20)
+            r1 = CRM_CLIENT.patch(f"{CRM_BASE_URL}/leads/{lead_id}", headers=headers, json={"stage": stage, "insights": insights, "tags": tags})
             results["sent"].append({"endpoint": "lead", "code": r1.status_code})
         except Exception as exc:
             results.setdefault("errors", []).append({"endpoint": "lead", "error": str(exc)})
         # Cria tarefas
         for t in tasks:
             try:
-                r2 = requests.post(f"{CRM_BASE_URL}/tasks", headers=headers, json={"lead_id": lead_id, **t}, timeout=20)
+                r2 = CRM_CLIENT.post(f"{CRM_BASE_URL}/tasks", headers=headers, json={"lead_id": lead_id, **t})
                 results["sent"].append({"endpoint": "task", "code": r2.status_code})
             except Exception as exc:
                 results.setdefault("errors", []).append({"endpoint": "task", "error": str(exc)})
@@ -332,6 +1084,66 @@ def update_crm(lead_id: str, stage: StageLiteral, insights: List[str], tags: Lis
     log_jsonl("crm_sync.jsonl", record)
     return {"logged": True}
 
+def normalize_message(text: str) -> str:
+    # Minúsculas, sem acentos nem pontuação: "Olá!!" e "ola" viram a mesma chave
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    stripped = "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return " ".join(RE_NON_WORD.sub(" ", stripped).split())
+
+
+# Contexto que uma resposta em cache pode ter visto: nada específico do lead (id, resumo, dores,
+# orçamento), senão a resposta escrita para um lead seria servida a outro
+REPLY_CACHE_CONTEXT = ("stage", "buying_intent", "urgency")
+
+
+def _reply_cache_key(user_text: str, analysis: Dict[str, Any]) -> Optional[tuple]:
+    norm = normalize_message(user_text)
+    if not norm or len(norm) > REPLY_CACHE_MAX_CHARS:
+        return None
+    return (norm,) + tuple(analysis.get(k) for k in REPLY_CACHE_CONTEXT)
+
+
+def _complete_chat(messages: List[Dict[str, str]], deadline: float) -> Optional[str]:
+    # Pedido que ficou na fila além do prazo não vira uma completion paga que ninguém lê
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        return None
+    payload = {"model": LLM_MODEL, "messages": messages, "temperature": 0.4, "max_tokens": 120}
+    headers = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"}
+    if not LLM_STREAM:
+        resp = LLM_CLIENT.post(f"{OPENAI_BASE_URL}/chat/completions", headers=headers, json=payload, timeout=remaining)
+        data = resp.json()
+        return (
+            (((data or {}).get("choices") or [{}])[0].get("message") or {}).get("content")
+            if isinstance(data, dict) else None
+        )
+    # Streaming (SSE): tokens chegam aos poucos e a leitura para no deadline
+    resp = LLM_CLIENT.post(f"{OPENAI_BASE_URL}/chat/completions", headers=headers, json={**payload, "stream": True}, stream=True, timeout=remaining)
+    parts: List[str] = []
+    try:
+        for line in resp.iter_lines():
+            if time.monotonic() > deadline:
+                return None
+            if not line.startswith(b"data:"):
+                continue
+            data = line[5:].strip()
+            if data == b"[DONE]":
+                break
+            chunk = json.loads(data)
+            delta = ((chunk.get("choices") or [{}])[0].get("delta") or {}).get("content")
+            if delta:
+                parts.append(delta)
+    finally:
+        resp.close()
+    return "".join(parts) or None
+
+
+def _count_reply(outcome: str) -> None:
+    REPLY_OUTCOMES.inc(outcome)
+    with _reply_stats_lock:
+        _reply_stats[outcome] += 1
+
+
 def generate_reply(user_text: str, analysis: Dict[str, Any], sender_name: str = "") -> str:
     # Prompt curto e humano em PT-BR
     system_prompt = (
@@ -342,46 +1154,449 @@ def generate_reply(user_text: str, analysis: Dict[str, Any], sender_name: str =
     fallback = f"{name_part}obrigado pela mensagem! Vou te ajudar com isso. Poderia me confirmar rapidamente orçamento, prazo e quem decide?"
 
     if not OPENAI_API_KEY:
+        REPLY_OUTCOMES.inc("disabled")
+        return fallback
+
+    # Mensagens curtas e repetidas ("oi", "olá") no mesmo estágio/intenção/urgência reaproveitam a resposta
+    key = _reply_cache_key(user_text, analysis)
+    if key is not None:
+        cached = REPLY_CACHE.get(key)
+        if cached is not None:
+            REPLY_OUTCOMES.inc("cache_hit")
+            return cached
+
+    deadline = time.monotonic() + LLM_DEADLINE
+    # A espera pela vez conta no prazo da resposta
+    if not LLM_SCHEDULER.acquire(outbound_priority(analysis), timeout=LLM_DEADLINE):
+        _count_reply("shed")
         return fallback
 
+    # Resposta que vai para o cache só vê o contexto que está na chave
+    context = {k: analysis.get(k) for k in REPLY_CACHE_CONTEXT} if key is not None else analysis
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": (
+            "Contexto do CRM (JSON):\n" + json.dumps(context, ensure_ascii=False) + "\n\n" +
+            "Mensagem do cliente:\n" + user_text + "\n\n" +
+            "Gere uma resposta curta (<= 2 frases), natural e útil."
+        )},
+    ]
+    # Contexto copiado: a chamada ao LLM entra no trace da requisição
+    future = _llm_executor.submit(contextvars.copy_context().run, _complete_chat, messages, deadline)
+
+    def remember(f) -> None:
+        # Respostas que chegam depois do deadline ainda aquecem o cache
+        if key is not None and not f.cancelled() and not f.exception() and f.result():
+            REPLY_CACHE.put(key, f.result().strip())
+
+    future.add_done_callback(remember)
     try:
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": (
-                "Contexto do CRM (JSON):\n" + json.dumps(analysis, ensure_ascii=False) + "\n\n" +
-                "Mensagem do cliente:\n" + user_text + "\n\n" +
-                "Gere uma resposta curta (<= 2 frases), natural e útil."
-            )},
-        ]
-        resp = requests.post(
-            f"{OPENAI_BASE_URL}/chat/completions",
-            headers={
-                "Authorization": f"Bearer {OPENAI_API_KEY}",
-                "Content-Type": "application/json",
-            },
-            json={
-                "model": LLM_MODEL,
-                "messages": messages,
-                "temperature": 0.4,
-                "max_tokens": 120,
-            },
-            timeout=30,
-        )
-        data = resp.json()
-        content = (
-            (((data or {}).get("choices") or [{}])[0].get("message") or {}).get("content")
-            if isinstance(data, dict) else None
-        )
-        return (content or fallback).strip()
+        content = future.result(timeout=max(0.0, deadline - time.monotonic()))
+    except FutureTimeout:
+        # Se ainda está na fila, não roda mais; se já está em curso, _complete_chat para no prazo
+        future.cancel()
+        _count_reply("deadline_fallbacks")
+        return fallback
     except Exception:
+        _count_reply("errors")
         return fallback
+    if not content:
+        _count_reply("deadline_fallbacks" if time.monotonic() > deadline else "errors")
+        return fallback
+    _count_reply("generated")
+    return content.strip()
+
+
+# --------- Pipeline ---------
+
+def _step_status(result: Any) -> str:
+    if not isinstance(result, dict):
+        return "ok"
+    if result.get("skipped"):
+        return "skipped"
+    if "error" in result or result.get("errors"):
+        return "error"
+    if "status_code" in result:
+        return str(result["status_code"])
+    return "ok"
+
+
+def run_step(step: str, fn, *args: Any, **kwargs: Any) -> Any:
+    """Executa uma etapa do pipeline registrando duração e resultado em /metrics."""
+    t0 = time.perf_counter()
+    try:
+        result = fn(*args, **kwargs)
+    except Exception:
+        STEP_LATENCY.observe(time.perf_counter() - t0, step, "exception")
+        raise
+    finally:
+        record("steps", step, time.perf_counter() - t0)
+    STEP_LATENCY.observe(time.perf_counter() - t0, step, _step_status(result))
+    return result
+
+
+def process_message(lead_id: str, phone: str, text: str, sender_name: str = "", tenant: str = "", instance_id: str = "") -> Dict[str, Any]:
+    # Analisar o conteúdo no contexto acumulado do lead, com as regras do tenant
+    analysis_json = run_step("analysis", analyze_message, lead_id, text, {"origem": "whatsapp"}, RULES.get(tenant))
+    observe_analysis(analysis_json, "webhook")
+
+    # Gerar resposta ao cliente
+    reply_text = run_step("generate_reply", generate_reply, text, analysis_json, sender_name)
+
+    # Atualizar CRM (ou log local)
+    crm_sync = run_step(
+        "update_crm",
+        update_crm,
+        lead_id=lead_id,
+        stage=analysis_json.get("stage"),
+        insights=analysis_json.get("insights", []),
+        tags=analysis_json.get("tags", []),
+        tasks=analysis_json.get("tasks_to_create", []),
+    )
+
+    # Enviar via WhatsApp (Z-API)
+    wa_send = run_step(
+        "send_whatsapp_message",
+        send_whatsapp_message,
+        phone=phone,
+        message=reply_text,
+        priority=outbound_priority(analysis_json),
+        instance_id=instance_id,
+    )
+
+    # Log de histórico
+    record = {
+        "lead_id": lead_id,
+        "phone": phone,
+        "name": sender_name,
+        "text": text,
+        "reply": reply_text,
+        "analysis": analysis_json,
+        "crm_sync": crm_sync,
+        "wa_send": wa_send,
+        "ts": datetime.utcnow().isoformat(),
+    }
+    run_step("log_history", record_history, record)
+    return record
+
+
+def webhook_idempotency_key(event: Dict[str, Any]) -> str:
+    # Sem id do provedor, usa telefone + horário + hash do texto; sem horário não há como distinguir reenvio
+    if event.get("message_id"):
+        return f"id:{event['message_id']}"
+    if event.get("timestamp"):
+        digest = hashlib.sha256(event.get("text", "").encode("utf-8")).hexdigest()[:32]
+        return f"h:{event.get('phone', '')}:{event['timestamp']}:{digest}"
+    return ""
+
+
+def webhook_outcome(result: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "ok": True,
+        "lead_id": result["lead_id"],
+        "stage": result["analysis"].get("stage"),
+        "reply": result["reply"],
+        "wa": result["wa_send"],
+        "crm": result["crm_sync"],
+    }
+
+
+def run_webhook_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    # Uma rajada agrupada carrega as chaves de todas as mensagens que a compõem
+    keys = job.pop("idempotency_keys", [])
+    # Nos workers (modo assíncrono) não há requisição em volta: o job tem o próprio trace
+    token = start_trace() if SLOW_REQUEST_MS > 0 and current_trace() is None else None
+    t0 = time.perf_counter()
+    try:
+        outcome = webhook_outcome(process_message(**job))
+    except Exception:
+        for key in keys:
+            IDEMPOTENCY.abort(key)
+        raise
+    finally:
+        if token is not None:
+            trace = finish_trace(token)
+            elapsed = time.perf_counter() - t0
+            if elapsed * 1000 >= SLOW_REQUEST_MS:
+                capture_slow("slow", "webhook:job", "", 0, elapsed, trace, job)
+    for key in keys:
+        IDEMPOTENCY.complete(key, outcome)
+    return outcome
+
+
+def merge_burst(jobs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    # Mensagens da rajada viram uma única transcrição, na ordem de chegada
+    last = jobs[-1]
+    return {
+        "lead_id": last["lead_id"],
+        "phone": last["phone"],
+        "text": "\n".join(j["text"] for j in jobs),
+        "sender_name": next((j["sender_name"] for j in reversed(jobs) if j["sender_name"]), ""),
+        "tenant": last.get("tenant", ""),
+        "instance_id": last.get("instance_id", ""),
+        "idempotency_keys": [k for j in jobs for k in j["idempotency_keys"]],
+    }
+
+
+def flush_burst(phone: str, jobs: List[Dict[str, Any]]) -> bool:
+    return WEBHOOK_QUEUE.submit(phone, merge_burst(jobs))
+
+
+IDEMPOTENCY = IdempotencyStore(
+    IDEMPOTENCY_CACHE,
+    IDEMPOTENCY_TTL,
+    path=os.path.join(_ensure_data_dir(), "idempotency.sqlite3") if IDEMPOTENCY_PERSIST else "",
+)
+WEBHOOK_QUEUE = KeyedJobQueue(run_webhook_job, workers=WEBHOOK_WORKERS, maxsize=WEBHOOK_QUEUE_MAX, name="webhook")
+WEBHOOK_DEBOUNCER = KeyedDebouncer(
+    flush_burst,
+    window=WEBHOOK_DEBOUNCE,
+    max_wait=WEBHOOK_DEBOUNCE_MAX_WAIT,
+    max_items=WEBHOOK_DEBOUNCE_MAX_MESSAGES,
+)
+# Ao encerrar: entrega rajadas pendentes, drena a fila e por último fecha os logs (atexit é LIFO)
+atexit.register(close_log_sinks)
+atexit.register(close_history_store)
+atexit.register(close_funnel_analytics)
+atexit.register(WEBHOOK_QUEUE.stop, 30)
+atexit.register(WEBHOOK_DEBOUNCER.flush_all)
+
+
+@REGISTRY.collector
+def collect_runtime_metrics() -> List[tuple]:
+    # Lido só no scrape: filas, caches e breakers já mantêm seus próprios contadores
+    families: List[tuple] = []
+    queue_stats = WEBHOOK_QUEUE.stats()
+    debounce_stats = WEBHOOK_DEBOUNCER.stats()
+    with _log_sinks_lock:
+        sinks = dict(_log_sinks) if _log_sinks_pid == os.getpid() else {}
+    depths = [
+        ({"queue": "webhook"}, queue_stats["depth"]),
+        ({"queue": "webhook_in_progress"}, queue_stats["in_progress"]),
+        ({"queue": "debounce"}, debounce_stats["pending_items"]),
+    ]
+    depths += [({"queue": f"log:{name}"}, sink.depth()) for name, sink in sorted(sinks.items())]
+    if _history_store is not None:
+        depths.append(({"queue": "history_store"}, _history_store.depth()))
+    if _funnel_analytics is not None:
+        depths.append(({"queue": "funnel_analytics"}, _funnel_analytics.depth()))
+    depths += [({"queue": f"outbound:{s.name}"}, s.depth()) for s in (LLM_SCHEDULER, ZAPI_SCHEDULER)]
+    if CRM_BASE_URL and CRM_TOKEN and CRM_OUTBOX_ENABLED:
+        outbox = get_crm_outbox().stats()
+        depths += [({"queue": f"crm_outbox:{name}"}, v["pending"]) for name, v in outbox.items()]
+        families.append(("funnel_crm_outbox_dead", "gauge", "Itens do outbox que esgotaram as tentativas", [({"table": n}, v["dead"]) for n, v in outbox.items()]))
+    families.append(("funnel_queue_depth", "gauge", "Itens aguardando em cada fila", depths))
+    families.append((
+        "funnel_webhook_jobs_total", "counter", "Jobs do webhook por resultado",
+        [({"result": r}, queue_stats[r]) for r in ("processed", "failed", "rejected")],
+    ))
+
+    caches = [("reply", REPLY_CACHE.stats())]
+    if LEAD_STATE_ENABLED:
+        caches.append(("lead_state", get_lead_state().stats()))
+    if IDEMPOTENCY_ENABLED:
+        idem = IDEMPOTENCY.stats()
+        caches.append(("idempotency", idem["cache"]))
+        families.append(("funnel_webhook_duplicates_total", "counter", "Reentregas respondidas sem reprocessar", [({}, idem["duplicates"])]))
+    families.append(("funnel_cache_hits_total", "counter", "Acertos por cache", [({"cache": n}, c["hits"]) for n, c in caches]))
+    families.append(("funnel_cache_misses_total", "counter", "Faltas por cache", [({"cache": n}, c["misses"]) for n, c in caches]))
+    families.append((
+        "funnel_cache_hit_ratio", "gauge", "Taxa de acerto acumulada por cache",
+        [({"cache": n}, c["hits"] / (c["hits"] + c["misses"]) if c["hits"] + c["misses"] else 0) for n, c in caches],
+    ))
+    families.append((
+        "funnel_backend_circuit_open", "gauge", "1 se o circuit breaker do backend está aberto",
+        [({"backend": c.name}, int(c.breaker.state == "open")) for c in (ZAPI_CLIENT, CRM_CLIENT, LLM_CLIENT)],
+    ))
+    return families
 
 
 app = Flask(__name__)
 
+
+SLOW_LOG = SlowLog(SLOW_REQUEST_BUFFER)
+TRACED_PREFIXES = ("/analyze", "/zapi/webhook")
+
+
+def is_admin() -> bool:
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(request.headers.get("X-Admin-Token", ""), ADMIN_TOKEN)
+
+
+def capture_slow(reason: str, route: str, method: str, status: int, elapsed: float, trace: Any, payload: Any) -> Dict[str, Any]:
+    """Guarda uma requisição lenta (ou perfilada) no buffer de /admin/slow e em slow_requests.jsonl."""
+    entry = SLOW_LOG.add({
+        "ts": datetime.utcnow().isoformat(),
+        "reason": reason,
+        "route": route,
+        "method": method,
+        "status": status,
+        "ms": round(elapsed * 1000, 2),
+        "payload": redact(payload, SLOW_REQUEST_MAX_CHARS),
+        "timings": trace.summary() if trace is not None else {},
+    })
+    log_jsonl("slow_requests.jsonl", entry)
+    return entry
+
+
+def _request_payload() -> Any:
+    # Corpos JSON já foram lidos pela rota; streams (arquivo, NDJSON) não são guardados
+    if request.is_json:
+        return request.get_json(silent=True)
+    return {"mimetype": request.mimetype, "bytes": request.content_length}
+
+
+@app.before_request
+def _start_timer():
+    g.request_started = time.perf_counter()
+    if not request.path.startswith(TRACED_PREFIXES):
+        return
+    reason = ""
+    if request.headers.get(PROFILE_HEADER) and is_admin():
+        reason = "profiled"
+    elif PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        reason = "sampled"
+    if reason or SLOW_REQUEST_MS > 0:
+        g.trace_token = start_trace(profile=bool(reason), interval=PROFILE_INTERVAL_MS / 1000)
+        g.trace_reason = reason
+
+
+@app.after_request
+def _record_request(response):
+    started = g.pop("request_started", None)
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    if started is not None and METRICS_ENABLED:
+        HTTP_LATENCY.observe(time.perf_counter() - started, route, request.method)
+        HTTP_REQUESTS.inc(route, request.method, str(response.status_code))
+    token = g.pop("trace_token", None)
+    if token is not None and started is not None:
+        trace = finish_trace(token)
+        elapsed = time.perf_counter() - started
+        reason = g.pop("trace_reason", "")
+        if not reason and SLOW_REQUEST_MS > 0 and elapsed * 1000 >= SLOW_REQUEST_MS:
+            reason = "slow"
+        if reason:
+            entry = capture_slow(reason, route, request.method, response.status_code, elapsed, trace, _request_payload())
+            if reason != "slow":
+                response.headers["X-Trace-Id"] = str(entry["id"])
+    return response
+
+
+@app.teardown_request
+def _close_trace(_exc):
+    # Rota que levantou exceção não passa pelo after_request: fecha o trace (e o profiler) aqui
+    token = g.pop("trace_token", None)
+    if token is not None:
+        finish_trace(token)
+
+
+@app.get("/admin/slow")
+def admin_slow():
+    if not ADMIN_TOKEN:
+        return jsonify({"error": "ADMIN_TOKEN não configurado"}), 404
+    if not is_admin():
+        return jsonify({"error": "não autorizado"}), 403
+    return jsonify({"threshold_ms": SLOW_REQUEST_MS, "items": SLOW_LOG.list()})
+
+
+@app.get("/admin/slow/<int:entry_id>")
+def admin_slow_entry(entry_id: int):
+    if not ADMIN_TOKEN:
+        return jsonify({"error": "ADMIN_TOKEN não configurado"}), 404
+    if not is_admin():
+        return jsonify({"error": "não autorizado"}), 403
+    entry = SLOW_LOG.get(entry_id)
+    if entry is None:
+        return jsonify({"error": "não encontrado (o buffer guarda só as últimas capturas)"}), 404
+    return jsonify(entry)
+
+
 @app.get("/health")
 def health():
-    return jsonify({"status": "ok", "ts": datetime.utcnow().isoformat()})
+    resp: Dict[str, Any] = {"status": "ok", "ts": datetime.utcnow().isoformat()}
+    if WEBHOOK_ASYNC or WEBHOOK_DEBOUNCE > 0:
+        resp["queue"] = WEBHOOK_QUEUE.stats()
+    if WEBHOOK_DEBOUNCE > 0:
+        resp["debounce"] = WEBHOOK_DEBOUNCER.stats()
+    resp["backends"] = {c.name: c.stats() for c in (ZAPI_CLIENT, CRM_CLIENT, LLM_CLIENT)}
+    resp["outbound"] = {s.name: s.stats() for s in (LLM_SCHEDULER, ZAPI_SCHEDULER)}
+    resp["slow_requests"] = SLOW_LOG.stats()
+    if CRM_BASE_URL and CRM_TOKEN and CRM_OUTBOX_ENABLED:
+        resp["crm_outbox"] = get_crm_outbox().stats()
+    if LEAD_STATE_ENABLED:
+        resp["lead_state"] = get_lead_state().stats()
+    if IDEMPOTENCY_ENABLED:
+        resp["idempotency"] = IDEMPOTENCY.stats()
+    if RULES_DIR:
+        resp["rules"] = RULES.stats()
+    if HISTORY_STORE_ENABLED and _history_store is not None:
+        resp["history"] = _history_store.stats()
+    if ANALYTICS_ENABLED and _funnel_analytics is not None:
+        resp["analytics"] = _funnel_analytics.stats()
+    if OPENAI_API_KEY:
+        with _reply_stats_lock:
+            resp["replies"] = {**_reply_stats, "cache": REPLY_CACHE.stats()}
+    return jsonify(resp)
+
+@app.get("/metrics")
+def metrics():
+    if not METRICS_ENABLED:
+        return jsonify({"error": "métricas desabilitadas"}), 404
+    return Response(REGISTRY.expose(), mimetype="text/plain; version=0.0.4")
+
+def _page_args() -> tuple:
+    try:
+        limit = int(request.args.get("limit", "50"))
+    except ValueError:
+        raise ValueError("limit deve ser um inteiro")
+    return limit, request.args.get("cursor", "")
+
+
+@app.get("/leads/<lead_id>/history")
+def lead_history(lead_id: str):
+    if not HISTORY_STORE_ENABLED:
+        return jsonify({"error": "histórico indexado desabilitado"}), 404
+    order = request.args.get("order", "asc")
+    if order not in ("asc", "desc"):
+        return jsonify({"error": "order deve ser asc ou desc"}), 400
+    try:
+        limit, cursor = _page_args()
+        return jsonify(get_history_store().lead_history(lead_id, limit=limit, cursor=cursor, order=order))
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+
+
+@app.get("/leads")
+def list_leads():
+    if not HISTORY_STORE_ENABLED:
+        return jsonify({"error": "histórico indexado desabilitado"}), 404
+    since = request.args.get("since", "")
+    try:
+        if since:
+            datetime.fromisoformat(since)
+        limit, cursor = _page_args()
+        page = get_history_store().list_leads(
+            stage=request.args.get("stage", ""),
+            since=since,
+            phone=_digits_only(request.args.get("phone", "")),
+            limit=limit,
+            cursor=cursor,
+        )
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    return jsonify(page)
+
+@app.get("/analytics/funnel")
+def analytics_funnel():
+    if not ANALYTICS_ENABLED:
+        return jsonify({"error": "analytics desabilitado"}), 404
+    try:
+        until = date.fromisoformat(request.args.get("until") or datetime.utcnow().date().isoformat())
+        since = date.fromisoformat(request.args.get("since") or (until - timedelta(days=ANALYTICS_DEFAULT_DAYS - 1)).isoformat())
+    except ValueError:
+        return jsonify({"error": "since/until devem ser datas AAAA-MM-DD"}), 400
+    if since > until:
+        return jsonify({"error": "since depois de until"}), 400
+    return jsonify(get_funnel_analytics().report(since.isoformat(), until.isoformat()))
 
 @app.post("/analyze")
 def analyze():
@@ -395,65 +1610,63 @@ def analyze():
     except Exception as exc:
         return jsonify({"error": str(exc)}), 400
 
-    stage, stage_conf, _ = detect_stage(transcript)
-    pains = detect_pain_points(transcript)
-    objections = detect_objections(transcript)
-    urgency = detect_urgency(transcript)
-    budget = detect_budget_signal(transcript)
-    decision = detect_decision_maker(transcript)
-    intent = detect_intent(transcript)
-    icp_fit = detect_icp_fit(metadata)
-    lead_score = compute_lead_score(transcript, urgency, budget, decision)
-
-    if decision != "Sim" and stage == "Fechamento":
-        stage = "Negociacao"
-        stage_conf = min(stage_conf, 0.75)
-
-    if stage in ("Novo", "Qualificacao") and intent == "Baixo":
-        stage_conf = min(stage_conf, 0.5)
-
-    nba = build_next_best_actions(stage, intent, decision, objections, urgency)
-    tasks = build_tasks(stage, decision, complete_diagnosis=(stage != "Diagnostico"))
-
-    insights: List[str] = []
-    if urgency != "Baixa":
-        insights.append(f"Urgência: {urgency}")
-    if budget != "Inexistente":
-        insights.append(f"Sinal de orçamento: {budget}")
-    if any(r.search(transcript) for r in COMPARE_REGEX):
-        insights.append("Comparação com fornecedores/concorrentes")
+    result = analyze_transcript(lead_id, transcript, metadata, RULES.get(request.headers.get(RULES_TENANT_HEADER, "")))
+    observe_analysis(result, "analyze")
+    return jsonify(result)
+
+@app.post("/analyze/stream")
+def analyze_stream_endpoint():
+    # Arquivo (multipart, campo "file") ou corpo em texto puro, inclusive chunked
+    if request.mimetype == "multipart/form-data":
+        upload = request.files.get("file")
+        if upload is None:
+            return jsonify({"error": "campo file obrigatório"}), 400
+        stream = upload.stream
+        fields = request.form
+    else:
+        stream = request.stream
+        fields = request.args
+    lead_id = fields.get("lead_id") or request.args.get("lead_id") or request.headers.get("X-Lead-Id", "")
+    if not lead_id:
+        return jsonify({"error": "lead_id obrigatório"}), 400
+    try:
+        metadata = json.loads(fields.get("metadata") or request.args.get("metadata") or "{}")
+        if not isinstance(metadata, dict):
+            raise ValueError("metadata deve ser um objeto JSON")
+        encoding = codecs.lookup(request.mimetype_params.get("charset", "utf-8")).name
+    except (ValueError, LookupError) as exc:
+        return jsonify({"error": str(exc)}), 400
 
-    summary = summarize_pt(transcript)
+    rules = RULES.get(request.headers.get(RULES_TENANT_HEADER, ""))
+    result = analyze_stream(lead_id, iter_text_chunks(stream, encoding=encoding), metadata, rules)
+    observe_analysis(result, "stream")
+    return jsonify(result)
+
+@app.post("/analyze/batch")
+def analyze_batch_endpoint():
+    tenant = request.headers.get(RULES_TENANT_HEADER, "")
+    # NDJSON (um item por linha) é lido e respondido em streaming
+    if request.mimetype in ("application/x-ndjson", "application/jsonl"):
+        def generate() -> Iterator[str]:
+            for result in iter_analyze_batch(_iter_ndjson(request.stream), tenant):
+                observe_analysis(result, "batch")
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
 
-    tags: List[str] = []
-    if lead_score >= 70:
-        tags.append("quente")
-    if budget == "Presente":
-        tags.append("budget_presente")
-    if urgency == "Alta":
-        tags.append("urgencia_alta")
-    if decision != "Sim":
-        tags.append("nao_decisor")
+    try:
+        payload = request.get_json(force=True)
+        items = payload.get("items") if isinstance(payload, dict) else payload
+        if not isinstance(items, list):
+            return jsonify({"error": "items deve ser uma lista"}), 400
+        if len(items) > BATCH_MAX_ITEMS:
+            return jsonify({"error": f"máximo de {BATCH_MAX_ITEMS} itens por lote; use NDJSON para lotes maiores"}), 413
+    except Exception as exc:
+        return jsonify({"error": str(exc)}), 400
 
-    resp = {
-        "lead_id": lead_id,
-        "stage": stage,
-        "stage_confidence": round(float(stage_conf), 2),
-        "lead_score": int(lead_score),
-        "icp_fit": icp_fit,
-        "buying_intent": intent,
-        "pain_points": pains,
-        "objections": objections,
-        "urgency": urgency,
-        "budget_signal": budget,
-        "decision_maker": decision,
-        "next_best_actions": nba,
-        "insights": insights,
-        "summary_pt": summary,
-        "tasks_to_create": tasks,
-        "tags": tags,
-    }
-    return jsonify(resp)
+    results = analyze_batch(items, tenant)
+    for result in results:
+        observe_analysis(result, "batch")
+    return jsonify({"results": results})
 
 @app.post("/zapi/webhook")
 def zapi_webhook():
@@ -468,56 +1681,40 @@ def zapi_webhook():
         return jsonify({"status": "ignored", "reason": "sem texto ou telefone"}), 200
 
     lead_id = f"LEAD-{phone}"
+    # Regras do tenant: cabeçalho explícito ou a instância Z-API que enviou o evento
+    tenant = request.headers.get(RULES_TENANT_HEADER, "") or RULES.for_instance(extracted["instance_id"]).tenant
 
-    # Analisar o conteúdo
-    analysis_request = {"lead_id": lead_id, "transcript": text, "metadata": {"origem": "whatsapp"}}
-    with app.test_request_context(json=analysis_request):
-        analysis_resp = analyze()
-    # Flask view returns (Response, code) or Response
-    if isinstance(analysis_resp, tuple):
-        flask_resp, status_code = analysis_resp
-        if status_code != 200:
-            return jsonify({"error": "falha na análise"}), 500
-        analysis_json = flask_resp.get_json()  # type: ignore
-    else:
-        analysis_json = analysis_resp.get_json()  # type: ignore
-
-    # Gerar resposta ao cliente
-    reply_text = generate_reply(text, analysis_json, sender_name)
-
-    # Atualizar CRM (ou log local)
-    crm_sync = update_crm(
-        lead_id=lead_id,
-        stage=analysis_json.get("stage"),
-        insights=analysis_json.get("insights", []),
-        tags=analysis_json.get("tags", []),
-        tasks=analysis_json.get("tasks_to_create", []),
-    )
+    # Reentrega da Z-API: responde com o resultado já registrado, sem reprocessar
+    idempotency_key = webhook_idempotency_key(extracted) if IDEMPOTENCY_ENABLED else ""
+    if idempotency_key:
+        prior = IDEMPOTENCY.begin(idempotency_key)
+        if prior is not None:
+            return jsonify({**prior, "duplicate": True}), 200
 
-    # Enviar via WhatsApp (Z-API)
-    wa_send = send_whatsapp_message(phone=phone, message=reply_text)
-
-    # Log de histórico
-    log_jsonl("history.jsonl", {
+    job = {
         "lead_id": lead_id,
         "phone": phone,
-        "name": sender_name,
         "text": text,
-        "reply": reply_text,
-        "analysis": analysis_json,
-        "crm_sync": crm_sync,
-        "wa_send": wa_send,
-        "ts": datetime.utcnow().isoformat(),
-    })
+        "sender_name": sender_name,
+        "tenant": tenant,
+        "instance_id": extracted["instance_id"],
+        "idempotency_keys": [idempotency_key] if idempotency_key else [],
+    }
 
-    return jsonify({
-        "ok": True,
-        "lead_id": lead_id,
-        "stage": analysis_json.get("stage"),
-        "reply": reply_text,
-        "wa": wa_send,
-        "crm": crm_sync,
-    })
+    # Rajadas do mesmo telefone são agrupadas e respondidas uma vez só, em background
+    if WEBHOOK_DEBOUNCE > 0:
+        buffered = WEBHOOK_DEBOUNCER.add(phone, job)
+        return jsonify({"ok": True, "status": "buffered", "lead_id": lead_id, "buffered": buffered}), 202
+
+    # Modo assíncrono: confirma já e deixa LLM/CRM/WhatsApp para os workers
+    if WEBHOOK_ASYNC:
+        if not WEBHOOK_QUEUE.submit(phone, job):
+            if idempotency_key:
+                IDEMPOTENCY.abort(idempotency_key)
+            return jsonify({"status": "busy", "reason": "fila cheia"}), 503, {"Retry-After": "5"}
+        return jsonify({"ok": True, "status": "queued", "lead_id": lead_id, "queue_depth": WEBHOOK_QUEUE.depth()}), 202
+
+    return jsonify(run_webhook_job(job))
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=int(os.getenv("PORT", 8000)))
\ No newline at end of file
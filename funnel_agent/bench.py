@@ -0,0 +1,264 @@
+# Benchmarks dos detectores, do /analyze e do /zapi/webhook.
+#
+#   python3 bench.py --out var/bench/atual.json
+#   python3 bench.py --save-baseline var/bench/baseline.json
+#   python3 bench.py --baseline var/bench/baseline.json --tolerance 0.2   # sai com 1 se houver regressão
+#
+# Z-API, CRM e LLM são substituídos por servidores HTTP locais com atraso configurável.
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from transcripts import TranscriptGenerator
+
+
+# --------- Medição ---------
+
+
+def percentiles(samples: List[float], unit: float) -> Dict[str, float]:
+    ordered = sorted(samples)
+
+    def pct(q: float) -> float:
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * unit
+
+    return {
+        "mean": round(statistics.fmean(ordered) * unit, 3),
+        "p50": round(pct(0.50), 3),
+        "p95": round(pct(0.95), 3),
+        "p99": round(pct(0.99), 3),
+    }
+
+
+def time_calls(fn: Callable[[Any], Any], inputs: List[Any], repeat: int = 1) -> List[float]:
+    samples: List[float] = []
+    for _ in range(repeat):
+        for x in inputs:
+            t0 = time.perf_counter()
+            fn(x)
+            samples.append(time.perf_counter() - t0)
+    return samples
+
+
+def bench_detectors(app_module, corpora: Dict[str, List[str]], repeat: int) -> Dict[str, Any]:
+    detectors: Dict[str, Callable[[str], Any]] = {
+        "scan_signals": app_module.scan_signals,
+        "detect_stage": app_module.detect_stage,
+        "detect_pain_points": app_module.detect_pain_points,
+        "detect_objections": app_module.detect_objections,
+        "detect_urgency": app_module.detect_urgency,
+        "detect_budget_signal": app_module.detect_budget_signal,
+        "detect_decision_maker": app_module.detect_decision_maker,
+        "detect_intent": app_module.detect_intent,
+        "summarize_pt": app_module.summarize_pt,
+        "extract_features": app_module.extract_features,
+    }
+    out: Dict[str, Any] = {}
+    for kind, texts in corpora.items():
+        for name, fn in detectors.items():
+            out[f"detectors.{kind}.{name}"] = {"unit": "us", **percentiles(time_calls(fn, texts, repeat), 1e6)}
+    return out
+
+
+def bench_analyze(app_module, corpora: Dict[str, List[str]], repeat: int) -> Dict[str, Any]:
+    client = app_module.app.test_client()
+    out: Dict[str, Any] = {}
+    for kind, texts in corpora.items():
+        bodies = [{"lead_id": f"LEAD-{i}", "transcript": t, "metadata": {"segmento": "SaaS"}} for i, t in enumerate(texts)]
+
+        def call(body):
+            resp = client.post("/analyze", json=body)
+            assert resp.status_code == 200, resp.status_code
+
+        t0 = time.perf_counter()
+        samples = time_calls(call, bodies, repeat)
+        elapsed = time.perf_counter() - t0
+        out[f"analyze.{kind}"] = {"unit": "ms", **percentiles(samples, 1e3), "rps": round(len(samples) / elapsed, 1)}
+    return out
+
+
+class StubBackend:
+    """Servidor HTTP local que responde como Z-API, CRM ou LLM, com atraso fixo."""
+
+    def __init__(self, delay: float, body: Dict[str, Any]):
+        payload = json.dumps(body).encode("utf-8")
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _respond(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0) or 0))
+                if delay:
+                    time.sleep(delay)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_POST = do_PATCH = do_GET = _respond
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self) -> None:
+        self.server.shutdown()
+
+
+def bench_webhook(app_module, gen: TranscriptGenerator, n: int, modes: List[str]) -> Dict[str, Any]:
+    client = app_module.app.test_client()
+    out: Dict[str, Any] = {}
+    for mode in modes:
+        app_module.WEBHOOK_ASYNC = mode == "async"
+        messages = gen.corpus("short", n)
+        counter = iter(range(10 ** 9))
+
+        def call(text):
+            i = next(counter)
+            resp = client.post("/zapi/webhook", json={"phone": f"55119{i % 50:08d}", "message": text, "messageId": f"bench-{mode}-{i}"})
+            assert resp.status_code in (200, 202), resp.status_code
+
+        t0 = time.perf_counter()
+        samples = time_calls(call, messages)
+        accepted = time.perf_counter() - t0
+        if app_module.WEBHOOK_ASYNC:
+            app_module.WEBHOOK_QUEUE.join()
+        drained = time.perf_counter() - t0
+        out[f"webhook.{mode}"] = {
+            "unit": "ms",
+            **percentiles(samples, 1e3),
+            "rps": round(len(samples) / drained, 1),
+            "accept_rps": round(len(samples) / accepted, 1),
+        }
+    app_module.WEBHOOK_ASYNC = False
+    return out
+
+
+# --------- Baseline ---------
+
+# p95/p99 são reportados, mas oscilam demais em amostras pequenas para servir de gate
+HIGHER_IS_BETTER = {"rps", "accept_rps"}
+LOWER_IS_BETTER = {"mean", "p50"}
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[Dict[str, Any]]:
+    """Lista métricas que pioraram mais que `tolerance` (fração) em relação ao baseline."""
+    regressions: List[Dict[str, Any]] = []
+    for key, metrics in current["results"].items():
+        base = baseline.get("results", {}).get(key)
+        if not base:
+            continue
+        for name, value in metrics.items():
+            ref = base.get(name)
+            if not isinstance(value, (int, float)) or not isinstance(ref, (int, float)) or ref <= 0:
+                continue
+            if name in LOWER_IS_BETTER and value > ref * (1 + tolerance):
+                regressions.append({"metric": f"{key}.{name}", "baseline": ref, "current": value, "ratio": round(value / ref, 3)})
+            elif name in HIGHER_IS_BETTER and value < ref * (1 - tolerance):
+                regressions.append({"metric": f"{key}.{name}", "baseline": ref, "current": value, "ratio": round(value / ref, 3)})
+    return regressions
+
+
+def load_app(delays: Dict[str, float], crm_sync: bool) -> Tuple[Any, List[StubBackend], str]:
+    # Configura o ambiente antes de importar o app: stubs no lugar dos backends e dados em diretório temporário
+    stubs = {
+        "zapi": StubBackend(delays["zapi"], {"zaapId": "bench", "messageId": "bench"}),
+        "crm": StubBackend(delays["crm"], {"ok": True}),
+        "llm": StubBackend(delays["llm"], {"choices": [{"message": {"content": "Claro! Te envio a proposta ainda hoje."}}]}),
+    }
+    workdir = tempfile.mkdtemp(prefix="funnel-bench-")
+    os.chdir(workdir)
+    os.environ.update({
+        "Z_API_BASE_URL": stubs["zapi"].url,
+        "Z_API_INSTANCE_ID": "bench",
+        "Z_API_TOKEN": "bench",
+        "CRM_API_BASE_URL": stubs["crm"].url,
+        "CRM_API_TOKEN": "bench",
+        "CRM_OUTBOX": "0" if crm_sync else "1",
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": stubs["llm"].url,
+        "REPLY_CACHE_SIZE": "0",
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as app_module
+    return app_module, list(stubs.values()), workdir
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks do funnel_agent")
+    parser.add_argument("--only", default="detectors,analyze,webhook", help="suites separadas por vírgula")
+    parser.add_argument("--quick", action="store_true", help="corpus menor, para rodar em CI")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--delay-zapi", type=float, default=0.02, help="atraso do stub da Z-API (s)")
+    parser.add_argument("--delay-crm", type=float, default=0.05, help="atraso do stub do CRM (s)")
+    parser.add_argument("--delay-llm", type=float, default=0.2, help="atraso do stub do LLM (s)")
+    parser.add_argument("--crm-sync", action="store_true", help="CRM síncrono (sem outbox) no webhook")
+    parser.add_argument("--out", help="grava o resultado (JSON) neste arquivo")
+    parser.add_argument("--baseline", help="compara com este resultado salvo")
+    parser.add_argument("--save-baseline", help="grava o resultado como novo baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="piora aceitável antes de acusar regressão (fração)")
+    args = parser.parse_args(argv)
+
+    here = os.getcwd()
+    suites = set(args.only.split(","))
+    delays = {"zapi": args.delay_zapi, "crm": args.delay_crm, "llm": args.delay_llm}
+    app_module, stubs, workdir = load_app(delays, args.crm_sync)
+    gen = TranscriptGenerator(app_module, args.seed)
+    sizes = {"short": 200, "medium": 40, "long": 3} if args.quick else {"short": 2000, "medium": 300, "long": 20}
+    corpora = {kind: gen.corpus(kind, n) for kind, n in sizes.items()}
+    repeat = 1 if args.quick else 3
+
+    results: Dict[str, Any] = {}
+    try:
+        if "detectors" in suites:
+            results.update(bench_detectors(app_module, corpora, repeat))
+        if "analyze" in suites:
+            results.update(bench_analyze(app_module, corpora, repeat))
+        if "webhook" in suites:
+            results.update(bench_webhook(app_module, gen, 50 if args.quick else 300, ["sync", "async"]))
+    finally:
+        for stub in stubs:
+            stub.close()
+        os.chdir(here)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "corpus": {k: {"n": len(v), "avg_chars": int(statistics.fmean(len(t) for t in v))} for k, v in corpora.items()},
+            "delays": delays,
+            "quick": args.quick,
+        },
+        "results": results,
+    }
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            report["regressions"] = compare(report, json.load(f), args.tolerance)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    for path in filter(None, [args.out, args.save_baseline]):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+    return 1 if report.get("regressions") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,282 @@
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from http_clients import BackendClient
+
+# Erros 4xx que não são do pedido em si: repetir pode dar certo
+TRANSIENT_CLIENT_STATUS = {408, 429}
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS lead_updates (
+    lead_id TEXT PRIMARY KEY,
+    payload TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 1,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    leased_until REAL NOT NULL DEFAULT 0,
+    last_error TEXT,
+    dead INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS task_creates (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    lead_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    leased_until REAL NOT NULL DEFAULT 0,
+    last_error TEXT,
+    dead INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_lead_updates_due ON lead_updates (dead, next_attempt_at);
+CREATE INDEX IF NOT EXISTS idx_task_creates_due ON task_creates (dead, next_attempt_at);
+"""
+
+
+class CrmOutbox:
+    """Outbox durável (SQLite) para mutações no CRM.
+
+    - Atualizações de estágio/insights/tags do mesmo lead são coalescidas: só o
+      estado mais recente é enviado (controle por `version`).
+    - Criações de tarefa são enviadas em paralelo ou, se `bulk_path` estiver
+      configurado, em uma única chamada por rodada.
+    - Falhas voltam para a fila com backoff; após `max_attempts` a linha fica
+      marcada como `dead`, mas nunca é apagada sem sucesso. Um 4xx (exceto 408
+      e 429) não vai melhorar na próxima tentativa e marca `dead` na hora.
+    - Linhas são "reservadas" (`leased_until`) por `lease` segundos antes do envio,
+      então mais de um processo pode despachar a mesma base sem enviar em
+      duplicidade, e uma versão nova de um lead só sai depois da anterior. A
+      reserva é renovada logo antes de cada envio e cobre o pior caso de uma
+      chamada com retries; se outro processo já a tomou, a linha é pulada.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        client: BackendClient,
+        base_url: str,
+        token: str,
+        bulk_path: str = "",
+        concurrency: int = 8,
+        batch_size: int = 100,
+        interval: float = 2.0,
+        max_attempts: int = 20,
+        backoff_max: float = 900.0,
+        lease: float = 120.0,
+    ):
+        self.path = path
+        self.client = client
+        self.base_url = base_url
+        self.token = token
+        self.bulk_path = bulk_path
+        self.concurrency = max(1, concurrency)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.backoff_max = backoff_max
+        # Uma chamada (timeouts + esperas entre retries) precisa caber na reserva
+        worst_send = client.timeout * (client.retries + 1) + client.backoff_max * client.retries
+        self.lease = max(lease, 2 * worst_send)
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pool: Optional[ThreadPoolExecutor] = None
+
+    # ---- armazenamento ----
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            db = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(SCHEMA)
+            self._db = db
+        return self._db
+
+    def enqueue(self, lead_id: str, lead_payload: Dict[str, Any], tasks: List[Dict[str, Any]]) -> Dict[str, Any]:
+        now = time.time()
+        with self._db_lock:
+            db = self._conn()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute(
+                    "INSERT INTO lead_updates (lead_id, payload, next_attempt_at, updated_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(lead_id) DO UPDATE SET payload=excluded.payload, version=version+1, attempts=0, "
+                    "next_attempt_at=excluded.next_attempt_at, dead=0, last_error=NULL, updated_at=excluded.updated_at",
+                    (lead_id, json.dumps(lead_payload, ensure_ascii=False), now, now),
+                )
+                db.executemany(
+                    "INSERT INTO task_creates (lead_id, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?)",
+                    [(lead_id, json.dumps({"lead_id": lead_id, **t}, ensure_ascii=False), now, now) for t in tasks],
+                )
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        self.start()
+        self._wake.set()
+        return {"queued": True, "lead_update": True, "tasks": len(tasks)}
+
+    def _claim(self, table: str, columns: str) -> Tuple[List[Tuple], float]:
+        """Reserva as linhas vencidas; devolve as linhas e o `leased_until` gravado nelas."""
+        now = time.time()
+        with self._db_lock:
+            db = self._conn()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = db.execute(
+                    f"SELECT {columns} FROM {table} WHERE dead=0 AND next_attempt_at<=? AND leased_until<=? "
+                    "ORDER BY next_attempt_at LIMIT ?",
+                    (now, now, self.batch_size),
+                ).fetchall()
+                key = "lead_id" if table == "lead_updates" else "id"
+                db.executemany(f"UPDATE {table} SET leased_until=? WHERE {key}=?", [(now + self.lease, r[0]) for r in rows])
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        return rows, now + self.lease
+
+    def _retry_delay(self, attempts: int) -> float:
+        return random.uniform(0.5, 1.0) * min(self.backoff_max, 5.0 * (2 ** attempts))
+
+    def _renew(self, table: str, ids: List[Any], held: float) -> List[Any]:
+        """Estende a reserva das linhas que ainda são desta rodada (`leased_until == held`)."""
+        key = "lead_id" if table == "lead_updates" else "id"
+        until = time.time() + self.lease
+        renewed = []
+        with self._db_lock:
+            db = self._conn()
+            for rid in ids:
+                cur = db.execute(f"UPDATE {table} SET leased_until=? WHERE {key}=? AND leased_until=?", (until, rid, held))
+                if cur.rowcount:
+                    renewed.append(rid)
+        return renewed
+
+    def _mark_failed(self, table: str, where: str, params: Tuple, attempts: int, error: str, permanent: bool = False) -> None:
+        dead = 1 if permanent or attempts + 1 >= self.max_attempts else 0
+        with self._db_lock:
+            self._conn().execute(
+                f"UPDATE {table} SET attempts=attempts+1, next_attempt_at=?, leased_until=0, last_error=?, dead=? WHERE {where}",
+                (time.time() + self._retry_delay(attempts), error[:500], dead, *params),
+            )
+
+    # ---- envio ----
+
+    def _headers(self) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {self.token}", "Content-Type": "application/json"}
+
+    def _send(self, method: str, url: str, payload: Any) -> Tuple[Optional[str], bool]:
+        """Envia; devolve (erro, permanente). Sem erro, (None, False)."""
+        try:
+            resp = self.client.request(method, url, headers=self._headers(), json=payload)
+        except Exception as exc:
+            return str(exc), False
+        if resp.status_code >= 400:
+            return f"HTTP {resp.status_code}", resp.status_code < 500 and resp.status_code not in TRANSIENT_CLIENT_STATUS
+        return None, False
+
+    def _dispatch_lead(self, row: Tuple, held: float) -> bool:
+        lead_id, payload, version, attempts = row
+        if not self._renew("lead_updates", [lead_id], held):
+            return False
+        error, permanent = self._send("PATCH", f"{self.base_url}/leads/{lead_id}", json.loads(payload))
+        if error is None:
+            # Só remove se nenhuma versão mais nova chegou durante o envio
+            with self._db_lock:
+                cur = self._conn().execute("DELETE FROM lead_updates WHERE lead_id=? AND version=?", (lead_id, version))
+                if cur.rowcount == 0:
+                    self._conn().execute("UPDATE lead_updates SET leased_until=0 WHERE lead_id=?", (lead_id,))
+            return True
+        self._mark_failed("lead_updates", "lead_id=? AND version=?", (lead_id, version), attempts, error, permanent)
+        with self._db_lock:
+            self._conn().execute("UPDATE lead_updates SET leased_until=0 WHERE lead_id=?", (lead_id,))
+        return False
+
+    def _dispatch_task(self, row: Tuple, held: float) -> bool:
+        task_id, payload, attempts = row
+        if not self._renew("task_creates", [task_id], held):
+            return False
+        error, permanent = self._send("POST", f"{self.base_url}/tasks", json.loads(payload))
+        if error is None:
+            with self._db_lock:
+                self._conn().execute("DELETE FROM task_creates WHERE id=?", (task_id,))
+            return True
+        self._mark_failed("task_creates", "id=?", (task_id,), attempts, error, permanent)
+        return False
+
+    def _dispatch_tasks_bulk(self, rows: List[Tuple], held: float) -> int:
+        renewed = set(self._renew("task_creates", [r[0] for r in rows], held))
+        rows = [r for r in rows if r[0] in renewed]
+        if not rows:
+            return 0
+        error, permanent = self._send("POST", f"{self.base_url}{self.bulk_path}", {"tasks": [json.loads(r[1]) for r in rows]})
+        if error is None:
+            with self._db_lock:
+                self._conn().executemany("DELETE FROM task_creates WHERE id=?", [(r[0],) for r in rows])
+            return len(rows)
+        for task_id, _, attempts in rows:
+            self._mark_failed("task_creates", "id=?", (task_id,), attempts, error, permanent)
+        return 0
+
+    def dispatch_once(self) -> Dict[str, int]:
+        """Envia tudo que está vencido; devolve quantos itens foram enviados com sucesso."""
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="crm-outbox")
+        leads, lead_lease = self._claim("lead_updates", "lead_id, payload, version, attempts")
+        tasks, task_lease = self._claim("task_creates", "id, payload, attempts")
+        lead_ok = sum(self._pool.map(lambda row: self._dispatch_lead(row, lead_lease), leads))
+        if tasks and self.bulk_path:
+            task_ok = self._dispatch_tasks_bulk(tasks, task_lease)
+        else:
+            task_ok = sum(self._pool.map(lambda row: self._dispatch_task(row, task_lease), tasks))
+        return {"leads": lead_ok, "tasks": task_ok, "claimed": len(leads) + len(tasks)}
+
+    # ---- dispatcher em background ----
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        with self._db_lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="crm-outbox", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                result = self.dispatch_once()
+            except Exception:
+                logger.exception("crm-outbox: falha ao despachar")
+                result = {"claimed": 0}
+            # Rodada cheia: continua sem esperar; caso contrário aguarda intervalo ou novo item
+            if result["claimed"] < self.batch_size:
+                self._wake.wait(self.interval)
+                self._wake.clear()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._db_lock:
+            db = self._conn()
+            out: Dict[str, Any] = {}
+            for table, name in (("lead_updates", "lead_updates"), ("task_creates", "tasks")):
+                pending, dead = db.execute(f"SELECT COALESCE(SUM(dead=0), 0), COALESCE(SUM(dead=1), 0) FROM {table}").fetchone()
+                out[name] = {"pending": pending, "dead": dead}
+        return out
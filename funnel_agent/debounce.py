@@ -0,0 +1,106 @@
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedDebouncer:
+    """Agrupa itens que chegam em rajada para a mesma chave.
+
+    Cada novo item adia a entrega em `window` segundos; a rajada é entregue de
+    uma vez quando ninguém manda nada por `window`, quando passa `max_wait`
+    desde o primeiro item ou ao atingir `max_items`. `on_flush(key, items)`
+    devolve False se não conseguiu aceitar a rajada (ex.: fila cheia); nesse caso
+    ela é reagendada em `retry_after` segundos.
+    """
+
+    def __init__(
+        self,
+        on_flush: Callable[[str, List[Any]], bool],
+        window: float = 3.0,
+        max_wait: float = 10.0,
+        max_items: int = 20,
+        retry_after: float = 1.0,
+    ):
+        self.on_flush = on_flush
+        self.window = window
+        self.max_wait = max_wait
+        self.max_items = max_items
+        self.retry_after = retry_after
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self.bursts = 0
+        self.items = 0
+
+    def start(self) -> None:
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="debounce", daemon=True)
+                self._thread.start()
+
+    def add(self, key: str, item: Any) -> int:
+        """Adiciona `item` à rajada de `key`; devolve quantos itens ela tem."""
+        self.start()
+        now = time.monotonic()
+        with self._cond:
+            burst = self._pending.get(key)
+            if burst is None:
+                burst = {"items": [], "first": now}
+                self._pending[key] = burst
+            burst["items"].append(item)
+            self.items += 1
+            if len(burst["items"]) >= self.max_items:
+                burst["deadline"] = now
+            else:
+                burst["deadline"] = min(now + self.window, burst["first"] + self.max_wait)
+            self._cond.notify()
+            return len(burst["items"])
+
+    def _take_due(self, now: float, force: bool = False) -> List[tuple]:
+        due = [(k, b) for k, b in self._pending.items() if force or b["deadline"] <= now]
+        for k, _ in due:
+            del self._pending[k]
+        return due
+
+    def _deliver(self, due: List[tuple]) -> None:
+        for key, burst in due:
+            try:
+                ok = self.on_flush(key, burst["items"])
+            except Exception:
+                logger.exception("debounce: falha ao entregar rajada de %s", key)
+                ok = False
+            if ok:
+                self.bursts += 1
+                continue
+            with self._cond:
+                # Reagenda juntando com o que chegou nesse meio tempo
+                current = self._pending.setdefault(key, {"items": [], "first": burst["first"]})
+                current["items"] = burst["items"] + current["items"]
+                current["deadline"] = time.monotonic() + self.retry_after
+                self._cond.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    due = self._take_due(now)
+                    if due:
+                        break
+                    next_deadline = min((b["deadline"] for b in self._pending.values()), default=None)
+                    self._cond.wait(None if next_deadline is None else max(0.0, next_deadline - now))
+            self._deliver(due)
+
+    def flush_all(self) -> None:
+        """Entrega imediatamente todas as rajadas pendentes (ex.: ao encerrar)."""
+        with self._cond:
+            due = self._take_due(time.monotonic(), force=True)
+        self._deliver(due)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            pending = sum(len(b["items"]) for b in self._pending.values())
+            return {"pending_keys": len(self._pending), "pending_items": pending, "bursts": self.bursts, "items": self.items}
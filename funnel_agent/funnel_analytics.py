@@ -0,0 +1,374 @@
+import argparse
+import heapq
+import json
+import logging
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+from history_store import ReaderPool, history_segments, iter_jsonl
+from rules import STAGES
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rollups (
+    day TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    key TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    total REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, metric, key)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS lead_funnel (
+    lead_id TEXT PRIMARY KEY,
+    stage TEXT NOT NULL,
+    max_rank INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    day_stages TEXT NOT NULL
+);
+"""
+
+UPSERT_ROLLUP = """
+INSERT INTO rollups (day, metric, key, count, total) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT(day, metric, key) DO UPDATE SET count = count + excluded.count, total = total + excluded.total
+"""
+UPSERT_LEAD = "INSERT OR REPLACE INTO lead_funnel (lead_id, stage, max_rank, day, day_stages) VALUES (?, ?, ?, ?, ?)"
+
+
+class FunnelEvent(NamedTuple):
+    lead_id: str
+    day: str
+    stage: str
+    lead_score: int
+    icp_fit: str
+    objections: Tuple[str, ...]
+
+
+def event_from_analysis(analysis: Dict[str, Any], ts: str, lead_id: str = "") -> Optional[FunnelEvent]:
+    lead_id = lead_id or analysis.get("lead_id") or ""
+    stage = analysis.get("stage")
+    if not lead_id or not stage or not ts:
+        return None
+    score = analysis.get("lead_score")
+    return FunnelEvent(
+        str(lead_id),
+        str(ts)[:10],
+        str(stage),
+        int(score) if isinstance(score, (int, float)) else 0,
+        str(analysis.get("icp_fit") or ""),
+        tuple(analysis.get("objections") or ()),
+    )
+
+
+def event_from_record(record: Dict[str, Any]) -> Optional[FunnelEvent]:
+    # Registros de history.jsonl e analysis.jsonl: {"lead_id", "analysis", "ts", ...}
+    analysis = record.get("analysis")
+    if not isinstance(analysis, dict):
+        return None
+    return event_from_analysis(analysis, record.get("ts") or "", record.get("lead_id") or "")
+
+
+class FunnelAnalytics:
+    """Rollups do funil por dia em SQLite (WAL), atualizados a cada análise.
+
+    `observe` só enfileira; uma thread aplica os eventos em lote, numa
+    transação por lote, somando deltas na tabela `rollups` (dia, métrica,
+    chave). O estágio atual de cada lead fica em `lead_funnel`, que é o que
+    permite contar transições e o avanço no funil sem reler o histórico. Um
+    relatório lê só as linhas dos dias pedidos: algumas dezenas por dia,
+    independente do volume de mensagens.
+
+    Métricas: `stage` (leads distintos por estágio no dia), `reached` (leads
+    que chegaram pela primeira vez até o estágio), `transition` ("A>B"),
+    `objection`, `icp` (contagem e soma do score) e `analyses`.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        stages: Sequence[str] = STAGES,
+        batch_size: int = 500,
+        flush_interval: float = 1.0,
+        max_queue: int = 10000,
+        readers: int = 4,
+    ):
+        self.path = path
+        self.stages = tuple(stages)
+        self._rank = {s: i for i, s in enumerate(self.stages)}
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self.applied = 0
+        # Schema só na construção; as conexões seguintes não repetem o DDL
+        db = self._connect()
+        db.executescript(SCHEMA)
+        db.close()
+        self._readers = ReaderPool(self._connect, readers)
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    # ---- escrita ----
+
+    def observe(self, event: Optional[FunnelEvent]) -> None:
+        if event is None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="funnel-analytics", daemon=True)
+                self._thread.start()
+        self._queue.put(event)
+
+    def apply_many(self, events: Iterable[FunnelEvent], db: Optional[sqlite3.Connection] = None) -> int:
+        """Aplica `events` numa transação; devolve quantos foram aplicados."""
+        own = db is None
+        db = db or self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                applied = self._apply(db, events)
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        finally:
+            if own:
+                db.close()
+        return applied
+
+    def _apply(self, db: sqlite3.Connection, events: Iterable[FunnelEvent]) -> int:
+        # Deltas e estado dos leads ficam em memória só durante o lote
+        deltas: Dict[Tuple[str, str, str], List[float]] = {}
+        leads: Dict[str, Optional[list]] = {}
+
+        def add(day: str, metric: str, key: str, total: float = 0.0) -> None:
+            row = deltas.get((day, metric, key))
+            if row is None:
+                deltas[(day, metric, key)] = [1, total]
+            else:
+                row[0] += 1
+                row[1] += total
+
+        applied = 0
+        for ev in events:
+            rank = self._rank.get(ev.stage)
+            if rank is None:
+                continue
+            if ev.lead_id not in leads:
+                row = db.execute(
+                    "SELECT stage, max_rank, day, day_stages FROM lead_funnel WHERE lead_id = ?", (ev.lead_id,)
+                ).fetchone()
+                leads[ev.lead_id] = [row[0], row[1], row[2], set(row[3].split(",")) - {""}] if row else None
+            state = leads[ev.lead_id]
+            if state is None:
+                state = [ev.stage, -1, ev.day, set()]
+                leads[ev.lead_id] = state
+            elif state[0] != ev.stage:
+                add(ev.day, "transition", f"{state[0]}>{ev.stage}")
+            if state[2] != ev.day:
+                state[2] = ev.day
+                state[3] = set()
+            if ev.stage not in state[3]:
+                state[3].add(ev.stage)
+                add(ev.day, "stage", ev.stage)
+            # Chegar a um estágio conta como ter passado pelos anteriores
+            for r in range(state[1] + 1, rank + 1):
+                add(ev.day, "reached", self.stages[r])
+            state[0] = ev.stage
+            state[1] = max(state[1], rank)
+
+            add(ev.day, "analyses", "")
+            for label in ev.objections:
+                add(ev.day, "objection", label)
+            if ev.icp_fit:
+                add(ev.day, "icp", ev.icp_fit, ev.lead_score)
+            applied += 1
+
+        db.executemany(UPSERT_ROLLUP, [(d, m, k, c, t) for (d, m, k), (c, t) in deltas.items()])
+        db.executemany(
+            UPSERT_LEAD,
+            [(lead_id, s[0], s[1], s[2], ",".join(sorted(s[3]))) for lead_id, s in leads.items() if s is not None],
+        )
+        return applied
+
+    def flush(self, timeout: Optional[float] = None) -> None:
+        """Bloqueia até tudo que foi enfileirado antes da chamada estar aplicado."""
+        if self._thread is None:
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def close(self, timeout: Optional[float] = 10.0) -> None:
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+        self._readers.close()
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def _run(self) -> None:
+        db = self._connect()
+        while True:
+            batch: List[FunnelEvent] = []
+            waiters: List[threading.Event] = []
+            stop = False
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                    break
+                batch.append(item)
+            retry_delay = 0.5
+            while batch:
+                try:
+                    self.applied += self.apply_many(batch, db)
+                    batch = []
+                except sqlite3.OperationalError:
+                    # Banco ocupado (um rebuild segura a escrita até o commit): o lote espera
+                    # e é reaplicado, em vez de se perder depois do busy timeout
+                    logger.warning("funnel: banco ocupado, %d eventos aguardando", len(batch))
+                    time.sleep(retry_delay)
+                    retry_delay = min(retry_delay * 2, 10.0)
+                except Exception:
+                    logger.exception("funnel: falha ao aplicar %d eventos", len(batch))
+                    break
+            for w in waiters:
+                w.set()
+            if stop:
+                db.close()
+                return
+
+    def rebuild(self, events: Iterable[FunnelEvent], batch_size: int = 5000) -> int:
+        """Recalcula tudo a partir de `events` numa única transação.
+
+        Leitores continuam vendo os rollups antigos até o commit. O estado dos
+        leads vai para o banco a cada `batch_size` eventos, então a memória não
+        cresce com o histórico.
+        """
+        db = self._connect()
+        applied = 0
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute("DELETE FROM rollups")
+                db.execute("DELETE FROM lead_funnel")
+                batch: List[FunnelEvent] = []
+                for ev in events:
+                    batch.append(ev)
+                    if len(batch) >= batch_size:
+                        applied += self._apply(db, batch)
+                        batch = []
+                applied += self._apply(db, batch)
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        finally:
+            db.close()
+        return applied
+
+    # ---- leitura ----
+
+    def report(self, since: str, until: str) -> Dict[str, Any]:
+        """Funil entre os dias `since` e `until` (AAAA-MM-DD, inclusive)."""
+        with self._readers.connection() as db:
+            rows = db.execute(
+                "SELECT day, metric, key, count, total FROM rollups WHERE day >= ? AND day <= ? ORDER BY day",
+                (since, until),
+            ).fetchall()
+        days: Dict[str, Dict[str, Any]] = {}
+        totals: Dict[str, Dict[str, List[float]]] = {}
+        for day, metric, key, count, total in rows:
+            entry = days.setdefault(day, {"day": day, "analyses": 0, "stages": {}})
+            if metric == "analyses":
+                entry["analyses"] += count
+            elif metric == "stage":
+                entry["stages"][key] = count
+            acc = totals.setdefault(metric, {}).setdefault(key, [0, 0.0])
+            acc[0] += count
+            acc[1] += total
+
+        def counts(metric: str) -> Dict[str, int]:
+            return {k: int(v[0]) for k, v in totals.get(metric, {}).items()}
+
+        analyses = counts("analyses").get("", 0)
+        reached = counts("reached")
+        funnel = []
+        for i, stage in enumerate(self.stages):
+            entry = {"stage": stage, "leads": reached.get(stage, 0)}
+            if i + 1 < len(self.stages):
+                nxt = reached.get(self.stages[i + 1], 0)
+                entry["conversion"] = round(nxt / entry["leads"], 4) if entry["leads"] else None
+            funnel.append(entry)
+        transitions = sorted(counts("transition").items(), key=lambda kv: (-kv[1], kv[0]))
+        objections = sorted(counts("objection").items(), key=lambda kv: (-kv[1], kv[0]))
+        return {
+            "since": since,
+            "until": until,
+            "analyses": analyses,
+            "days": list(days.values()),
+            "funnel": funnel,
+            "transitions": [{"from": k.split(">", 1)[0], "to": k.split(">", 1)[1], "count": n} for k, n in transitions],
+            "objections": [{"objection": k, "count": n, "rate": round(n / analyses, 4) if analyses else None} for k, n in objections],
+            "score_by_icp": {
+                k: {"count": int(c), "avg_score": round(t / c, 2) if c else None}
+                for k, (c, t) in sorted(totals.get("icp", {}).items())
+            },
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {"pending": self.depth(), "applied": self.applied}
+
+
+def iter_history_events(bases: Sequence[str]) -> Iterator[FunnelEvent]:
+    """Eventos de cada log (com seus segmentos), intercalados por horário numa só passada."""
+    streams = []
+    for base in bases:
+        records = iter_jsonl(history_segments(base))
+        streams.append((str(r.get("ts") or ""), ev) for r in records for ev in (event_from_record(r),) if ev is not None)
+    # Cada log já está em ordem cronológica; merge só intercala, sem ordenar tudo em memória
+    for _, ev in heapq.merge(*streams, key=lambda item: item[0]):
+        yield ev
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Rollups do funil")
+    sub = parser.add_subparsers(dest="command", required=True)
+    rebuild = sub.add_parser("rebuild", help="recalcula os rollups a partir dos logs de histórico")
+    rebuild.add_argument("logs", nargs="*", help="JSONL base (segmentos rotacionados e .gz incluídos)")
+    rebuild.add_argument("--db", default=os.path.join("var", "data", "funnel.sqlite3"))
+    rebuild.add_argument("--batch-size", type=int, default=5000)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    logs = args.logs or [os.path.join("var", "data", "history.jsonl"), os.path.join("var", "data", "analysis.jsonl")]
+    os.makedirs(os.path.dirname(os.path.abspath(args.db)), exist_ok=True)
+    store = FunnelAnalytics(args.db)
+    t0 = time.time()
+    applied = store.rebuild(iter_history_events(logs), batch_size=args.batch_size)
+    print(json.dumps({"applied": applied, "seconds": round(time.time() - t0, 2)}))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,380 @@
+import argparse
+import base64
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    digest TEXT NOT NULL UNIQUE,
+    lead_id TEXT NOT NULL,
+    phone TEXT NOT NULL DEFAULT '',
+    stage TEXT,
+    lead_score INTEGER,
+    ts TEXT NOT NULL,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_lead_ts ON messages (lead_id, ts, id);
+CREATE INDEX IF NOT EXISTS idx_messages_phone_ts ON messages (phone, ts, id);
+CREATE INDEX IF NOT EXISTS idx_messages_stage_ts ON messages (stage, ts, id);
+CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages (ts, id);
+
+CREATE TABLE IF NOT EXISTS leads (
+    lead_id TEXT PRIMARY KEY,
+    phone TEXT NOT NULL DEFAULT '',
+    stage TEXT,
+    lead_score INTEGER,
+    first_ts TEXT NOT NULL,
+    last_ts TEXT NOT NULL,
+    messages INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_leads_stage_last ON leads (stage, last_ts, lead_id);
+CREATE INDEX IF NOT EXISTS idx_leads_last ON leads (last_ts, lead_id);
+CREATE INDEX IF NOT EXISTS idx_leads_phone ON leads (phone);
+"""
+
+INSERT_MESSAGE = (
+    "INSERT OR IGNORE INTO messages (digest, lead_id, phone, stage, lead_score, ts, record) VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+# O estado do lead acompanha a mensagem mais recente, mesmo que o import traga mensagens fora de ordem
+UPSERT_LEAD = """
+INSERT INTO leads (lead_id, phone, stage, lead_score, first_ts, last_ts, messages) VALUES (?, ?, ?, ?, ?, ?, 1)
+ON CONFLICT(lead_id) DO UPDATE SET
+    phone = CASE WHEN excluded.last_ts >= leads.last_ts THEN excluded.phone ELSE leads.phone END,
+    stage = CASE WHEN excluded.last_ts >= leads.last_ts THEN excluded.stage ELSE leads.stage END,
+    lead_score = CASE WHEN excluded.last_ts >= leads.last_ts THEN excluded.lead_score ELSE leads.lead_score END,
+    first_ts = MIN(leads.first_ts, excluded.first_ts),
+    last_ts = MAX(leads.last_ts, excluded.last_ts),
+    messages = leads.messages + 1
+"""
+
+MAX_PAGE = 500
+
+
+def encode_cursor(*values: Any) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(",", ":")).encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, size: int) -> Optional[List[Any]]:
+    """Valores do cursor, ou None se vazio. Levanta ValueError se inválido."""
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError("cursor inválido")
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("cursor inválido")
+    return values
+
+
+def record_digest(record: Dict[str, Any]) -> str:
+    # Mesmo registro, mesma chave: reimportar um arquivo ou reenviar um lote não duplica mensagens
+    return hashlib.sha1(json.dumps(record, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def _row(record: Dict[str, Any]) -> Optional[Tuple]:
+    lead_id = record.get("lead_id")
+    ts = record.get("ts")
+    if not lead_id or not ts:
+        return None
+    analysis = record.get("analysis") if isinstance(record.get("analysis"), dict) else {}
+    score = analysis.get("lead_score")
+    return (
+        record_digest(record),
+        str(lead_id),
+        str(record.get("phone") or ""),
+        analysis.get("stage"),
+        int(score) if isinstance(score, (int, float)) else None,
+        str(ts),
+        json.dumps(record, ensure_ascii=False),
+    )
+
+
+def history_segments(path: str) -> List[str]:
+    """Segmentos rotacionados de `path` (`<path>.<AAAAmmdd-HHMMSS-ffffff>[.gz]`) em ordem, e o arquivo ativo por último."""
+    rotated = sorted(p for p in glob.glob(glob.escape(path) + ".*") if not p.endswith(".lock"))
+    # Durante a compressão existem o segmento e o .gz parcial: fica com o segmento
+    present = set(rotated)
+    rotated = [p for p in rotated if not (p.endswith(".gz") and p[:-3] in present)]
+    return rotated + ([path] if os.path.exists(path) else [])
+
+
+def iter_jsonl(paths: Iterable[str]) -> Iterator[Dict[str, Any]]:
+    """Registros de arquivos JSONL (`.gz` incluído), linha a linha; linhas inválidas são puladas."""
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8", errors="replace") as fh:
+            for line in fh:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning("history: linha inválida em %s", path)
+                    continue
+                if isinstance(record, dict):
+                    yield record
+
+
+class ReaderPool:
+    """Conexões de leitura compartilhadas pelas threads de requisição.
+
+    No máximo `size` ficam abertas; uma thread a mais espera a vez em vez de
+    abrir outra. O schema já existe quando o pool é criado, então pegar uma
+    conexão não roda DDL.
+    """
+
+    def __init__(self, connect: Callable[[], sqlite3.Connection], size: int = 4):
+        self._connect = connect
+        self._slots = threading.BoundedSemaphore(max(1, size))
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        with self._slots:
+            try:
+                db = self._idle.get_nowait()
+            except queue.Empty:
+                db = self._connect()
+            try:
+                yield db
+            finally:
+                self._idle.put(db)
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class HistoryStore:
+    """Histórico de conversas em SQLite (WAL), indexado por lead, telefone, estágio e horário.
+
+    `add` só enfileira; uma thread grava em lote, numa transação por lote, a
+    cada `flush_interval` segundos ou `batch_size` registros. Além das
+    mensagens, a tabela `leads` guarda o último estágio/score de cada lead para
+    listagens por estágio sem varrer mensagens. Leituras usam um pool pequeno
+    de conexões (`readers`) e paginação por cursor (keyset), então o custo de
+    uma página não depende do tamanho do histórico.
+    """
+
+    def __init__(
+        self, path: str, batch_size: int = 500, flush_interval: float = 1.0, max_queue: int = 10000, readers: int = 4
+    ):
+        self.path = path
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self.written = 0
+        self.duplicates = 0
+        # Schema só na construção; as conexões seguintes não repetem o DDL
+        db = self._connect()
+        db.executescript(SCHEMA)
+        db.close()
+        self._readers = ReaderPool(self._connect, readers)
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    # ---- escrita ----
+
+    def add(self, record: Dict[str, Any]) -> None:
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="history-store", daemon=True)
+                self._thread.start()
+        self._queue.put(record)
+
+    def write_many(self, records: Iterable[Dict[str, Any]], db: Optional[sqlite3.Connection] = None) -> Tuple[int, int]:
+        """Grava `records` numa transação; devolve (inseridos, ignorados)."""
+        own = db is None
+        db = db or self._connect()
+        inserted = skipped = 0
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                for record in records:
+                    row = _row(record)
+                    if row is None:
+                        skipped += 1
+                        continue
+                    if db.execute(INSERT_MESSAGE, row).rowcount == 0:
+                        skipped += 1
+                        continue
+                    inserted += 1
+                    db.execute(UPSERT_LEAD, (row[1], row[2], row[3], row[4], row[5], row[5]))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        finally:
+            if own:
+                db.close()
+        return inserted, skipped
+
+    def flush(self, timeout: Optional[float] = None) -> None:
+        """Bloqueia até tudo que foi enfileirado antes da chamada estar gravado."""
+        if self._thread is None:
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def close(self, timeout: Optional[float] = 10.0) -> None:
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+        self._readers.close()
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def _run(self) -> None:
+        db = self._connect()
+        while True:
+            batch: List[Dict[str, Any]] = []
+            waiters: List[threading.Event] = []
+            stop = False
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                    break
+                batch.append(item)
+            if batch:
+                try:
+                    inserted, skipped = self.write_many(batch, db)
+                    self.written += inserted
+                    self.duplicates += skipped
+                except Exception:
+                    logger.exception("history: falha ao gravar %d registros", len(batch))
+            for w in waiters:
+                w.set()
+            if stop:
+                db.close()
+                return
+
+    # ---- leitura ----
+
+    def lead_history(self, lead_id: str, limit: int = 50, cursor: str = "", order: str = "asc") -> Dict[str, Any]:
+        """Mensagens de um lead por horário, `limit` por página."""
+        limit = max(1, min(limit, MAX_PAGE))
+        desc = order == "desc"
+        after = decode_cursor(cursor, 2)
+        sql = "SELECT id, ts, record FROM messages WHERE lead_id = ?"
+        params: List[Any] = [lead_id]
+        if after is not None:
+            sql += " AND (ts, id) < (?, ?)" if desc else " AND (ts, id) > (?, ?)"
+            params += after
+        sql += " ORDER BY ts DESC, id DESC LIMIT ?" if desc else " ORDER BY ts, id LIMIT ?"
+        with self._readers.connection() as db:
+            rows = db.execute(sql, params + [limit + 1]).fetchall()
+        items = [json.loads(r[2]) for r in rows[:limit]]
+        next_cursor = encode_cursor(rows[limit - 1][1], rows[limit - 1][0]) if len(rows) > limit else None
+        return {"lead_id": lead_id, "items": items, "next_cursor": next_cursor}
+
+    def list_leads(self, stage: str = "", since: str = "", phone: str = "", limit: int = 50, cursor: str = "") -> Dict[str, Any]:
+        """Leads pela última atividade (mais recentes primeiro), com filtros opcionais."""
+        limit = max(1, min(limit, MAX_PAGE))
+        after = decode_cursor(cursor, 2)
+        sql = "SELECT lead_id, phone, stage, lead_score, first_ts, last_ts, messages FROM leads WHERE 1=1"
+        params: List[Any] = []
+        if stage:
+            sql += " AND stage = ?"
+            params.append(stage)
+        if phone:
+            sql += " AND phone = ?"
+            params.append(phone)
+        if since:
+            sql += " AND last_ts >= ?"
+            params.append(since)
+        if after is not None:
+            sql += " AND (last_ts, lead_id) < (?, ?)"
+            params += after
+        sql += " ORDER BY last_ts DESC, lead_id DESC LIMIT ?"
+        with self._readers.connection() as db:
+            rows = db.execute(sql, params + [limit + 1]).fetchall()
+        keys = ("lead_id", "phone", "stage", "lead_score", "first_ts", "last_ts", "messages")
+        items = [dict(zip(keys, r)) for r in rows[:limit]]
+        next_cursor = encode_cursor(rows[limit - 1][5], rows[limit - 1][0]) if len(rows) > limit else None
+        return {"items": items, "next_cursor": next_cursor}
+
+    def stats(self) -> Dict[str, Any]:
+        return {"pending": self.depth(), "written": self.written, "duplicates": self.duplicates}
+
+
+def import_jsonl(store: HistoryStore, paths: Iterable[str], batch_size: int = 5000) -> Dict[str, int]:
+    """Importa arquivos JSONL de histórico em lotes, sem carregar o arquivo em memória."""
+    totals = {"read": 0, "inserted": 0, "skipped": 0}
+    db = store._connect()
+    try:
+        batch: List[Dict[str, Any]] = []
+        for record in iter_jsonl(paths):
+            batch.append(record)
+            totals["read"] += 1
+            if len(batch) >= batch_size:
+                inserted, skipped = store.write_many(batch, db)
+                totals["inserted"] += inserted
+                totals["skipped"] += skipped
+                batch = []
+        if batch:
+            inserted, skipped = store.write_many(batch, db)
+            totals["inserted"] += inserted
+            totals["skipped"] += skipped
+    finally:
+        db.close()
+    return totals
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Histórico de conversas em SQLite")
+    sub = parser.add_subparsers(dest="command", required=True)
+    imp = sub.add_parser("import", help="importa history.jsonl (e segmentos rotacionados/.gz) para o banco")
+    imp.add_argument("files", nargs="*", help="arquivos JSONL; padrão: var/data/history.jsonl e seus segmentos")
+    imp.add_argument("--db", default=os.path.join("var", "data", "history.sqlite3"))
+    imp.add_argument("--batch-size", type=int, default=5000)
+    args = parser.parse_args(argv)
+
+    paths = args.files or history_segments(os.path.join("var", "data", "history.jsonl"))
+    if not paths:
+        print("nenhum arquivo para importar", file=sys.stderr)
+        return 1
+    os.makedirs(os.path.dirname(os.path.abspath(args.db)), exist_ok=True)
+    started = time.monotonic()
+    totals = import_jsonl(HistoryStore(args.db), paths, args.batch_size)
+    totals["seconds"] = round(time.monotonic() - started, 2)  # type: ignore[assignment]
+    print(json.dumps(totals))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
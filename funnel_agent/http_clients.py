@@ -0,0 +1,194 @@
+import os
+import random
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import REGISTRY
+from profiling import record_call
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS")
+
+BACKEND_REQUESTS = REGISTRY.counter(
+    "funnel_backend_requests_total", "Tentativas HTTP por backend, método e status (código ou classe do erro)", ("backend", "method", "status")
+)
+BACKEND_LATENCY = REGISTRY.histogram("funnel_backend_request_duration_seconds", "Duração de cada tentativa HTTP por backend", ("backend", "method"))
+
+
+class CircuitOpenError(requests.RequestException):
+    """O backend está com o circuito aberto; a chamada nem foi tentada."""
+
+
+class CircuitBreaker:
+    """Abre após `threshold` falhas seguidas e recusa chamadas por `reset_after` segundos.
+
+    Depois disso deixa passar uma chamada de teste (meio-aberto): sucesso fecha o
+    circuito, falha reabre.
+    """
+
+    def __init__(self, threshold: int = 5, reset_after: float = 30.0):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_after:
+                return "half_open"
+            return "open"
+
+    def allow(self) -> bool:
+        if self.threshold <= 0:
+            return True
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_after or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._probing or (self.threshold > 0 and self._failures >= self.threshold):
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+
+class BackendClient:
+    """Cliente HTTP de um backend: sessão com keep-alive, retries com backoff e circuit breaker.
+
+    Cada backend tem seu próprio pool de conexões e seu próprio breaker, então um
+    CRM lento não consome conexões nem tempo das chamadas à Z-API ou ao LLM.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        pool_size: int = 10,
+        timeout: float = 20.0,
+        retries: int = 2,
+        backoff_base: float = 0.5,
+        backoff_max: float = 8.0,
+        breaker_threshold: int = 5,
+        breaker_reset: float = 30.0,
+    ):
+        self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @classmethod
+    def from_env(cls, name: str, prefix: str, **defaults: Any) -> "BackendClient":
+        # Ex.: CRM_HTTP_POOL_SIZE, CRM_HTTP_TIMEOUT, CRM_HTTP_RETRIES, CRM_HTTP_BREAKER_THRESHOLD
+        def env(key: str, cast, default):
+            raw = os.getenv(f"{prefix}_HTTP_{key}")
+            return cast(raw) if raw not in (None, "") else default
+
+        return cls(
+            name,
+            pool_size=env("POOL_SIZE", int, defaults.get("pool_size", 10)),
+            timeout=env("TIMEOUT", float, defaults.get("timeout", 20.0)),
+            retries=env("RETRIES", int, defaults.get("retries", 2)),
+            backoff_base=env("BACKOFF_BASE", float, defaults.get("backoff_base", 0.5)),
+            backoff_max=env("BACKOFF_MAX", float, defaults.get("backoff_max", 8.0)),
+            breaker_threshold=env("BREAKER_THRESHOLD", int, defaults.get("breaker_threshold", 5)),
+            breaker_reset=env("BREAKER_RESET", float, defaults.get("breaker_reset", 30.0)),
+        )
+
+    def _backoff(self, attempt: int, resp: Optional[requests.Response]) -> float:
+        if resp is not None:
+            retry_after = resp.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                return min(float(retry_after), self.backoff_max)
+        # Full jitter: espera aleatória entre 0 e o teto exponencial
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    @staticmethod
+    def _rejected_unprocessed(resp: requests.Response) -> bool:
+        # 429 e 503 com Retry-After indicam que o servidor recusou o pedido antes de
+        # processá-lo; 500/502/504 em POST/PATCH podem vir depois de aplicado
+        return resp.status_code == 429 or (resp.status_code == 503 and "Retry-After" in resp.headers)
+
+    def request(self, method: str, url: str, **kwargs: Any) -> requests.Response:
+        method = method.upper()
+        if not self.breaker.allow():
+            BACKEND_REQUESTS.inc(self.name, method, "CircuitOpenError")
+            record_call(self.name, method, "CircuitOpenError", 0.0)
+            raise CircuitOpenError(f"{self.name}: circuito aberto")
+        kwargs.setdefault("timeout", self.timeout)
+        # Com Idempotency-Key o servidor descarta a repetição, então POST/PATCH também podem repetir
+        headers = kwargs.get("headers") or {}
+        idempotent = method in IDEMPOTENT_METHODS or any(k.lower() == "idempotency-key" for k in headers)
+        attempt = 0
+        ok = False
+        try:
+            while True:
+                resp: Optional[requests.Response] = None
+                t0 = time.perf_counter()
+                try:
+                    resp = self.session.request(method, url, **kwargs)
+                except requests.RequestException as exc:
+                    BACKEND_LATENCY.observe(time.perf_counter() - t0, self.name, method)
+                    BACKEND_REQUESTS.inc(self.name, method, type(exc).__name__)
+                    record_call(self.name, method, type(exc).__name__, time.perf_counter() - t0)
+                    if not isinstance(exc, (requests.ConnectionError, requests.Timeout)):
+                        raise
+                    # Leitura expirada em POST/PATCH pode já ter sido aplicada: não repete
+                    retryable = isinstance(exc, requests.ConnectTimeout) or idempotent or not isinstance(exc, requests.ReadTimeout)
+                    if attempt >= self.retries or not retryable:
+                        raise
+                else:
+                    BACKEND_LATENCY.observe(time.perf_counter() - t0, self.name, method)
+                    BACKEND_REQUESTS.inc(self.name, method, str(resp.status_code))
+                    record_call(self.name, method, str(resp.status_code), time.perf_counter() - t0)
+                    if resp.status_code not in RETRY_STATUS:
+                        ok = True
+                        return resp
+                    if attempt >= self.retries or not (idempotent or self._rejected_unprocessed(resp)):
+                        return resp
+                    resp.close()
+                time.sleep(self._backoff(attempt, resp))
+                attempt += 1
+        finally:
+            # Toda saída registra o resultado, inclusive erros que não são de rede: sem isso a
+            # chamada de teste do meio-aberto ficaria pendente e o circuito não fecharia mais
+            if ok:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+
+    def get(self, url: str, **kwargs: Any) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs: Any) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def patch(self, url: str, **kwargs: Any) -> requests.Response:
+        return self.request("PATCH", url, **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"breaker": self.breaker.state, "timeout": self.timeout, "retries": self.retries}
@@ -0,0 +1,100 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from ttl_cache import TTLCache
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS idempotency (
+    key TEXT PRIMARY KEY,
+    outcome TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_idempotency_created ON idempotency (created_at);
+"""
+
+PROCESSING: Dict[str, Any] = {"ok": True, "status": "processing"}
+
+
+class IdempotencyStore:
+    """Registro de eventos já recebidos, para responder reentregas sem reprocessar.
+
+    `begin(key)` devolve None quando o chamador passa a ser o dono do evento;
+    caso contrário devolve o resultado registrado (ou `PROCESSING` se ainda em
+    andamento). `complete` grava o resultado; `abort` libera a chave para que
+    uma reentrega seja processada de novo.
+
+    O LRU em memória atende o caso comum. Com `path`, o SQLite é a fonte de
+    verdade entre processos (o `INSERT OR IGNORE` decide quem é o dono).
+    Marcas "em andamento" mais antigas que `inflight_ttl` são tratadas como
+    abandonadas (processo caiu no meio).
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 86400.0, path: str = "", inflight_ttl: float = 300.0):
+        self.ttl = ttl
+        self.inflight_ttl = inflight_ttl
+        self.path = path
+        self._cache = TTLCache(maxsize, ttl)
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self.duplicates = 0
+        self._last_purge = 0.0
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            db = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(SCHEMA)
+            self._db = db
+        return self._db
+
+    def _purge(self, now: float) -> None:
+        if now - self._last_purge < 60:
+            return
+        self._last_purge = now
+        self._conn().execute("DELETE FROM idempotency WHERE created_at < ?", (now - self.ttl,))
+
+    def begin(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                started, outcome = cached
+                if outcome is not None or now - started < self.inflight_ttl:
+                    self.duplicates += 1
+                    return outcome or PROCESSING
+            if self.path:
+                db = self._conn()
+                self._purge(now)
+                # Remove marca "em andamento" abandonada antes de tentar assumir a chave
+                db.execute(
+                    "DELETE FROM idempotency WHERE key=? AND outcome IS NULL AND created_at < ?",
+                    (key, now - self.inflight_ttl),
+                )
+                cur = db.execute("INSERT OR IGNORE INTO idempotency (key, outcome, created_at) VALUES (?, NULL, ?)", (key, now))
+                if cur.rowcount == 0:
+                    row = db.execute("SELECT outcome, created_at FROM idempotency WHERE key=?", (key,)).fetchone()
+                    outcome = json.loads(row[0]) if row and row[0] else None
+                    self._cache.put(key, (row[1] if row else now, outcome))
+                    self.duplicates += 1
+                    return outcome or PROCESSING
+            self._cache.put(key, (now, None))
+            return None
+
+    def complete(self, key: str, outcome: Dict[str, Any]) -> None:
+        with self._lock:
+            self._cache.put(key, (time.time(), outcome))
+            if self.path:
+                self._conn().execute("UPDATE idempotency SET outcome=? WHERE key=?", (json.dumps(outcome, ensure_ascii=False), key))
+
+    def abort(self, key: str) -> None:
+        with self._lock:
+            self._cache.put(key, (0.0, None))
+            if self.path:
+                self._conn().execute("DELETE FROM idempotency WHERE key=? AND outcome IS NULL", (key,))
+
+    def stats(self) -> Dict[str, Any]:
+        return {"duplicates": self.duplicates, "cache": self._cache.stats(), "persistent": bool(self.path)}
@@ -0,0 +1,101 @@
+import logging
+import queue
+import threading
+import zlib
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedJobQueue:
+    """Fila de jobs em memória, limitada, processada por um pool de threads.
+
+    Cada chave (ex.: telefone) é sempre roteada para o mesmo worker, então jobs
+    da mesma chave rodam na ordem de chegada. Chaves diferentes rodam em paralelo.
+    """
+
+    def __init__(self, handler: Callable[[Dict[str, Any]], Any], workers: int = 4, maxsize: int = 1000, name: str = "jobs"):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.name = name
+        per_shard = max(1, maxsize // self.workers)
+        self._shards: List[queue.Queue] = [queue.Queue(maxsize=per_shard) for _ in range(self.workers)]
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._busy = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def _shard(self, key: str) -> queue.Queue:
+        return self._shards[zlib.crc32(key.encode("utf-8")) % self.workers]
+
+    def start(self) -> None:
+        with self._lock:
+            if self._threads:
+                return
+            for i, shard in enumerate(self._shards):
+                t = threading.Thread(target=self._run, args=(shard,), name=f"{self.name}-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, key: str, job: Dict[str, Any]) -> bool:
+        """Enfileira `job`; devolve False se a fila da chave estiver cheia."""
+        self.start()
+        try:
+            self._shard(key).put_nowait(job)
+            return True
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+
+    def _run(self, shard: queue.Queue) -> None:
+        while True:
+            job = shard.get()
+            if job is None:
+                shard.task_done()
+                return
+            with self._lock:
+                self._busy += 1
+            try:
+                self.handler(job)
+                ok = True
+            except Exception:
+                logger.exception("%s: falha ao processar job", self.name)
+                ok = False
+            finally:
+                shard.task_done()
+            with self._lock:
+                self._busy -= 1
+                if ok:
+                    self.processed += 1
+                else:
+                    self.failed += 1
+
+    def depth(self) -> int:
+        return sum(s.qsize() for s in self._shards)
+
+    def join(self) -> None:
+        for s in self._shards:
+            s.join()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for s in self._shards:
+            s.put(None)
+        for t in threads:
+            t.join(timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "depth": self.depth(),
+                "in_progress": self._busy,
+                "workers": self.workers,
+                "capacity": sum(s.maxsize for s in self._shards),
+                "processed": self.processed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+            }
@@ -0,0 +1,200 @@
+import gzip
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: sem lock entre processos
+    fcntl = None  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+
+class JsonlSink:
+    """Escritor JSONL com buffer, uma thread por arquivo e rotação.
+
+    - `write` só serializa e enfileira; a thread de escrita junta os registros e
+      grava em lote quando acumula `flush_records` ou a cada `flush_interval`s.
+    - Cada lote vai em um único `write` com `O_APPEND` sob `flock` em
+      `<arquivo>.lock`, então linhas nunca se misturam entre threads ou processos.
+    - Rotaciona por tamanho (`max_bytes`) e/ou na virada do dia (UTC); segmentos
+      antigos viram `<arquivo>.<AAAAmmdd-HHMMSS-ffffff>[.gz]` e são apagados após
+      `retention_days`.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = 50 * 1024 * 1024,
+        rotate_daily: bool = True,
+        compress: bool = True,
+        retention_days: int = 30,
+        flush_interval: float = 1.0,
+        flush_records: int = 256,
+        max_record_bytes: int = 256 * 1024,
+        max_queue: int = 10000,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_daily = rotate_daily
+        self.compress = compress
+        self.retention_days = retention_days
+        self.flush_interval = flush_interval
+        self.flush_records = max(1, flush_records)
+        self.max_record_bytes = max_record_bytes
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._fd: Optional[int] = None
+        self._thread = threading.Thread(target=self._run, name=f"jsonl-{os.path.basename(path)}", daemon=True)
+        self._thread.start()
+
+    # ---- produtor ----
+
+    def _encode(self, record: Dict[str, Any]) -> bytes:
+        line = json.dumps(record, ensure_ascii=False)
+        if self.max_record_bytes and len(line) > self.max_record_bytes:
+            # Registro grande demais: mantém campos pequenos e marca os cortados
+            kept: Dict[str, Any] = {}
+            dropped: List[str] = []
+            budget = self.max_record_bytes // 2
+            for k, v in record.items():
+                size = len(json.dumps(v, ensure_ascii=False))
+                if size <= budget:
+                    kept[k] = v
+                    budget -= size
+                else:
+                    dropped.append(k)
+            kept["_truncated"] = dropped
+            line = json.dumps(kept, ensure_ascii=False)
+        return (line + "\n").encode("utf-8")
+
+    def write(self, record: Dict[str, Any]) -> None:
+        self._queue.put(self._encode(record))
+
+    def flush(self, timeout: Optional[float] = None) -> None:
+        """Bloqueia até tudo que foi enfileirado antes da chamada estar no disco."""
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def depth(self) -> int:
+        """Registros aguardando a thread de escrita."""
+        return self._queue.qsize()
+
+    def close(self, timeout: Optional[float] = 10.0) -> None:
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    # ---- thread de escrita ----
+
+    def _run(self) -> None:
+        while True:
+            batch: List[bytes] = []
+            waiters: List[threading.Event] = []
+            stop = False
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.flush_records:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                    break
+                batch.append(item)
+            if batch:
+                try:
+                    self._write_batch(b"".join(batch))
+                except Exception:
+                    logger.exception("jsonl: falha ao gravar %s", self.path)
+            for w in waiters:
+                w.set()
+            if stop:
+                if self._fd is not None:
+                    os.close(self._fd)
+                    self._fd = None
+                return
+
+    def _open(self) -> int:
+        return os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def _write_batch(self, data: bytes) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        lock_fd = os.open(self.path + ".lock", os.O_WRONLY | os.O_CREAT, 0o644)
+        rotated: Optional[str] = None
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            # Outro processo pode ter rotacionado: reabre se o inode mudou
+            if self._fd is not None:
+                try:
+                    if os.stat(self.path).st_ino != os.fstat(self._fd).st_ino:
+                        os.close(self._fd)
+                        self._fd = None
+                except FileNotFoundError:
+                    os.close(self._fd)
+                    self._fd = None
+            if self._fd is None:
+                self._fd = self._open()
+            rotated = self._maybe_rotate(len(data))
+            view = memoryview(data)
+            while view:
+                n = os.write(self._fd, view)
+                view = view[n:]
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+            os.close(lock_fd)
+        if rotated:
+            self._finish_rotation(rotated)
+
+    def _maybe_rotate(self, incoming: int) -> Optional[str]:
+        assert self._fd is not None
+        st = os.fstat(self._fd)
+        if st.st_size == 0:
+            return None
+        today = datetime.utcnow().strftime("%Y%m%d")
+        file_day = datetime.utcfromtimestamp(st.st_mtime).strftime("%Y%m%d")
+        by_size = self.max_bytes and st.st_size + incoming > self.max_bytes
+        by_day = self.rotate_daily and file_day != today
+        if not (by_size or by_day):
+            return None
+        # Microssegundos no nome mantêm a ordem lexicográfica igual à cronológica
+        target = f"{self.path}.{datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f')}"
+        while os.path.exists(target) or os.path.exists(target + ".gz"):
+            target = f"{self.path}.{datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f')}"
+        os.rename(self.path, target)
+        os.close(self._fd)
+        self._fd = self._open()
+        return target
+
+    def _finish_rotation(self, segment: str) -> None:
+        if self.compress:
+            try:
+                with open(segment, "rb") as src, gzip.open(segment + ".gz", "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(segment)
+            except Exception:
+                logger.exception("jsonl: falha ao comprimir %s", segment)
+        if self.retention_days > 0:
+            cutoff = time.time() - self.retention_days * 86400
+            directory = os.path.dirname(self.path) or "."
+            prefix = os.path.basename(self.path) + "."
+            for name in os.listdir(directory):
+                if not name.startswith(prefix) or name.endswith(".lock"):
+                    continue
+                full = os.path.join(directory, name)
+                try:
+                    if os.path.getmtime(full) < cutoff:
+                        os.remove(full)
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,409 @@
+import argparse
+import json
+import logging
+import math
+import os
+import sqlite3
+import sys
+import time
+import zlib
+from array import array
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from history_store import history_segments, iter_jsonl
+
+try:  # NumPy é opcional: só treino e re-score em lote precisam dele
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+BIAS = "bias"
+# Mesmo texto que app.build_analysis coloca em insights
+COMPARE_INSIGHT = "Comparação com fornecedores/concorrentes"
+
+OUTCOME_VALUES = {
+    "1": 1, "true": 1, "won": 1, "ganho": 1, "ganha": 1, "fechado": 1, "convertido": 1,
+    "0": 0, "false": 0, "lost": 0, "perdido": 0, "perdida": 0,
+}
+
+
+def _require_numpy() -> None:
+    if np is None:
+        raise RuntimeError("NumPy é necessário para treinar e re-pontuar em lote (pip install -r requirements-train.txt)")
+
+
+def _messages_bucket(n: int) -> str:
+    if n <= 1:
+        return "1"
+    if n <= 3:
+        return "2-3"
+    if n <= 7:
+        return "4-7"
+    return "8+"
+
+
+CATEGORICAL = (
+    ("stage", "stage"),
+    ("urgency", "urgency"),
+    ("budget_signal", "budget"),
+    ("decision_maker", "decision"),
+    ("buying_intent", "intent"),
+    ("icp_fit", "icp"),
+)
+
+
+def analysis_key(analysis: Dict[str, Any]) -> Tuple:
+    """Tudo que `analysis_tokens` usa de uma análise; análises com a mesma chave têm as mesmas features."""
+    messages = analysis.get("messages")
+    return (
+        tuple(analysis.get(field) for field, _ in CATEGORICAL),
+        tuple(analysis.get("pain_points") or ()),
+        tuple(analysis.get("objections") or ()),
+        bool(analysis.get("compares_vendors") or COMPARE_INSIGHT in (analysis.get("insights") or ())),
+        _messages_bucket(messages) if isinstance(messages, int) else None,
+    )
+
+
+def _key_tokens(key: Tuple) -> List[str]:
+    values, pains, objections, compares, messages = key
+    tokens = [BIAS]
+    tokens += [f"{prefix}={value}" for (_, prefix), value in zip(CATEGORICAL, values) if value]
+    tokens += [f"pain={str(p).casefold()}" for p in pains]
+    tokens += [f"objection={o}" for o in objections]
+    if compares:
+        tokens.append("compare")
+    if messages:
+        tokens.append(f"messages={messages}")
+    return tokens
+
+
+def analysis_tokens(analysis: Dict[str, Any]) -> List[str]:
+    """Features esparsas (binárias) de uma análise: uma string por sinal presente.
+
+    Usa só campos que a resposta do /analyze e os registros de histórico já
+    trazem, então o mesmo modelo serve para o tempo real e para o histórico.
+    """
+    return _key_tokens(analysis_key(analysis))
+
+
+class LeadModel:
+    """Regressão logística sobre `analysis_tokens`; score = 100 × probabilidade de conversão.
+
+    Pontuar uma análise é somar os pesos dos tokens presentes, em Python puro.
+    `score_batch` usa NumPy para pontuar muitas de uma vez.
+    """
+
+    def __init__(self, vocabulary: Sequence[str], weights: Sequence[float], version: str = "", metrics: Optional[Dict[str, Any]] = None):
+        if len(vocabulary) != len(weights):
+            raise ValueError("vocabulary e weights com tamanhos diferentes")
+        self.vocabulary = list(vocabulary)
+        self.weights = [float(w) for w in weights]
+        self.index = {token: i for i, token in enumerate(self.vocabulary)}
+        self._weight = dict(zip(self.vocabulary, self.weights))
+        self.version = version
+        self.metrics = metrics or {}
+        self._np_weights = None
+
+    @classmethod
+    def load(cls, path: str) -> "LeadModel":
+        with open(path, encoding="utf-8") as fh:
+            data = json.load(fh)
+        if data.get("format") != FORMAT_VERSION:
+            raise ValueError(f"formato de modelo não suportado: {data.get('format')}")
+        return cls(data["vocabulary"], data["weights"], data.get("version", ""), data.get("metrics"))
+
+    def save(self, path: str) -> None:
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(
+                {"format": FORMAT_VERSION, "version": self.version, "metrics": self.metrics,
+                 "vocabulary": self.vocabulary, "weights": self.weights},
+                fh,
+                ensure_ascii=False,
+            )
+        os.replace(tmp, path)
+
+    def score(self, analysis: Dict[str, Any]) -> int:
+        z = sum(self._weight.get(t, 0.0) for t in analysis_tokens(analysis))
+        return int(round(100.0 / (1.0 + math.exp(-max(-30.0, min(30.0, z))))))
+
+    def encode(self, analyses: Iterable[Dict[str, Any]]) -> Tuple[Any, Any]:
+        """CSR (indptr, indices) das análises; tokens fora do vocabulário são ignorados."""
+        indptr = array("q", [0])
+        indices = array("i")
+        # A base tem poucas combinações de sinais: cada uma vira índices uma vez só
+        rows: Dict[Tuple, List[int]] = {}
+        for analysis in analyses:
+            key = analysis_key(analysis)
+            row = rows.get(key)
+            if row is None:
+                if len(rows) >= 100000:
+                    rows.clear()
+                row = rows[key] = [i for i in (self.index.get(t) for t in _key_tokens(key)) if i is not None]
+            indices.extend(row)
+            indptr.append(len(indices))
+        return indptr, indices
+
+    def score_batch(self, analyses: Iterable[Dict[str, Any]]) -> Any:
+        _require_numpy()
+        if self._np_weights is None:
+            self._np_weights = np.asarray(self.weights, dtype=np.float64)
+        indptr, indices = self.encode(analyses)
+        z = _row_sums(self._np_weights, np.frombuffer(indptr, dtype=np.int64), np.frombuffer(indices, dtype=np.int32))
+        return np.rint(100.0 * _sigmoid(z)).astype(np.int64)
+
+
+def load_model(path: str) -> Optional[LeadModel]:
+    """Modelo em `path`, ou None (com aviso no log) se o arquivo faltar ou for inválido."""
+    try:
+        model = LeadModel.load(path)
+    except (OSError, ValueError, KeyError, TypeError) as exc:
+        logger.warning("lead_scoring: modelo %s indisponível (%s); usando a regra", path, exc)
+        return None
+    logger.info("lead_scoring: modelo %s carregado (%d features)", model.version, len(model.vocabulary))
+    return model
+
+
+def _sigmoid(z: Any) -> Any:
+    return 1.0 / (1.0 + np.exp(-np.clip(z, -30.0, 30.0)))
+
+
+def _row_sums(weights: Any, indptr: Any, indices: Any) -> Any:
+    # Soma dos pesos por linha do CSR; linhas vazias somam 0
+    gathered = np.concatenate([weights[indices], [0.0]])
+    starts = indptr[:-1]
+    sums = np.add.reduceat(gathered, np.minimum(starts, len(gathered) - 1))
+    sums[starts == indptr[1:]] = 0.0
+    return sums
+
+
+# ---- treino ----
+
+
+def load_labels(path: str) -> Dict[str, int]:
+    """Desfechos por lead: JSONL com {"lead_id", "outcome"} (1/0, won/lost, ganho/perdido)."""
+    labels: Dict[str, int] = {}
+    for record in iter_jsonl([path]):
+        lead_id = record.get("lead_id")
+        outcome = OUTCOME_VALUES.get(str(record.get("outcome")).strip().lower())
+        if lead_id and outcome is not None:
+            labels[str(lead_id)] = outcome
+    return labels
+
+
+def iter_labeled(records: Iterable[Dict[str, Any]], labels: Dict[str, int]) -> Iterator[Tuple[str, Dict[str, Any], int]]:
+    # Cada análise registrada de um lead rotulado é uma amostra: o modelo aprende a pontuar em qualquer ponto da conversa
+    for record in records:
+        analysis = record.get("analysis")
+        lead_id = str(record.get("lead_id") or "")
+        if isinstance(analysis, dict) and lead_id in labels:
+            yield lead_id, analysis, labels[lead_id]
+
+
+def train(
+    samples: Iterable[Tuple[str, Dict[str, Any], int]],
+    epochs: int = 300,
+    learning_rate: float = 0.5,
+    l2: float = 1e-3,
+    min_count: int = 5,
+    holdout: float = 0.2,
+) -> LeadModel:
+    """Treina por gradiente (lote inteiro) sobre a matriz esparsa, sem materializá-la densa.
+
+    A separação treino/validação é por lead (hash do lead_id), para que mensagens
+    do mesmo lead não caiam dos dois lados.
+    """
+    _require_numpy()
+    vocab: Dict[str, int] = {}
+    counts: List[int] = []
+    indptr = array("q", [0])
+    indices = array("i")
+    labels = array("b")
+    is_holdout = array("b")
+    for lead_id, analysis, label in samples:
+        for token in analysis_tokens(analysis):
+            i = vocab.get(token)
+            if i is None:
+                i = vocab[token] = len(counts)
+                counts.append(0)
+            counts[i] += 1
+            indices.append(i)
+        indptr.append(len(indices))
+        labels.append(label)
+        is_holdout.append((zlib.crc32(lead_id.encode("utf-8")) % 1000) < holdout * 1000)
+    if not labels:
+        raise ValueError("nenhuma amostra rotulada: confira lead_id entre desfechos e histórico")
+
+    # Tokens raros saem do vocabulário (o bias fica sempre)
+    counts_np = np.asarray(counts)
+    keep = counts_np >= min_count
+    keep[vocab[BIAS]] = True
+    remap = np.full(len(counts), -1, dtype=np.int64)
+    remap[keep] = np.arange(int(keep.sum()))
+    names = [t for t, i in sorted(vocab.items(), key=lambda kv: kv[1]) if keep[i]]
+
+    rows_np = np.repeat(np.arange(len(labels)), np.diff(np.frombuffer(indptr, dtype=np.int64)))
+    cols_np = remap[np.frombuffer(indices, dtype=np.int32)]
+    mask = cols_np >= 0
+    rows_np, cols_np = rows_np[mask], cols_np[mask]
+    y = np.frombuffer(labels, dtype=np.int8).astype(np.float64)
+    held = np.frombuffer(is_holdout, dtype=np.int8).astype(bool)
+    if held.all() or not held.any():
+        held = np.zeros(len(y), dtype=bool)
+
+    train_rows = ~held[rows_np]
+    t_rows, t_cols = rows_np[train_rows], cols_np[train_rows]
+    y_train = y[~held]
+    # Linhas de treino renumeradas de 0 a n_train-1
+    train_index = np.cumsum(~held) - 1
+    t_rows = train_index[t_rows]
+    n_train = len(y_train)
+
+    w = np.zeros(len(names))
+    bias = names.index(BIAS)
+    for _ in range(epochs):
+        z = np.bincount(t_rows, weights=w[t_cols], minlength=n_train)
+        err = _sigmoid(z) - y_train
+        grad = np.bincount(t_cols, weights=err[t_rows], minlength=len(names)) / n_train
+        grad += l2 * w
+        grad[bias] -= l2 * w[bias]  # o bias não é regularizado
+        w -= learning_rate * grad
+
+    z_all = np.bincount(rows_np, weights=w[cols_np], minlength=len(y))
+    metrics = {"samples": int(len(y)), "features": len(names), "train": _evaluate(z_all[~held], y[~held])}
+    if held.any():
+        metrics["holdout"] = _evaluate(z_all[held], y[held])
+    version = datetime.utcnow().strftime("%Y%m%d%H%M%S")
+    return LeadModel(names, w.tolist(), version, metrics)
+
+
+def _evaluate(z: Any, y: Any) -> Dict[str, Any]:
+    p = _sigmoid(z)
+    eps = 1e-12
+    logloss = float(-np.mean(y * np.log(p + eps) + (1 - y) * np.log(1 - p + eps)))
+    positives = int(y.sum())
+    negatives = len(y) - positives
+    auc = None
+    if positives and negatives:
+        # AUC pela soma dos postos (com empates na média)
+        order = np.argsort(z, kind="mergesort")
+        ranks = np.empty(len(z))
+        ranks[order] = np.arange(1, len(z) + 1)
+        _, inverse, counts = np.unique(z, return_inverse=True, return_counts=True)
+        sums = np.bincount(inverse, weights=ranks)
+        ranks = (sums / counts)[inverse]
+        auc = round(float((ranks[y == 1].sum() - positives * (positives + 1) / 2) / (positives * negatives)), 4)
+    return {
+        "samples": int(len(y)),
+        "positive_rate": round(positives / len(y), 4) if len(y) else 0,
+        "logloss": round(logloss, 4),
+        "auc": auc,
+        "accuracy": round(float(np.mean((p >= 0.5) == (y == 1))), 4),
+        "score_ge_70": round(float(np.mean(p >= 0.7)), 4),
+    }
+
+
+# ---- re-score da base ----
+
+
+def iter_latest_analyses(db_path: str, batch: int = 5000) -> Iterator[Tuple[str, Optional[int], Dict[str, Any]]]:
+    """(lead_id, score atual, última análise) de cada lead do histórico indexado."""
+    db = sqlite3.connect(db_path, timeout=30)
+    try:
+        cursor = db.execute(
+            "SELECT l.lead_id, l.lead_score, m.record FROM leads l JOIN messages m ON m.id = ("
+            "SELECT id FROM messages WHERE lead_id = l.lead_id ORDER BY ts DESC, id DESC LIMIT 1)"
+        )
+        while True:
+            rows = cursor.fetchmany(batch)
+            if not rows:
+                break
+            for lead_id, score, record in rows:
+                analysis = json.loads(record).get("analysis")
+                if isinstance(analysis, dict):
+                    yield lead_id, score, analysis
+    finally:
+        db.close()
+
+
+def rescore(model: LeadModel, rows: Iterable[Tuple[str, Optional[int], Dict[str, Any]]], out: Any, batch: int = 50000) -> Dict[str, Any]:
+    """Pontua em lotes vetorizados e escreve `{"lead_id", "old", "new"}` por lead em `out`."""
+    _require_numpy()
+    total = changed = hot = 0
+    deltas = 0.0
+    buf: List[Tuple[str, Optional[int], Dict[str, Any]]] = []
+
+    def flush() -> None:
+        nonlocal total, changed, hot, deltas
+        scores = model.score_batch(a for _, _, a in buf)
+        for (lead_id, old, _), new in zip(buf, scores.tolist()):
+            out.write(json.dumps({"lead_id": lead_id, "old": old, "new": new}) + "\n")
+            changed += old != new
+            deltas += new - (old or 0)
+        total += len(buf)
+        hot += int((scores >= 70).sum())
+        buf.clear()
+
+    for row in rows:
+        buf.append(row)
+        if len(buf) >= batch:
+            flush()
+    if buf:
+        flush()
+    return {"leads": total, "changed": changed, "hot": hot, "mean_delta": round(deltas / total, 2) if total else 0}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Score de leads aprendido")
+    sub = parser.add_subparsers(dest="command", required=True)
+    tr = sub.add_parser("train", help="treina o modelo com desfechos rotulados")
+    tr.add_argument("--labels", required=True, help="JSONL com lead_id e outcome")
+    tr.add_argument("history", nargs="*", help="history.jsonl (segmentos e .gz incluídos)")
+    tr.add_argument("--out", default=os.path.join("var", "data", "lead_model.json"))
+    tr.add_argument("--epochs", type=int, default=300)
+    tr.add_argument("--learning-rate", type=float, default=0.5)
+    tr.add_argument("--l2", type=float, default=1e-3)
+    tr.add_argument("--min-count", type=int, default=5)
+    rs = sub.add_parser("rescore", help="re-pontua todos os leads do histórico indexado")
+    rs.add_argument("--model", default=os.path.join("var", "data", "lead_model.json"))
+    rs.add_argument("--db", default=os.path.join("var", "data", "history.sqlite3"))
+    rs.add_argument("--out", default=os.path.join("var", "data", "rescore.jsonl"))
+    rs.add_argument("--batch-size", type=int, default=50000)
+    args = parser.parse_args(argv)
+    if np is None:
+        # Falha antes de ler histórico ou rótulos, com o comando que resolve
+        print("lead_scoring: train e rescore precisam de NumPy; instale com pip install -r requirements-train.txt", file=sys.stderr)
+        return 2
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    t0 = time.time()
+    if args.command == "train":
+        labels = load_labels(args.labels)
+        bases = args.history or [os.path.join("var", "data", "history.jsonl")]
+        records = (r for base in bases for r in iter_jsonl(history_segments(base) or [base]))
+        model = train(
+            iter_labeled(records, labels),
+            epochs=args.epochs,
+            learning_rate=args.learning_rate,
+            l2=args.l2,
+            min_count=args.min_count,
+        )
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        model.save(args.out)
+        result = {"out": args.out, "version": model.version, **model.metrics}
+    else:
+        model = LeadModel.load(args.model)
+        with open(args.out, "w", encoding="utf-8") as out:
+            result = rescore(model, iter_latest_analyses(args.db), out, batch=args.batch_size)
+        result["out"] = args.out
+    result["seconds"] = round(time.time() - t0, 2)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
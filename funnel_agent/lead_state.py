@@ -0,0 +1,85 @@
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS lead_state (
+    lead_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+class LeadStateStore:
+    """Estado acumulado por lead: cache LRU em memória com gravação direta em SQLite.
+
+    `update` lê, aplica a função e grava sob um lock por lead (listrado), então
+    mensagens simultâneas do mesmo lead não perdem atualização.
+    """
+
+    def __init__(self, path: str, cache_size: int = 10000, lock_stripes: int = 64):
+        self.path = path
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._stripes: List[threading.Lock] = [threading.Lock() for _ in range(lock_stripes)]
+        self.hits = 0
+        self.misses = 0
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            db = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(SCHEMA)
+            self._db = db
+        return self._db
+
+    def _remember(self, lead_id: str, state: Dict[str, Any]) -> None:
+        with self._cache_lock:
+            self._cache[lead_id] = state
+            self._cache.move_to_end(lead_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def get(self, lead_id: str) -> Optional[Dict[str, Any]]:
+        with self._cache_lock:
+            state = self._cache.get(lead_id)
+            if state is not None:
+                self._cache.move_to_end(lead_id)
+                self.hits += 1
+                return state
+            self.misses += 1
+        with self._db_lock:
+            row = self._conn().execute("SELECT state FROM lead_state WHERE lead_id=?", (lead_id,)).fetchone()
+        if row is None:
+            return None
+        state = json.loads(row[0])
+        self._remember(lead_id, state)
+        return state
+
+    def put(self, lead_id: str, state: Dict[str, Any]) -> None:
+        with self._db_lock:
+            self._conn().execute(
+                "INSERT INTO lead_state (lead_id, state, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(lead_id) DO UPDATE SET state=excluded.state, updated_at=excluded.updated_at",
+                (lead_id, json.dumps(state, ensure_ascii=False), time.time()),
+            )
+        self._remember(lead_id, state)
+
+    def update(self, lead_id: str, fn: Callable[[Optional[Dict[str, Any]]], Dict[str, Any]]) -> Dict[str, Any]:
+        with self._stripes[zlib.crc32(lead_id.encode("utf-8")) % len(self._stripes)]:
+            state = fn(self.get(lead_id))
+            self.put(lead_id, state)
+            return state
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cache_lock:
+            return {"cached": len(self._cache), "capacity": self.cache_size, "hits": self.hits, "misses": self.misses}
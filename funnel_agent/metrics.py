@@ -0,0 +1,201 @@
+import threading
+import time
+import weakref
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+LabelValues = Tuple[str, ...]
+Sample = Tuple[Dict[str, str], float]
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class _ThreadShards:
+    """Um dict por thread: quem escreve nunca disputa lock; a leitura soma os shards.
+
+    Quando a thread termina, o shard dela é somado em `retired` (com `merge`) e
+    descartado; o servidor threaded cria uma thread por requisição, então sem
+    isso os shards cresceriam com cada requisição já atendida.
+    """
+
+    def __init__(self, merge: Callable[[Dict[LabelValues, Any], LabelValues, Any], None]):
+        self._local = threading.local()
+        self._all: Dict[int, Dict[LabelValues, Any]] = {}
+        self._retired: Dict[LabelValues, Any] = {}
+        self._merge = merge
+        self._lock = threading.Lock()
+
+    def mine(self) -> Dict[LabelValues, Any]:
+        d = getattr(self._local, "d", None)
+        if d is None:
+            d = {}
+            with self._lock:
+                self._all[id(d)] = d
+            self._local.d = d
+            weakref.finalize(threading.current_thread(), self._retire, d)
+        return d
+
+    def _retire(self, d: Dict[LabelValues, Any]) -> None:
+        with self._lock:
+            self._all.pop(id(d), None)
+            for k, v in d.items():
+                self._merge(self._retired, k, v)
+
+    def snapshot(self) -> List[Dict[LabelValues, Any]]:
+        with self._lock:
+            shards = list(self._all.values())
+            # Linhas do histograma são listas somadas no lugar: copia sob o lock
+            retired = {k: list(v) if isinstance(v, list) else v for k, v in self._retired.items()}
+        # dict.copy() roda inteiro sob o GIL, então é consistente mesmo com escrita concorrente
+        return [retired] + [d.copy() for d in shards]
+
+
+def _merge_count(totals: Dict[LabelValues, Any], key: LabelValues, value: float) -> None:
+    totals[key] = totals.get(key, 0.0) + value
+
+
+def _merge_row(totals: Dict[LabelValues, Any], key: LabelValues, row: List[float]) -> None:
+    acc = totals.get(key)
+    if acc is None:
+        totals[key] = list(row)
+    else:
+        for i, v in enumerate(row):
+            acc[i] += v
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._shards = _ThreadShards(_merge_count)
+
+    def inc(self, *label_values: str, value: float = 1.0) -> None:
+        d = self._shards.mine()
+        d[label_values] = d.get(label_values, 0.0) + value
+
+    def expose(self) -> List[str]:
+        totals: Dict[LabelValues, float] = {}
+        for shard in self._shards.snapshot():
+            for k, v in shard.items():
+                totals[k] = totals.get(k, 0.0) + v
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for k in sorted(totals):
+            lines.append(f"{self.name}{_fmt_labels(self.labels, k)} {_fmt_value(totals[k])}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._shards = _ThreadShards(_merge_row)
+
+    def observe(self, value: float, *label_values: str) -> None:
+        d = self._shards.mine()
+        row = d.get(label_values)
+        if row is None:
+            # contagem por bucket (+Inf no fim), soma
+            row = [0] * (len(self.buckets) + 1) + [0.0]
+            d[label_values] = row
+        row[bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    @contextmanager
+    def time(self, *label_values: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, *label_values)
+
+    def expose(self) -> List[str]:
+        totals: Dict[LabelValues, List[float]] = {}
+        for shard in self._shards.snapshot():
+            for k, row in shard.items():
+                row = list(row)
+                acc = totals.setdefault(k, [0] * len(row))
+                for i, v in enumerate(row):
+                    acc[i] += v
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for k in sorted(totals):
+            row = totals[k]
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + [float("inf")], row[:-1]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _fmt_value(bound)
+                lines.append(f"{self.name}_bucket{_fmt_labels(self.labels + ('le',), k + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_fmt_labels(self.labels, k)} {_fmt_value(row[-1])}")
+            lines.append(f"{self.name}_count{_fmt_labels(self.labels, k)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Métricas do processo. Coletores são funções chamadas só no scrape (filas, caches)."""
+
+    def __init__(self):
+        self._metrics: List[Any] = []
+        self._collectors: List[Callable[[], List[Tuple[str, str, str, List[Sample]]]]] = []
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, help, labels)
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, labels, buckets)
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def collector(self, fn: Callable[[], List[Tuple[str, str, str, List[Sample]]]]) -> Callable:
+        """Registra `fn() -> [(nome, tipo, ajuda, [(labels, valor)])]`; pode ser usado como decorator."""
+        with self._lock:
+            self._collectors.append(fn)
+        return fn
+
+    def expose(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+        lines: List[str] = []
+        for metric in metrics:
+            lines.extend(metric.expose())
+        for fn in collectors:
+            try:
+                families = fn()
+            except Exception:
+                continue
+            for name, kind, help, samples in families:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    names = tuple(labels)
+                    lines.append(f"{name}{_fmt_labels(names, tuple(labels[n] for n in names))} {_fmt_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+def _fmt_value(value: Optional[float]) -> str:
+    if value is None:
+        return "NaN"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+REGISTRY = Registry()
@@ -0,0 +1,201 @@
+import heapq
+import itertools
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from metrics import REGISTRY
+from profiling import record
+
+OUTBOUND_WAIT = REGISTRY.histogram(
+    "funnel_outbound_wait_seconds", "Espera na fila do scheduler de saída", ("scheduler", "outcome")
+)
+OUTBOUND_OUTCOMES = REGISTRY.counter(
+    "funnel_outbound_total", "Pedidos ao scheduler de saída por resultado", ("scheduler", "outcome")
+)
+
+
+class TokenBucket:
+    """Balde de tokens: `rate` por segundo, até `burst` acumulados. `rate <= 0` é ilimitado.
+
+    Não é thread-safe sozinho; o scheduler usa sob o próprio lock.
+    """
+
+    def __init__(self, rate: float, burst: float = 0.0):
+        self.rate = rate
+        self.burst = max(1.0, burst or rate)
+        self.tokens = self.burst
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def ready(self, now: float) -> bool:
+        if self.rate <= 0:
+            return True
+        self._refill(now)
+        return self.tokens >= 1.0
+
+    def take(self) -> None:
+        if self.rate > 0:
+            self.tokens -= 1.0
+
+    def wait_time(self, now: float) -> float:
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        return max(0.0, (1.0 - self.tokens) / self.rate)
+
+
+class _Waiter:
+    __slots__ = ("priority", "key", "event", "outcome")
+
+    def __init__(self, priority: float, key: str):
+        self.priority = priority
+        self.key = key
+        self.event = threading.Event()
+        self.outcome = ""
+
+
+class OutboundScheduler:
+    """Fila de prioridade com limite de taxa na frente de um backend de saída.
+
+    `acquire` bloqueia quem chama até ser a vez dele: entre os que esperam, o
+    de maior prioridade cujo balde tem token passa primeiro. Há um balde
+    global (`rate`/`burst`) e, opcionalmente, um por chave (`key_rate`), por
+    exemplo por instância da Z-API. Um item de uma chave sem token não segura
+    os das outras.
+
+    Sob sobrecarga, devolve False em vez de bloquear:
+    - `shed`: com `shed_depth` ou mais esperando, prioridade abaixo de `shed_priority`;
+    - `evicted`: fila cheia (`max_queue`), o de menor prioridade sai;
+    - `timeout`: esperou mais que `max_wait`.
+
+    Com fila vazia e token disponível, passa direto, sem thread nem espera.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate: float = 0.0,
+        burst: float = 0.0,
+        key_rate: float = 0.0,
+        key_burst: float = 0.0,
+        max_queue: int = 500,
+        max_wait: float = 30.0,
+        shed_priority: Optional[float] = None,
+        shed_depth: int = 0,
+    ):
+        self.name = name
+        self.max_queue = max(1, max_queue)
+        self.max_wait = max_wait
+        self.shed_priority = shed_priority
+        self.shed_depth = shed_depth
+        self._bucket = TokenBucket(rate, burst)
+        self._key_rate = key_rate
+        self._key_burst = key_burst
+        self._key_buckets: Dict[str, TokenBucket] = {}
+        self._heap: List[Tuple[float, int, _Waiter]] = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self.counts = {"granted": 0, "shed": 0, "evicted": 0, "timeout": 0}
+
+    def _buckets(self, key: str) -> Tuple[TokenBucket, ...]:
+        if not key or self._key_rate <= 0:
+            return (self._bucket,)
+        bucket = self._key_buckets.get(key)
+        if bucket is None:
+            bucket = self._key_buckets[key] = TokenBucket(self._key_rate, self._key_burst)
+        return (self._bucket, bucket)
+
+    def acquire(self, priority: float, key: str = "", timeout: Optional[float] = None) -> bool:
+        """Espera a vez de usar o backend. True: pode chamar; False: descartado."""
+        timeout = self.max_wait if timeout is None else min(timeout, self.max_wait)
+        t0 = time.monotonic()
+        waiter = _Waiter(priority, key)
+        with self._cond:
+            buckets = self._buckets(key)
+            if not self._heap and all(b.ready(t0) for b in buckets):
+                for b in buckets:
+                    b.take()
+                waiter.outcome = "granted"
+            elif (
+                self.shed_priority is not None
+                and len(self._heap) >= self.shed_depth
+                and priority < self.shed_priority
+            ):
+                waiter.outcome = "shed"
+            else:
+                if len(self._heap) >= self.max_queue:
+                    # Sai o de menor prioridade (o mais novo, no empate), que pode ser o próprio pedido
+                    lowest = max(self._heap)
+                    if (-priority, float("inf")) > lowest[:2]:
+                        waiter.outcome = "evicted"
+                    else:
+                        self._heap.remove(lowest)
+                        heapq.heapify(self._heap)
+                        lowest[2].outcome = "evicted"
+                        lowest[2].event.set()
+                if not waiter.outcome:
+                    heapq.heappush(self._heap, (-priority, next(self._seq), waiter))
+                    self._ensure_dispatcher()
+                    self._cond.notify()
+        if not waiter.outcome:
+            waiter.event.wait(timeout)
+            with self._cond:
+                if not waiter.outcome:
+                    waiter.outcome = "timeout"
+                    self._heap = [e for e in self._heap if e[2] is not waiter]
+                    heapq.heapify(self._heap)
+        self._record(waiter.outcome, time.monotonic() - t0)
+        return waiter.outcome == "granted"
+
+    def _record(self, outcome: str, waited: float) -> None:
+        OUTBOUND_WAIT.observe(waited, self.name, outcome)
+        OUTBOUND_OUTCOMES.inc(self.name, outcome)
+        record("outbound_wait", self.name, waited)
+        with self._cond:
+            self.counts[outcome] += 1
+
+    def _ensure_dispatcher(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._dispatch, name=f"outbound-{self.name}", daemon=True)
+            self._thread.start()
+
+    def _dispatch(self) -> None:
+        with self._cond:
+            while True:
+                wake: Optional[float] = None
+                if self._heap:
+                    now = time.monotonic()
+                    granted = False
+                    for entry in sorted(self._heap):
+                        waiter = entry[2]
+                        buckets = self._buckets(waiter.key)
+                        if all(b.ready(now) for b in buckets):
+                            for b in buckets:
+                                b.take()
+                            waiter.outcome = "granted"
+                            waiter.event.set()
+                            granted = True
+                        else:
+                            t = max(b.wait_time(now) for b in buckets)
+                            wake = t if wake is None else min(wake, t)
+                        if not self._bucket.ready(now):
+                            # Sem token global ninguém mais passa nesta rodada
+                            t = self._bucket.wait_time(now)
+                            wake = t if wake is None else min(wake, t)
+                            break
+                    if granted:
+                        self._heap = [e for e in self._heap if not e[2].outcome]
+                        heapq.heapify(self._heap)
+                self._cond.wait(timeout=wake if self._heap else None)
+
+    def depth(self) -> int:
+        return len(self._heap)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {"waiting": len(self._heap), "rate": self._bucket.rate, "key_rate": self._key_rate, **self.counts}
@@ -0,0 +1,227 @@
+import functools
+import itertools
+import re
+import sys
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional
+
+MAX_CALLS = 50  # chamadas de saída guardadas por requisição
+
+_current: ContextVar[Optional["RequestTrace"]] = ContextVar("request_trace", default=None)
+
+
+class SamplingProfiler:
+    """Amostra a pilha de uma thread a cada `interval` segundos, numa thread à parte.
+
+    O resultado é por função: amostras em que ela estava no topo (`self`) ou em
+    qualquer ponto da pilha (`total`), convertidas em ms estimados. Uma chamada
+    longa em C que segura o GIL (um regex com backtracking, por exemplo) atrasa
+    as amostras; os tempos por detector do `RequestTrace` cobrem esse caso.
+    """
+
+    def __init__(self, thread_id: int, interval: float = 0.001, max_depth: int = 64):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = 0
+        self._self: Dict[str, int] = {}
+        self._total: Dict[str, int] = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._started = 0.0
+        self.elapsed = 0.0
+
+    def start(self) -> "SamplingProfiler":
+        self._started = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.elapsed = time.perf_counter() - self._started
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None or self._stop.is_set():
+                continue
+            self.samples += 1
+            seen = set()
+            depth = 0
+            top = True
+            while frame is not None and depth < self.max_depth:
+                code = frame.f_code
+                name = f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})"
+                if top:
+                    self._self[name] = self._self.get(name, 0) + 1
+                    top = False
+                if name not in seen:
+                    seen.add(name)
+                    self._total[name] = self._total.get(name, 0) + 1
+                frame = frame.f_back
+                depth += 1
+
+    def report(self, limit: int = 30) -> Dict[str, Any]:
+        # Cada amostra vale o tempo real entre amostras, não o intervalo pedido
+        per_sample = self.elapsed / self.samples * 1000 if self.samples else 0.0
+        # Ordena pelo tempo próprio: a pilha do Flask aparece em toda amostra e só ocuparia o topo
+        top = sorted(self._total.items(), key=lambda kv: (-self._self.get(kv[0], 0), -kv[1]))[:limit]
+        return {
+            "samples": self.samples,
+            "interval_ms": round(self.interval * 1000, 3),
+            "functions": [
+                {"function": name, "total_ms": round(n * per_sample, 2), "self_ms": round(self._self.get(name, 0) * per_sample, 2)}
+                for name, n in top
+            ],
+        }
+
+
+class RequestTrace:
+    """Tempos de uma requisição: detectores, etapas do pipeline e chamadas de saída."""
+
+    def __init__(self, profiler: Optional[SamplingProfiler] = None):
+        self.started = time.perf_counter()
+        self.timings: Dict[str, Dict[str, List[float]]] = {}
+        self.calls: List[Dict[str, Any]] = []
+        self.profiler = profiler
+
+    def add(self, group: str, name: str, seconds: float) -> None:
+        row = self.timings.setdefault(group, {}).setdefault(name, [0, 0.0])
+        row[0] += 1
+        row[1] += seconds
+
+    def call(self, backend: str, method: str, status: str, seconds: float) -> None:
+        self.add("outbound", f"{backend} {method}", seconds)
+        if len(self.calls) < MAX_CALLS:
+            self.calls.append({"backend": backend, "method": method, "status": status, "ms": round(seconds * 1000, 2)})
+
+    def summary(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {
+            group: {name: {"calls": int(n), "ms": round(total * 1000, 2)} for name, (n, total) in sorted(rows.items())}
+            for group, rows in sorted(self.timings.items())
+        }
+        if self.calls:
+            out["calls"] = list(self.calls)
+        if self.profiler is not None:
+            out["profile"] = self.profiler.report()
+        return out
+
+
+def start_trace(profile: bool = False, interval: float = 0.001) -> Any:
+    """Abre um trace no contexto atual; devolve o token para `finish_trace`."""
+    profiler = SamplingProfiler(threading.get_ident(), interval).start() if profile else None
+    return _current.set(RequestTrace(profiler))
+
+
+def finish_trace(token: Any) -> Optional[RequestTrace]:
+    trace = _current.get()
+    _current.reset(token)
+    if trace is not None and trace.profiler is not None:
+        trace.profiler.stop()
+    return trace
+
+
+def current_trace() -> Optional[RequestTrace]:
+    return _current.get()
+
+
+def record(group: str, name: str, seconds: float) -> None:
+    trace = _current.get()
+    if trace is not None:
+        trace.add(group, name, seconds)
+
+
+def record_call(backend: str, method: str, status: str, seconds: float) -> None:
+    trace = _current.get()
+    if trace is not None:
+        trace.call(backend, method, status, seconds)
+
+
+def timed(group: str) -> Callable:
+    """Decorator: soma a duração da função no trace ativo (sem trace, só uma consulta ao contexto)."""
+
+    def decorate(fn: Callable) -> Callable:
+        name = fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            trace = _current.get()
+            if trace is None:
+                return fn(*args, **kwargs)
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                trace.add(group, name, time.perf_counter() - t0)
+
+        return wrapper
+
+    return decorate
+
+
+# ---- redação ----
+
+RE_EMAIL = re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+")
+# Telefone, CPF, CNPJ, cartão: sequências longas de dígitos (com separadores)
+RE_LONG_NUMBER = re.compile(r"\+?\d[\d .()/-]{6,}\d")
+SECRET_KEYS = ("token", "authorization", "password", "senha", "secret", "api_key", "apikey")
+
+
+def _mask_number(m: "re.Match[str]") -> str:
+    digits = re.sub(r"\D", "", m.group())
+    if len(digits) < 8:
+        return m.group()
+    return "*" * (len(digits) - 4) + digits[-4:]
+
+
+def redact(value: Any, max_chars: int = 20000) -> Any:
+    """Cópia de `value` sem segredos, e-mails e números longos; textos cortados em `max_chars`.
+
+    Números curtos ficam ("R$ 5 mil", "amanhã às 10"), para o payload continuar
+    reproduzindo os mesmos sinais.
+    """
+    if isinstance(value, dict):
+        return {
+            k: "***" if any(s in str(k).lower() for s in SECRET_KEYS) else redact(v, max_chars)
+            for k, v in value.items()
+        }
+    if isinstance(value, list):
+        return [redact(v, max_chars) for v in value]
+    if isinstance(value, str):
+        text = RE_LONG_NUMBER.sub(_mask_number, RE_EMAIL.sub("<email>", value))
+        return text if len(text) <= max_chars else text[:max_chars] + f"...[+{len(text) - max_chars}]"
+    return value
+
+
+class SlowLog:
+    """Últimas `size` capturas (lentas ou perfiladas), em memória."""
+
+    def __init__(self, size: int = 100):
+        self._items: deque = deque(maxlen=max(1, size))
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.captured = 0
+
+    def add(self, entry: Dict[str, Any]) -> Dict[str, Any]:
+        with self._lock:
+            entry = {"id": next(self._ids), **entry}
+            self._items.append(entry)
+            self.captured += 1
+        return entry
+
+    def list(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            items = list(self._items)
+        return [{k: v for k, v in e.items() if k not in ("payload", "timings")} for e in reversed(items)]
+
+    def get(self, entry_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return next((e for e in self._items if e["id"] == entry_id), None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"buffered": len(self._items), "captured": self.captured}
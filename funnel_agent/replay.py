@@ -0,0 +1,296 @@
+# Replay: reprocessa conversas antigas com as heurísticas atuais e compara com a análise gravada.
+#
+#   python3 replay.py                                   # var/data/history.jsonl e segmentos
+#   python3 replay.py antigo.jsonl.gz --out diff.jsonl --workers 8
+#   python3 replay.py transcricoes/ --tenant acme       # corpus de .txt ou JSONL com "transcript"
+#
+# Cada registro alterado vira uma linha em --out; o resumo (transições de estágio,
+# deltas de score, tags adicionadas/removidas) sai em JSON no stdout.
+import argparse
+import glob
+import json
+import multiprocessing as mp
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from history_store import history_segments, iter_jsonl
+
+# Registro de entrada: (origem, registro); origem é o arquivo, para o relatório
+Item = Tuple[str, Dict[str, Any]]
+
+
+def iter_inputs(paths: List[str]) -> Iterator[Item]:
+    """Registros de logs JSONL (com segmentos e .gz) e transcrições em .txt, em streaming."""
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(glob.glob(os.path.join(glob.escape(path), "**", "*.txt"), recursive=True))
+            for name in files:
+                yield from _iter_txt(name)
+        elif path.endswith(".txt"):
+            yield from _iter_txt(path)
+        else:
+            for segment in history_segments(path) or [path]:
+                for record in iter_jsonl([segment]):
+                    yield os.path.basename(segment), record
+
+
+def _iter_txt(path: str) -> Iterator[Item]:
+    with open(path, encoding="utf-8", errors="replace") as fh:
+        transcript = fh.read()
+    yield os.path.basename(path), {"lead_id": os.path.splitext(os.path.basename(path))[0], "transcript": transcript}
+
+
+def _tenant_of(analysis: Dict[str, Any]) -> str:
+    # Análises feitas com pacote de tenant trazem "rules": "<tenant>@<versão>"
+    return str(analysis.get("rules", "")).split("@", 1)[0]
+
+
+def compare(old: Optional[Dict[str, Any]], new: Dict[str, Any]) -> Dict[str, Any]:
+    """Diferenças entre a análise gravada e a nova (vazio se não mudou nada relevante)."""
+    if not old:
+        return {}
+    diff: Dict[str, Any] = {}
+    if old.get("stage") != new.get("stage"):
+        diff["stage"] = [old.get("stage"), new.get("stage")]
+    old_score, new_score = old.get("lead_score"), new.get("lead_score")
+    if isinstance(old_score, (int, float)) and old_score != new_score:
+        diff["lead_score"] = [old_score, new_score, new_score - old_score]
+    old_tags, new_tags = set(old.get("tags") or ()), set(new.get("tags") or ())
+    if old_tags != new_tags:
+        diff["tags_added"] = sorted(new_tags - old_tags)
+        diff["tags_removed"] = sorted(old_tags - new_tags)
+    return diff
+
+
+class Summary:
+    """Agregados do replay; o tamanho depende do vocabulário (estágios, tags), não do volume."""
+
+    def __init__(self):
+        self.records = 0
+        self.compared = 0
+        self.changed = 0
+        self.errors = 0
+        self.skipped = 0
+        self.stages: Dict[str, int] = {}
+        self.transitions: Dict[str, int] = {}
+        self.score_deltas: Dict[int, int] = {}
+        self.tags_added: Dict[str, int] = {}
+        self.tags_removed: Dict[str, int] = {}
+
+    def add(self, new: Dict[str, Any], compared: bool, diff: Dict[str, Any]) -> None:
+        self.records += 1
+        self.compared += compared
+        self.changed += bool(diff)
+        _bump(self.stages, new.get("stage"))
+        if "stage" in diff:
+            _bump(self.transitions, "{}>{}".format(*diff["stage"]))
+        if "lead_score" in diff:
+            _bump(self.score_deltas, diff["lead_score"][2])
+        for tag in diff.get("tags_added", ()):
+            _bump(self.tags_added, tag)
+        for tag in diff.get("tags_removed", ()):
+            _bump(self.tags_removed, tag)
+
+    def merge(self, other: "Summary") -> None:
+        self.records += other.records
+        self.compared += other.compared
+        self.changed += other.changed
+        self.errors += other.errors
+        self.skipped += other.skipped
+        for mine, theirs in (
+            (self.stages, other.stages),
+            (self.transitions, other.transitions),
+            (self.score_deltas, other.score_deltas),
+            (self.tags_added, other.tags_added),
+            (self.tags_removed, other.tags_removed),
+        ):
+            for k, v in theirs.items():
+                _bump(mine, k, v)
+
+    def to_dict(self) -> Dict[str, Any]:
+        deltas = self.score_deltas
+        changed = sum(deltas.values())
+        return {
+            "records": self.records,
+            "compared": self.compared,
+            "changed": self.changed,
+            "errors": self.errors,
+            "skipped": self.skipped,
+            "stages": dict(sorted(self.stages.items())),
+            "stage_transitions": dict(sorted(self.transitions.items(), key=lambda kv: (-kv[1], kv[0]))),
+            "score": {
+                "changed": changed,
+                "mean_delta": round(sum(d * n for d, n in deltas.items()) / changed, 2) if changed else 0,
+                "min_delta": min(deltas) if deltas else 0,
+                "max_delta": max(deltas) if deltas else 0,
+                "deltas": {str(d): n for d, n in sorted(deltas.items())},
+            },
+            "tags": {"added": dict(sorted(self.tags_added.items())), "removed": dict(sorted(self.tags_removed.items()))},
+        }
+
+
+def _bump(counts: Dict[Any, int], key: Any, value: int = 1) -> None:
+    counts[key] = counts.get(key, 0) + value
+
+
+def _worker(index: int, inbox: Any, outbox: Any, options: Dict[str, Any]) -> None:
+    # Importa o app só no worker: o processo principal apenas lê e distribui
+    import app
+    from lead_state import LeadStateStore
+
+    store = LeadStateStore(os.path.join(options["state_dir"], f"state-{index}.sqlite3"), cache_size=options["cache_size"])
+    summary = Summary()
+    while True:
+        chunk = inbox.get()
+        if chunk is None:
+            break
+        lines: List[str] = []
+        for origin, record in chunk:
+            if "transcript" not in record and "text" not in record:
+                # Sem o texto original (ex.: analysis.jsonl) não há o que reanalisar
+                summary.skipped += 1
+                continue
+            try:
+                old = record.get("analysis") if isinstance(record.get("analysis"), dict) else None
+                tenant = options["tenant"] or _tenant_of(old or {})
+                rules = app.RULES.get(tenant)
+                lead_id = str(record.get("lead_id") or "")
+                if "transcript" in record:
+                    new = app.analyze_transcript(lead_id, record.get("transcript") or "", record.get("metadata") or {}, rules)
+                elif old is not None and "messages" in old and not options["stateless"]:
+                    # Mensagem do webhook com estado acumulado: refaz o estado do lead na ordem do log
+                    new = app.analyze_message(lead_id, record.get("text") or "", {"origem": "whatsapp"}, rules, store)
+                else:
+                    new = app.analyze_transcript(lead_id, record.get("text") or "", {"origem": "whatsapp"}, rules)
+            except Exception as exc:
+                summary.errors += 1
+                lines.append(json.dumps({"source": origin, "lead_id": record.get("lead_id"), "error": str(exc)}, ensure_ascii=False))
+                continue
+            diff = compare(old, new)
+            summary.add(new, old is not None, diff)
+            if diff:
+                lines.append(json.dumps({"source": origin, "lead_id": lead_id, "ts": record.get("ts"), **diff}, ensure_ascii=False))
+        outbox.put(("lines", lines))
+    outbox.put(("done", summary))
+
+
+def replay(
+    items: Iterator[Item],
+    out: Any,
+    workers: int,
+    chunk_size: int = 256,
+    tenant: str = "",
+    stateless: bool = False,
+    cache_size: int = 10000,
+) -> Summary:
+    """Distribui `items` entre `workers` processos e escreve as diferenças em `out`.
+
+    O mesmo lead vai sempre para o mesmo worker, na ordem do log, para que o
+    estado acumulado seja refeito como no webhook. As filas de entrada são
+    limitadas e o estado dos leads fica em SQLite temporário com cache LRU,
+    então a memória não cresce com o número de registros.
+    """
+    workers = max(1, workers)
+    state_dir = tempfile.mkdtemp(prefix="replay-")
+    options = {"state_dir": state_dir, "tenant": tenant, "stateless": stateless, "cache_size": cache_size}
+    outbox: Any = mp.Queue()
+    inboxes = [mp.Queue(maxsize=4) for _ in range(workers)]
+    procs = [mp.Process(target=_worker, args=(i, inboxes[i], outbox, options), daemon=True) for i in range(workers)]
+    for p in procs:
+        p.start()
+    total = Summary()
+    done = 0
+
+    def drain(block: bool) -> None:
+        nonlocal done
+        while True:
+            try:
+                kind, payload = outbox.get(timeout=0.5) if block else outbox.get_nowait()
+            except queue.Empty:
+                return
+            if kind == "lines":
+                for line in payload:
+                    out.write(line + "\n")
+            else:
+                total.merge(payload)
+                done += 1
+            block = False
+
+    def send(index: int, chunk: Any) -> None:
+        # Com a fila do worker cheia, esvazia a saída enquanto espera: evita deadlock
+        while True:
+            try:
+                inboxes[index].put(chunk, timeout=0.1)
+                return
+            except queue.Full:
+                # Worker morto não esvazia mais a fila: aborta em vez de tentar para sempre
+                if procs[index].exitcode is not None:
+                    raise RuntimeError(f"worker {index} do replay encerrou (código {procs[index].exitcode})")
+                drain(False)
+
+    try:
+        buffers: List[List[Item]] = [[] for _ in range(workers)]
+        for origin, record in items:
+            index = zlib.crc32(str(record.get("lead_id") or "").encode("utf-8")) % workers
+            buffers[index].append((origin, record))
+            if len(buffers[index]) >= chunk_size:
+                send(index, buffers[index])
+                buffers[index] = []
+                drain(False)
+        for index, buf in enumerate(buffers):
+            if buf:
+                send(index, buf)
+            send(index, None)
+        while done < workers:
+            if any(p.exitcode not in (None, 0) for p in procs):
+                raise RuntimeError("worker do replay encerrou com erro")
+            drain(True)
+    finally:
+        for p in procs:
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+        shutil.rmtree(state_dir, ignore_errors=True)
+    return total
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Replay das heurísticas sobre o histórico")
+    parser.add_argument("inputs", nargs="*", help="history.jsonl (segmentos e .gz incluídos), JSONL com transcript, .txt ou diretório de .txt")
+    parser.add_argument("--out", default=os.path.join("var", "data", "replay_diff.jsonl"), help="diferenças por registro (JSONL)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk-size", type=int, default=256)
+    parser.add_argument("--tenant", default="", help="força o pacote de regras; padrão: o registrado na análise")
+    parser.add_argument("--stateless", action="store_true", help="analisa cada mensagem sozinha, sem refazer o estado do lead")
+    parser.add_argument("--cache-size", type=int, default=10000, help="leads em memória por worker")
+    args = parser.parse_args(argv)
+
+    inputs = args.inputs or [os.path.join("var", "data", "history.jsonl")]
+    out_dir = os.path.dirname(os.path.abspath(args.out))
+    os.makedirs(out_dir, exist_ok=True)
+    t0 = time.time()
+    with open(args.out, "w", encoding="utf-8") as out:
+        summary = replay(
+            iter_inputs(inputs),
+            out,
+            workers=args.workers,
+            chunk_size=args.chunk_size,
+            tenant=args.tenant,
+            stateless=args.stateless,
+            cache_size=args.cache_size,
+        )
+    result = summary.to_dict()
+    result["seconds"] = round(time.time() - t0, 2)
+    result["out"] = args.out
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
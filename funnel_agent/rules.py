@@ -0,0 +1,478 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from functools import lru_cache
+from itertools import product
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+try:  # Python 3.11+
+    from re import _constants as sre_constants
+    from re import _parser as sre_parse
+except ImportError:  # pragma: no cover - Python < 3.11
+    import sre_constants  # type: ignore
+    import sre_parse  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("Novo", "Qualificacao", "Diagnostico", "Proposta", "Negociacao", "Fechamento", "PosVenda")
+URGENCY_LEVELS = ("Alta", "Media")
+
+MAX_ALTERNATIVES = 64  # acima disso um trecho deixa de ser tratado como literal
+MAX_LITERAL = 64  # literais mais longos são cortados (um prefixo obrigatório continua obrigatório)
+
+
+# --------- Prefiltro por literais ---------
+
+def _fixed(seq: Any) -> Optional[Set[str]]:
+    """Todas as strings que `seq` pode casar, se forem poucas e finitas; senão None."""
+    out: Set[str] = {""}
+    for op, av in seq:
+        if op is sre_constants.LITERAL:
+            options = {chr(av)}
+        elif op is sre_constants.IN:
+            if any(o is not sre_constants.LITERAL for o, _ in av):
+                return None
+            options = {chr(c) for _, c in av}
+        elif op is sre_constants.SUBPATTERN:
+            options = _fixed(av[-1])
+        elif op is sre_constants.BRANCH:
+            options = set()
+            for branch in av[1]:
+                alt = _fixed(branch)
+                if alt is None:
+                    return None
+                options |= alt
+        elif op is sre_constants.AT:
+            options = {""}
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[1] == 1:
+            inner = _fixed(av[2])
+            options = None if inner is None else inner | ({""} if av[0] == 0 else set())
+        else:
+            return None
+        if options is None:
+            return None
+        out = {a + b for a, b in product(out, options)}
+        if len(out) > MAX_ALTERNATIVES:
+            return None
+    return out
+
+
+def _better(a: Optional[Set[str]], b: Optional[Set[str]]) -> Optional[Set[str]]:
+    # Prefere o conjunto cujo literal mais curto é mais longo; empate: menos alternativas
+    if not b or "" in b:
+        return a
+    if not a:
+        return b
+    ka = (min(map(len, a)), -len(a))
+    kb = (min(map(len, b)), -len(b))
+    return b if kb > ka else a
+
+
+def _required(seq: Any) -> Optional[Set[str]]:
+    """Conjunto de literais tal que todo match de `seq` contém pelo menos um deles."""
+    whole = _fixed(seq)
+    if whole is not None and "" not in whole:
+        return whole
+    best: Optional[Set[str]] = None
+    run: Set[str] = {""}
+    for item in seq:
+        options = _fixed([item])
+        if options is not None:
+            extended = {a + b for a, b in product(run, options)}
+            if len(extended) <= MAX_ALTERNATIVES:
+                run = extended
+                continue
+            # Explodiu: fecha o trecho atual e recomeça a partir deste item
+            best = _better(best, run)
+            run = options
+            continue
+        best = _better(best, run)
+        run = {""}
+        op, av = item
+        if op is sre_constants.SUBPATTERN:
+            best = _better(best, _required(av[-1]))
+        elif op is sre_constants.BRANCH:
+            alts: Set[str] = set()
+            for branch in av[1]:
+                req = _required(branch)
+                if not req:
+                    alts = set()
+                    break
+                alts |= req
+            best = _better(best, alts or None)
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] >= 1:
+            best = _better(best, _required(av[2]))
+    return _better(best, run)
+
+
+def required_literals(pattern: str) -> Optional[FrozenSet[str]]:
+    """Literais (em casefold) que todo match de `pattern` contém; None se não der para saber."""
+    try:
+        req = _required(sre_parse.parse(pattern, re.IGNORECASE))
+    except Exception:
+        return None
+    if not req or "" in req:
+        return None
+    return frozenset(lit.casefold()[:MAX_LITERAL] for lit in req)
+
+
+def _trie_regex(words: Iterable[str]) -> str:
+    # Trie em forma de regex: em cada posição o custo depende do texto, não do número de literais
+    trie: Dict[str, Any] = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def build(node: Dict[str, Any]) -> str:
+        alts = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not alts:
+            return ""
+        body = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+        return f"(?:{body})?" if "" in node else body
+
+    return build(trie)
+
+
+class LiteralPrefilter:
+    """Encontra, numa passada, quais literais de um conjunto aparecem no texto.
+
+    O regex em trie devolve o literal mais longo que começa em cada posição
+    (grupo dentro de lookahead, então matches sobrepostos também aparecem); os
+    literais que são prefixo dele são incluídos a partir de uma tabela pronta.
+    """
+
+    def __init__(self, literals: Iterable[str]):
+        self.literals = sorted(set(lit for lit in literals if lit))
+        known = set(self.literals)
+        self._prefixes = {lit: [lit[:i] for i in range(1, len(lit) + 1) if lit[:i] in known] for lit in self.literals}
+        self._regex = re.compile(f"(?=({_trie_regex(self.literals)}))", re.DOTALL) if self.literals else None
+
+    def find(self, folded: str) -> Set[str]:
+        if self._regex is None:
+            return set()
+        found: Set[str] = set()
+        for m in self._regex.finditer(folded):
+            longest = m.group(1)
+            if longest not in found:
+                found.update(self._prefixes[longest])
+        return found
+
+
+@lru_cache(maxsize=8192)
+def compile_rule(pattern: str) -> re.Pattern:
+    # Compartilhado entre pacotes: padrões repetidos em vários tenants compilam uma vez
+    return re.compile(pattern, re.IGNORECASE)
+
+
+# --------- Sinais ---------
+
+class Signals:
+    """Resultado de uma varredura: o primeiro match de cada padrão (ou None).
+
+    Criado por `SignalEngine.scan`, avalia cada padrão só quando um detector
+    pergunta por ele, e nem isso se o prefiltro já descartou o padrão.
+    """
+
+    __slots__ = ("matches", "rules", "_text", "_engine", "_candidates")
+
+    def __init__(
+        self,
+        matches: Optional[Dict[str, Any]] = None,
+        rules: Optional["RulePack"] = None,
+        text: str = "",
+        engine: Optional["SignalEngine"] = None,
+        candidates: FrozenSet[str] = frozenset(),
+    ):
+        self.matches = matches if matches is not None else {}
+        self.rules = rules
+        self._text = text
+        self._engine = engine
+        self._candidates = candidates
+
+    def _match(self, pattern: str) -> Any:
+        if pattern in self.matches:
+            return self.matches[pattern]
+        if self._engine is None:
+            raise KeyError(pattern)
+        m = self._engine.search(pattern, self._text) if pattern in self._candidates else None
+        self.matches[pattern] = m
+        return m
+
+    def hit(self, pattern: str) -> bool:
+        return self._match(pattern) is not None
+
+    def any(self, patterns: List[str]) -> bool:
+        return any(self._match(p) is not None for p in patterns)
+
+    def group(self, pattern: str) -> Optional[str]:
+        m = self._match(pattern)
+        return m.group(0) if m else None
+
+    def hits(self) -> List[str]:
+        order = self._engine.order if self._engine is not None else list(self.matches)
+        return [p for p in order if self._match(p) is not None]
+
+
+class SignalEngine:
+    """Junta todas as tabelas de regras e compila cada padrão distinto uma única vez.
+
+    Antes de rodar qualquer regex, uma passada do prefiltro de literais sobre o
+    texto em casefold diz quais padrões podem casar; só esses (e os que não têm
+    literal obrigatório) são avaliados.
+    """
+
+    def __init__(self, tables: Dict[str, List[str]]):
+        self.tables = tables
+        self.order: List[str] = []
+        self.patterns: Dict[str, re.Pattern] = {}
+        for patterns in tables.values():
+            for p in patterns:
+                if p not in self.patterns:
+                    self.patterns[p] = compile_rule(p)
+                    self.order.append(p)
+        self.literals: Dict[str, Optional[FrozenSet[str]]] = {p: required_literals(p) for p in self.order}
+        self.always = frozenset(p for p, lits in self.literals.items() if lits is None)
+        self._by_literal: Dict[str, List[str]] = {}
+        for p, lits in self.literals.items():
+            for lit in lits or ():
+                self._by_literal.setdefault(lit, []).append(p)
+        self.prefilter = LiteralPrefilter(self._by_literal)
+
+    def candidates(self, text: str) -> FrozenSet[str]:
+        found = self.prefilter.find(text.casefold())
+        return self.always.union(p for lit in found for p in self._by_literal[lit])
+
+    def search(self, pattern: str, text: str) -> Optional[re.Match]:
+        return self.patterns[pattern].search(text)
+
+    def scan(self, text: str, rules: Optional["RulePack"] = None) -> Signals:
+        return Signals(rules=rules, text=text, engine=self, candidates=self.candidates(text))
+
+
+# --------- Pacotes de regras ---------
+
+class RulePack:
+    """Tabelas de regras de um tenant, já compiladas.
+
+    As chaves seguem as tabelas de `app.py`; o que o arquivo do tenant não
+    define vem do pacote base.
+    """
+
+    KEYS = (
+        "stage_rules", "pain", "objections", "budget", "decision_positive", "decision_negative",
+        "intent_strong", "intent_medium", "urgency", "compare", "icp_segments", "icp_sizes",
+    )
+
+    def __init__(self, tenant: str, version: str, tables: Dict[str, Any], instances: Iterable[str] = (), source: str = "", digest: str = ""):
+        self.tenant = tenant
+        self.version = version
+        self.instances = tuple(instances)
+        self.source = source
+        self.digest = digest
+        self.stage_rules: List[Tuple[str, List[str]]] = [(s, list(ps)) for s, ps in tables["stage_rules"]]
+        self.pain: List[str] = list(tables["pain"])
+        self.objections: Dict[str, List[str]] = {k: list(v) for k, v in tables["objections"].items()}
+        self.budget: List[str] = list(tables["budget"])
+        self.decision_positive: List[str] = list(tables["decision_positive"])
+        self.decision_negative: List[str] = list(tables["decision_negative"])
+        self.intent_strong: List[str] = list(tables["intent_strong"])
+        self.intent_medium: List[str] = list(tables["intent_medium"])
+        self.urgency: List[Tuple[str, str]] = [(p, lvl) for p, lvl in tables["urgency"]]
+        self.compare: List[str] = list(tables["compare"])
+        self.icp_segments: List[str] = [s.lower() for s in tables["icp_segments"]]
+        self.icp_sizes: List[str] = [s.lower() for s in tables["icp_sizes"]]
+        self._validate()
+
+        self.signal_tables: Dict[str, List[str]] = {
+            "stage": [p for _, ps in self.stage_rules for p in ps],
+            "pain": self.pain,
+            "objection": [p for ps in self.objections.values() for p in ps],
+            "urgency": [p for p, _ in self.urgency],
+            "budget": self.budget,
+            "decision": self.decision_positive + self.decision_negative,
+            "intent": self.intent_strong + self.intent_medium,
+            "compare": self.compare,
+        }
+        self.engine = SignalEngine(self.signal_tables)
+        self.stage_priority = {name: i for i, (name, _) in enumerate(self.stage_rules)}
+        self.budget_numeric = {p: bool(re.search(r"\d", p)) for p in self.budget}
+        self.labels = self._labels()
+
+    def _validate(self) -> None:
+        for stage, _ in self.stage_rules:
+            if stage not in STAGES:
+                raise ValueError(f"estágio desconhecido: {stage}")
+        for _, level in self.urgency:
+            if level not in URGENCY_LEVELS:
+                raise ValueError(f"nível de urgência desconhecido: {level}")
+
+    def _labels(self) -> Dict[str, List[str]]:
+        # Para cada padrão, os sinais que ele alimenta (ex.: "stage:Proposta", "objection:preco")
+        labels: Dict[str, List[str]] = {}
+
+        def add(patterns: Iterable[str], label: str) -> None:
+            for p in patterns:
+                bucket = labels.setdefault(p, [])
+                if label not in bucket:
+                    bucket.append(label)
+
+        for stage, patterns in self.stage_rules:
+            add(patterns, f"stage:{stage}")
+        add(self.pain, "pain")
+        for label, patterns in self.objections.items():
+            add(patterns, f"objection:{label}")
+        for p, level in self.urgency:
+            add([p], f"urgency:{level}")
+        add(self.budget, "budget")
+        add(self.decision_positive, "decision:Sim")
+        add(self.decision_negative, "decision:Nao")
+        add(self.intent_strong, "intent:Alto")
+        add(self.intent_medium, "intent:Medio")
+        add(self.compare, "compare")
+        return labels
+
+    def tables(self) -> Dict[str, Any]:
+        return {k: getattr(self, k) for k in self.KEYS}
+
+    def scan(self, text: str) -> Signals:
+        return self.engine.scan(text, self)
+
+    @classmethod
+    def from_file(cls, path: str, base: "RulePack") -> "RulePack":
+        with open(path, "rb") as fh:
+            raw = fh.read()
+        return cls.from_json(raw, base, source=path)
+
+    @classmethod
+    def from_json(cls, raw: bytes, base: "RulePack", source: str = "") -> "RulePack":
+        digest = hashlib.sha256(raw).hexdigest()
+        spec = json.loads(raw)
+        if not isinstance(spec, dict):
+            raise ValueError("o pacote deve ser um objeto JSON")
+        unknown = set(spec) - set(cls.KEYS) - {"tenant", "version", "instances"}
+        if unknown:
+            raise ValueError(f"chaves desconhecidas: {sorted(unknown)}")
+        tenant = spec.get("tenant") or os.path.splitext(os.path.basename(source))[0]
+        tables = {**base.tables(), **{k: v for k, v in spec.items() if k in cls.KEYS}}
+        return cls(tenant, str(spec.get("version") or digest[:12]), tables, spec.get("instances") or (), source, digest)
+
+
+class RulePackRegistry:
+    """Pacotes de regras por tenant, lidos de `directory/*.json` e recarregados a quente.
+
+    A cada `reload_interval` segundos o primeiro `get` confere mtime/tamanho dos
+    arquivos; se algo mudou, os pacotes são relidos e trocados de uma vez (uma
+    atribuição), então uma requisição em andamento continua com o conjunto que
+    pegou. Pacotes compilados ficam em cache pelo hash do conteúdo: um arquivo
+    só tocado, ou de volta a uma versão anterior, não recompila nada. Arquivo
+    inválido é ignorado e o tenant mantém a versão que já estava carregada.
+    """
+
+    def __init__(self, default: RulePack, directory: str = "", reload_interval: float = 5.0):
+        self.base = default
+        self.directory = directory
+        self.reload_interval = reload_interval
+        # (pacotes por tenant, tenant por instância Z-API, assinatura do diretório)
+        self._state: Tuple[Dict[str, RulePack], Dict[str, str], Tuple] = ({"default": default}, {}, ())
+        self._compiled: Dict[str, RulePack] = {}
+        self._lock = threading.Lock()
+        self._next_check = 0.0
+        self.reloads = 0
+        self.errors: Dict[str, str] = {}
+        if directory:
+            self.reload()
+
+    def _signature(self) -> Tuple:
+        try:
+            entries = [e for e in os.scandir(self.directory) if e.name.endswith(".json") and e.is_file()]
+        except FileNotFoundError:
+            return ()
+        return tuple(sorted((e.name, e.stat().st_mtime_ns, e.stat().st_size) for e in entries))
+
+    def reload(self, force: bool = False) -> bool:
+        """Relê o diretório se mudou (ou sempre, com `force`). Devolve True se trocou os pacotes."""
+        with self._lock:
+            signature = self._signature()
+            packs, _, current = self._state
+            if signature == current and not force:
+                return False
+            default = self.base
+            names = [name for name, _, _ in signature]
+            # default.json, se existir, vira a base dos demais
+            if "default.json" in names:
+                names.remove("default.json")
+                names.insert(0, "default.json")
+            new_packs: Dict[str, RulePack] = {}
+            errors: Dict[str, str] = {}
+            compiled: Dict[str, RulePack] = {}
+            for name in names:
+                path = os.path.join(self.directory, name)
+                try:
+                    with open(path, "rb") as fh:
+                        raw = fh.read()
+                    key = hashlib.sha256(raw).hexdigest() + ("" if name == "default.json" else ":" + default.digest)
+                    pack = self._compiled.get(key) or RulePack.from_json(raw, default, source=path)
+                except Exception as exc:
+                    logger.error("rules: pacote %s inválido, mantendo a versão anterior: %s", name, exc)
+                    errors[name] = str(exc)
+                    stem = os.path.splitext(name)[0]
+                    previous = next((p for p in packs.values() if p.source == path), None) or packs.get(stem)
+                    if name == "default.json":
+                        # Base quebrada: os tenants continuam herdando da última base válida
+                        previous = packs["default"]
+                        default = previous
+                    if previous is not None:
+                        new_packs[previous.tenant] = previous
+                    continue
+                if pack.tenant == "default" and name != "default.json":
+                    logger.error("rules: %s declara o tenant reservado 'default'; use default.json", name)
+                    errors[name] = "tenant 'default' só pode vir de default.json"
+                    continue
+                compiled[key] = pack
+                if name == "default.json":
+                    default = pack
+                    pack.tenant = "default"
+                new_packs[pack.tenant] = pack
+            new_packs.setdefault("default", default)
+            instances = {i: p.tenant for p in new_packs.values() for i in p.instances}
+            self._state = (new_packs, instances, signature)
+            self._compiled = compiled
+            self.errors = errors
+            self.reloads += 1
+            self._next_check = time.monotonic() + self.reload_interval
+            return True
+
+    def _maybe_reload(self) -> None:
+        if not self.directory or time.monotonic() < self._next_check:
+            return
+        self._next_check = time.monotonic() + self.reload_interval
+        try:
+            self.reload()
+        except Exception:
+            logger.exception("rules: falha ao recarregar %s", self.directory)
+
+    def get(self, tenant: str = "") -> RulePack:
+        """Pacote do tenant; tenant vazio ou desconhecido usa o padrão."""
+        self._maybe_reload()
+        packs = self._state[0]
+        return packs.get(tenant) or packs["default"]
+
+    def for_instance(self, instance_id: str) -> RulePack:
+        self._maybe_reload()
+        packs, instances, _ = self._state
+        return packs.get(instances.get(instance_id, instance_id)) or packs["default"]
+
+    def stats(self) -> Dict[str, Any]:
+        packs, instances, _ = self._state
+        return {
+            "tenants": {t: p.version for t, p in sorted(packs.items())},
+            "instances": len(instances),
+            "reloads": self.reloads,
+            "errors": dict(self.errors),
+        }
@@ -0,0 +1,210 @@
+# Paridade: detectores sobre o SignalEngine (uma passada no texto) x detectores
+# antigos, uma regex por padrão, copiados da versão anterior ao engine.
+#
+#   cd funnel_agent && python3 -m pytest -q tests
+import os
+import re
+import sys
+from typing import Any, Dict, List
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+from transcripts import TranscriptGenerator  # noqa: E402
+
+
+def compile_patterns(patterns: List[str]) -> List[re.Pattern]:
+    return [re.compile(p, re.IGNORECASE) for p in patterns]
+
+
+PAIN_REGEX = compile_patterns(app.PAIN_PATTERNS)
+OBJECTION_REGEX = {k: compile_patterns(v) for k, v in app.OBJECTION_MAP.items()}
+BUDGET_REGEX = compile_patterns(app.BUDGET_PATTERNS)
+STAGE_REGEX = [(s, compile_patterns(ps)) for s, ps in app.STAGE_RULES]
+TIME_URGENCY_REGEX = [(re.compile(p, re.IGNORECASE), lvl) for p, lvl in app.TIME_URGENCY]
+COMPARE_REGEX = compile_patterns(app.COMPARE_PATTERNS)
+RE_SUMMARY_CLEAN = re.compile(r"\s+", re.MULTILINE)
+
+
+def legacy_stage(transcript: str):
+    hits = []
+    for stage, patterns in STAGE_REGEX:
+        for pat in patterns:
+            if pat.search(transcript):
+                hits.append(stage)
+                break
+    priority = {name: i for i, (name, _) in enumerate(app.STAGE_RULES)}
+    if not hits:
+        return "Novo", 0.35, []
+    top = min(hits, key=lambda s: priority[s])
+    confidence = 0.8 if top in ("Proposta", "Negociacao", "Fechamento") else 0.6
+    return top, confidence, hits
+
+
+def legacy_pain_points(transcript: str) -> List[str]:
+    pains = set()
+    for reg in PAIN_REGEX:
+        m = reg.search(transcript)
+        if m:
+            pains.add(m.group(0))
+    return list(pains)[:3]
+
+
+def legacy_objections(transcript: str) -> List[str]:
+    found = []
+    for label, regs in OBJECTION_REGEX.items():
+        for r in regs:
+            if r.search(transcript):
+                found.append(label)
+                break
+    return found
+
+
+def legacy_urgency(transcript: str) -> str:
+    for reg, lvl in TIME_URGENCY_REGEX:
+        if reg.search(transcript):
+            return lvl
+    return "Baixa"
+
+
+def legacy_budget_signal(transcript: str) -> str:
+    any_num = False
+    for reg in BUDGET_REGEX:
+        if reg.search(transcript):
+            if re.search(r"\d", reg.pattern):
+                any_num = True
+            else:
+                return "Indireto"
+    if any_num:
+        return "Presente"
+    return "Inexistente"
+
+
+def legacy_decision_maker(transcript: str) -> str:
+    positive = [r"sou o decisor", r"eu decido", r"posso aprovar", r"eu aprovo"]
+    negative = [r"meu chefe decide", r"preciso do gerente", r"aprova[çc][aã]o do gerente|compras"]
+    for p in compile_patterns(positive):
+        if p.search(transcript):
+            return "Sim"
+    for n in compile_patterns(negative):
+        if n.search(transcript):
+            return "Nao"
+    return "Desconhecido"
+
+
+def legacy_intent(transcript: str) -> str:
+    strong = [r"vamos fechar", r"quero contratar", r"enviar (a )?proposta", r"agendar demo", r"POC|piloto"]
+    medium = [r"avaliando", r"entender melhor", r"conhecer"]
+    for p in compile_patterns(strong):
+        if p.search(transcript):
+            return "Alto"
+    for p in compile_patterns(medium):
+        if p.search(transcript):
+            return "Medio"
+    return "Baixo"
+
+
+def legacy_lead_score(transcript: str, urgency: str, budget: str, decision: str) -> int:
+    score = 0
+    if legacy_pain_points(transcript) and urgency == "Alta":
+        score += 20
+    if budget == "Presente":
+        score += 15
+    if decision == "Sim":
+        score += 10
+    if any(r.search(transcript) for r in COMPARE_REGEX):
+        score += 10
+    if any(r.search(transcript) for r in OBJECTION_REGEX["prioridade"]):
+        score -= 10
+    return max(0, min(100, score))
+
+
+def legacy_summary(transcript: str) -> str:
+    words = RE_SUMMARY_CLEAN.sub(" ", transcript).strip().split()
+    return " ".join(words[:30])[:240]
+
+
+def legacy_signals(transcript: str) -> Dict[str, Any]:
+    urgency = legacy_urgency(transcript)
+    budget = legacy_budget_signal(transcript)
+    decision = legacy_decision_maker(transcript)
+    return {
+        "stage": legacy_stage(transcript),
+        "pain_points": legacy_pain_points(transcript),
+        "objections": legacy_objections(transcript),
+        "urgency": urgency,
+        "budget_signal": budget,
+        "decision_maker": decision,
+        "buying_intent": legacy_intent(transcript),
+        "lead_score": legacy_lead_score(transcript, urgency, budget, decision),
+        "summary_pt": legacy_summary(transcript),
+    }
+
+
+def engine_signals(transcript: str) -> Dict[str, Any]:
+    signals = app.scan_signals(transcript)
+    urgency = app.detect_urgency(transcript, signals)
+    budget = app.detect_budget_signal(transcript, signals)
+    decision = app.detect_decision_maker(transcript, signals)
+    return {
+        "stage": app.detect_stage(transcript, signals),
+        "pain_points": app.detect_pain_points(transcript, signals),
+        "objections": app.detect_objections(transcript, signals),
+        "urgency": urgency,
+        "budget_signal": budget,
+        "decision_maker": decision,
+        "buying_intent": app.detect_intent(transcript, signals),
+        "lead_score": app.compute_lead_score(transcript, urgency, budget, decision, signals),
+        "summary_pt": app.summarize_pt(transcript),
+    }
+
+
+FIXED = [
+    "",
+    "   \n\t ",
+    "oi",
+    "Olá, cheguei pelo site e tenho interesse",
+    "Cliente: está caro, o preço não cabe. Vendedor: posso ajustar o escopo.",
+    "Sou o decisor, quero contratar ainda este mês. Orçamento de R$ 15.000,00 aprovado.",
+    "Meu chefe decide, precisa de aprovação do gerente e de compras",
+    "Estamos comparando fornecedores e alternativas, pedimos outros orçamentos",
+    "Manda a proposta até amanhã, temos 30 dias para implantar",
+    "Vamos fechar hoje? Assinei contrato e o pagamento efetuado já está no sistema",
+    "Próximo trimestre talvez, agora não é prioridade",
+    "Queremos um piloto (POC) de 90 dias, budget de $ 2k/mês",
+    "ENVIAR PROPOSTA, DESCONTO, CONDIÇÕES, NEGOCIAR",
+    "precisamos entender problema, mapear requisitos e o contexto técnico",
+    "orçamento detalhado? cotação? mês que vem a gente vê",
+    "[00:01:30] Cliente: perdemos leads no follow-up manual\n[00:02:00] Vendedor: entendi a dor",
+    "R$5 mil\nou 10k ou 3 mil/mês, avaliando, quero conhecer e entender melhor",
+    "ação ação ação" * 200,
+]
+
+
+@pytest.mark.parametrize("transcript", FIXED)
+def test_fixed_transcripts(transcript: str):
+    assert engine_signals(transcript) == legacy_signals(transcript)
+
+
+@pytest.mark.parametrize("kind,n,seed", [("short", 400, 1), ("medium", 60, 2), ("long", 3, 3)])
+def test_generated_transcripts(kind: str, n: int, seed: int):
+    # Frases amostradas das próprias regex das tabelas, misturadas a texto neutro
+    for transcript in TranscriptGenerator(app, seed=seed).corpus(kind, n):
+        assert engine_signals(transcript) == legacy_signals(transcript), transcript[:200]
+
+
+def test_analyze_transcript_uses_engine_results():
+    transcript = "Sou o decisor, manda a proposta ainda este mês; perdemos leads, o concorrente é mais barato"
+    result = app.analyze_transcript("L1", transcript, {"segmento": "SaaS"})
+    legacy = legacy_signals(transcript)
+    assert result["stage"] == legacy["stage"][0]
+    assert result["pain_points"] == legacy["pain_points"]
+    assert result["objections"] == legacy["objections"]
+    assert result["urgency"] == legacy["urgency"]
+    assert result["budget_signal"] == legacy["budget_signal"]
+    assert result["decision_maker"] == legacy["decision_maker"]
+    assert result["buying_intent"] == legacy["buying_intent"]
+    if app.LEAD_MODEL is None:
+        assert result["lead_score"] == legacy["lead_score"]
@@ -0,0 +1,42 @@
+# Janelas sobrepostas do /analyze/stream: um match na borda entre janelas
+# aparece inteiro na janela seguinte, com ou sem espaço perto da borda.
+#
+#   cd funnel_agent && python3 -m pytest -q tests
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rules import SignalEngine  # noqa: E402
+from windowed_scan import WindowedScanner  # noqa: E402
+
+PATTERN = r"token=abc123"
+
+
+def scan(text: str, window: int = 64, overlap: int = 16, piece: int = 7) -> WindowedScanner:
+    scanner = WindowedScanner(SignalEngine({"t": [PATTERN]}), window=window, overlap=overlap)
+    for i in range(0, len(text), piece):
+        scanner.feed(text[i:i + piece])
+    scanner.finish()
+    return scanner
+
+
+@pytest.mark.parametrize("before", [55, 58, 60, 63])
+def test_match_across_boundary_without_whitespace(before: int):
+    # URL longa: nenhum espaço em toda a janela, o corte cai no limite (64)
+    text = "https://x.example/" + "a" * (before - 18) + PATTERN + "b" * 200
+    scanner = scan(text)
+    assert scanner.segments > 1
+    hit = scanner.matches.get(PATTERN)
+    assert hit is not None
+    assert hit.offset == before
+    assert hit.text == PATTERN
+
+
+def test_match_across_boundary_with_whitespace():
+    text = "palavra " * 7 + PATTERN + " fim" * 40
+    hit = scan(text).matches.get(PATTERN)
+    assert hit is not None
+    assert hit.offset == text.index(PATTERN)
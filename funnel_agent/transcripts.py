@@ -0,0 +1,118 @@
+# Transcrições sintéticas em PT-BR para testes e benchmarks: frases de sinal são
+# amostradas das próprias regex das tabelas de regras, misturadas a texto neutro.
+import random
+import re
+from typing import List
+
+try:
+    import re._parser as sre_parse  # Python 3.11+
+    from re._constants import (ANY, AT, BRANCH, CATEGORY, CATEGORY_DIGIT, CATEGORY_SPACE, IN, LITERAL,
+                               MAX_REPEAT, MIN_REPEAT, NEGATE, NOT_LITERAL, RANGE, SUBPATTERN)
+except ImportError:  # Python < 3.11
+    import sre_parse  # type: ignore
+    from sre_constants import (ANY, AT, BRANCH, CATEGORY, CATEGORY_DIGIT, CATEGORY_SPACE, IN, LITERAL,  # type: ignore
+                               MAX_REPEAT, MIN_REPEAT, NEGATE, NOT_LITERAL, RANGE, SUBPATTERN)
+
+FILLER = [
+    "a gente tem um time comercial de oito pessoas",
+    "hoje usamos planilha para acompanhar os leads",
+    "o pessoal de marketing gera bastante contato pelo site",
+    "queria entender como funciona a integração com o nosso sistema",
+    "na semana passada conversei com o Pedro sobre isso",
+    "o volume de atendimento cresce bastante no fim do ano",
+    "temos clientes no Brasil inteiro, principalmente em São Paulo",
+    "a equipe de suporte reclama do tempo de resposta",
+    "pode me explicar melhor como é o onboarding",
+    "isso faz sentido para a nossa operação",
+    "vou checar com o financeiro e te retorno",
+    "beleza, entendi",
+]
+
+SPEAKERS = ["Cliente", "Vendedor"]
+
+
+def _sample(parsed, rnd: random.Random) -> str:
+    out: List[str] = []
+    for op, av in parsed:
+        if op == LITERAL:
+            out.append(chr(av))
+        elif op == NOT_LITERAL or op == ANY:
+            out.append("x")
+        elif op == IN:
+            if av and av[0][0] == NEGATE:
+                out.append("x")
+                continue
+            choices: List[str] = []
+            for iop, iav in av:
+                if iop == LITERAL:
+                    choices.append(chr(iav))
+                elif iop == RANGE:
+                    choices.append(chr(rnd.randint(iav[0], iav[1])))
+                elif iop == CATEGORY:
+                    choices.append("5" if iav == CATEGORY_DIGIT else " " if iav == CATEGORY_SPACE else "a")
+            out.append(rnd.choice(choices) if choices else "x")
+        elif op == CATEGORY:
+            out.append("5" if av == CATEGORY_DIGIT else " " if av == CATEGORY_SPACE else "a")
+        elif op == BRANCH:
+            out.append(_sample(rnd.choice(av[1]), rnd))
+        elif op == SUBPATTERN:
+            out.append(_sample(av[-1], rnd))
+        elif op in (MAX_REPEAT, MIN_REPEAT):
+            lo, hi, sub = av
+            n = rnd.randint(lo, min(hi, lo + 2))
+            out.extend(_sample(sub, rnd) for _ in range(n))
+        elif op == AT:
+            continue
+    return "".join(out)
+
+
+def phrases_from_patterns(patterns: List[str], rnd: random.Random, per_pattern: int = 3) -> List[str]:
+    """Gera frases que casam com cada padrão (amostragem da própria regex)."""
+    phrases: List[str] = []
+    for p in patterns:
+        reg = re.compile(p, re.IGNORECASE)
+        parsed = sre_parse.parse(p)
+        for _ in range(per_pattern * 4):
+            sample = _sample(parsed, rnd).strip()
+            if sample and reg.search(sample):
+                phrases.append(sample)
+                if len(phrases) % per_pattern == 0:
+                    break
+    return phrases
+
+
+
+
+class TranscriptGenerator:
+    """Transcrições sintéticas em PT-BR com frases tiradas das tabelas de regras do app."""
+
+    def __init__(self, app_module, seed: int = 42):
+        self.rnd = random.Random(seed)
+        tables = app_module.SIGNAL_TABLES
+        self.signal_phrases = phrases_from_patterns(sorted({p for ps in tables.values() for p in ps}), self.rnd)
+
+    def sentence(self, signal_ratio: float = 0.35) -> str:
+        if self.rnd.random() < signal_ratio:
+            base = self.rnd.choice(FILLER)
+            return f"{base}, {self.rnd.choice(self.signal_phrases)}"
+        return self.rnd.choice(FILLER)
+
+    def whatsapp(self) -> str:
+        # Mensagem curta: 1-2 frases
+        return ". ".join(self.sentence(0.6) for _ in range(self.rnd.randint(1, 2))) + self.rnd.choice(["", "?", "!"])
+
+    def chat(self, turns: int = 40) -> str:
+        return "\n".join(f"{SPEAKERS[i % 2]}: {self.sentence()}." for i in range(turns))
+
+    def call(self, minutes: int = 60) -> str:
+        # Reunião: ~2 falas de ~75 palavras por minuto, com timestamp
+        lines: List[str] = []
+        for i in range(minutes * 2):
+            ts = f"[{i // 120:02d}:{(i // 2) % 60:02d}:{(i % 2) * 30:02d}]"
+            words = " ".join(self.sentence() for _ in range(6))
+            lines.append(f"{ts} {SPEAKERS[i % 2]}: {words}.")
+        return "\n".join(lines)
+
+    def corpus(self, kind: str, n: int) -> List[str]:
+        make = {"short": self.whatsapp, "medium": self.chat, "long": self.call}[kind]
+        return [make() for _ in range(n)]
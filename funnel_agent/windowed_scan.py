@@ -0,0 +1,137 @@
+import re
+from bisect import bisect_right
+from typing import Any, Dict, List, NamedTuple, Optional
+
+# "[00:12:34]", "00:12:34 -", "12:34" no início da linha
+RE_TIMESTAMP = re.compile(r"^\s*\[?(\d{1,2}:\d{2}(?::\d{2})?)\]?", re.MULTILINE)
+RE_WORD = re.compile(r"\S+")
+
+
+class SignalHit(NamedTuple):
+    """Primeira ocorrência de um padrão num texto lido em janelas.
+
+    Expõe `group()` como um `re.Match`, então pode ir direto para `Signals`.
+    """
+
+    text: str
+    offset: int
+    line: int
+    segment: int
+    timestamp: Optional[str]
+
+    def group(self, _index: int = 0) -> str:
+        return self.text
+
+
+def _last_space(text: str, end: int, limit: int = 4096) -> int:
+    # Índice logo após o último espaço antes de `end`; sem espaço por perto, corta em `end`
+    for i in range(end - 1, max(0, end - limit) - 1, -1):
+        if text[i].isspace():
+            return i + 1
+    return end
+
+
+def _next_space(text: str, start: int, end: int) -> int:
+    # Índice logo após o primeiro espaço em [start, end); sem espaço (URL longa, base64,
+    # texto CJK), `start`: a sobreposição fixa vale mais que começar em espaço
+    for i in range(start, end):
+        if text[i].isspace():
+            return i + 1
+    return start
+
+
+class WindowedScanner:
+    """Varre um texto recebido aos pedaços em janelas sobrepostas, com memória limitada.
+
+    Cada janela tem até `window` caracteres e repete os últimos `overlap` da
+    anterior, então um match que cruza a borda entre pedaços aparece inteiro na
+    janela seguinte. As janelas começam e terminam em espaço em branco para que
+    `\\b` se comporte como no texto completo; sem espaço perto da borda, a
+    janela corta no limite e a seguinte repete os `overlap` caracteres mesmo
+    assim. Guarda só a primeira ocorrência de cada padrão (com janela, linha e
+    timestamp) e as primeiras `summary_words` palavras; o resto do texto é
+    descartado assim que varrido.
+
+    `engine` é um `rules.SignalEngine`: cada janela passa pelo prefiltro de
+    literais e só os padrões candidatos ainda não encontrados são avaliados.
+    """
+
+    def __init__(self, engine: Any, window: int = 65536, overlap: int = 512, summary_words: int = 30):
+        if overlap >= window:
+            raise ValueError("overlap deve ser menor que window")
+        self.engine = engine
+        self.window = window
+        self.overlap = overlap
+        self.summary_words = summary_words
+        self.matches: Dict[str, SignalHit] = {}
+        self.words: List[str] = []
+        self.segments = 0
+        self.chars = 0
+        self._buf = ""
+        self._base = 0  # offset absoluto de _buf[0]
+        self._fresh = 0  # em _buf, onde começa o texto que nenhuma janela viu
+        self._lines = 0  # quebras de linha antes de _buf[0]
+        self._timestamp: Optional[str] = None  # timestamp vigente em _buf[0]
+        self._line_start = True  # _buf[0] é início de linha
+
+    def feed(self, text: str) -> None:
+        if not text:
+            return
+        self.chars += len(text)
+        self._buf += text
+        while len(self._buf) >= self.window:
+            self._scan(_last_space(self._buf, self.window), final=False)
+
+    def finish(self) -> Dict[str, SignalHit]:
+        if len(self._buf) > self._fresh or self.segments == 0:
+            self._scan(len(self._buf), final=True)
+        return self.matches
+
+    def summary(self) -> str:
+        return " ".join(self.words[: self.summary_words])[:240]
+
+    def _scan(self, cut: int, final: bool) -> None:
+        text = self._buf[:cut]
+        segment = self.segments
+        self.segments += 1
+
+        if len(self.words) < self.summary_words:
+            fresh = self._buf[self._fresh:cut]
+            for m in RE_WORD.finditer(fresh):
+                self.words.append(m.group())
+                if len(self.words) >= self.summary_words:
+                    break
+
+        # No meio de uma linha, "^" casaria no início da janela: ignora esse caso
+        stamps = [(m.start(), m.group(1)) for m in RE_TIMESTAMP.finditer(text) if m.start() or self._line_start]
+        stamp_pos = [p for p, _ in stamps]
+
+        def stamp_at(pos: int) -> Optional[str]:
+            i = bisect_right(stamp_pos, pos)
+            return stamps[i - 1][1] if i else self._timestamp
+
+        candidates = self.engine.candidates(text)
+        for pattern in self.engine.order:
+            if pattern in self.matches or pattern not in candidates:
+                continue
+            m = self.engine.search(pattern, text)
+            if m:
+                self.matches[pattern] = SignalHit(
+                    m.group(0),
+                    self._base + m.start(),
+                    self._lines + text.count("\n", 0, m.start()) + 1,
+                    segment,
+                    stamp_at(m.start()),
+                )
+
+        if final:
+            self._buf = ""
+            return
+        # A próxima janela repete o fim desta, começando depois de um espaço
+        start = _next_space(self._buf, max(0, cut - self.overlap), cut)
+        self._timestamp = stamp_at(start - 1) if start else self._timestamp
+        self._line_start = self._buf[start - 1] == "\n" if start else self._line_start
+        self._lines += self._buf.count("\n", 0, start)
+        self._base += start
+        self._buf = self._buf[start:]
+        self._fresh = cut - start